@@ -0,0 +1,204 @@
+import copy
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import gcmstools.filetypes as gcf
+import gcmstools.fitting as gcfit
+
+
+def synthetic_data(nscans=2000, ncpds=20, nmasses=300, peaks=15, width=0.02,
+        noise=0.01, seed=0):
+    '''Create a synthetic GCMS data set with known fit coefficients.
+
+    Each compound has a random reference spectrum and elutes as a Gaussian
+    peak at a random retention time. A constant background spectrum and
+    Gaussian noise are added to the intensity data.
+
+    Parameters
+    ----------
+    nscans : int (default 2000)
+        The number of scans. The scans are 1/600 min apart.
+
+    ncpds : int (default 20)
+        The number of reference compounds.
+
+    nmasses : int (default 300)
+        The number of masses, starting at m/z 30.
+
+    peaks : int (default 15)
+        The number of peaks in each reference spectrum.
+
+    width : float (default 0.02)
+        The standard deviation of the chromatographic peaks in minutes.
+
+    noise : float (default 0.01)
+        The standard deviation of the noise relative to the largest peak.
+
+    seed : int (default 0)
+        The seed for the random number generator.
+
+    Returns
+    -------
+    (AiaFile, ndarray)
+        The data object, which already has reference information, and the
+        (scans x cpds) array of true coefficients (including the Background).
+    '''
+    rng = np.random.RandomState(seed)
+    times = np.arange(nscans)/600.
+    masses = np.arange(30, 30 + nmasses)
+
+    ref_array = np.zeros((ncpds + 1, nmasses))
+    for row in ref_array[:-1]:
+        idx = rng.choice(nmasses, size=min(peaks, nmasses), replace=False)
+        row[idx] = rng.uniform(0.05, 1., idx.size)
+        row /= row.max()
+    bkg = rng.uniform(0., 0.1, nmasses)
+    ref_array[-1] = bkg/bkg.max()
+
+    rts = rng.uniform(times[0] + 5*width, times[-1] - 5*width, ncpds)
+    heights = rng.uniform(1e3, 1e5, ncpds)
+    coef = np.empty((nscans, ncpds + 1))
+    coef[:, :-1] = heights*np.exp(-0.5*((times[:, np.newaxis] - rts)/width)**2)
+    coef[:, -1] = 1e2
+
+    intensity = coef.dot(ref_array)
+    intensity += rng.normal(0., noise*intensity.max(), intensity.shape)
+    np.maximum(intensity, 0., out=intensity)
+
+    data = gcf.AiaFile('synthetic', file_build=False)
+    data.times = times
+    data.masses = masses
+    data.intensity = intensity
+    data.tic = intensity.sum(axis=1)
+    data.ref_type = 'Synthetic'
+    data.ref_cpds = ['cpd{}'.format(num) for num in range(ncpds)]
+    data.ref_cpds.append('Background')
+    data.ref_array = ref_array
+    data.ref_meta = {}
+    for name, rt in zip(data.ref_cpds, rts):
+        data.ref_meta[name] = {'RT': rt, 'START': rt - 3*width,
+                'STOP': rt + 3*width}
+    data.ref_meta['Background'] = {'bkg_time': 0., 'bkg_idx': 0}
+    return data, coef
+
+def benchmark(datafiles, fits=None, reference='nnls', memory=True,
+        **kwargs):
+    '''Compare the speed, memory use, and accuracy of fitting objects.
+
+    Every fitting object is run on a copy of each data set, and the results
+    are compared with the fit from the reference fitting object.
+
+    Parameters
+    ----------
+    datafiles : GcmsFile object or list of those objects
+        The data sets, which must already have reference information. These
+        are not modified.
+
+    fits : list (default None)
+        The fitting objects to compare. These can be names from the
+        `gcmstools.fitting.fit_types` registry or Fit instances. If None, all
+        of the registered fitting objects are used.
+
+    reference : str or Fit instance (default 'nnls')
+        The fitting object that gives the reference coefficients.
+
+    memory : bool (default True)
+        Measure the peak memory use of each fit with `tracemalloc`. This runs
+        each fit a second time, because tracing slows down the fits.
+
+    kwargs :
+        Extra keyword arguments for the fitting objects that are created
+        from names.
+
+    Returns
+    -------
+    DataFrame
+        One row for each data set and fitting object with the columns:
+        "seconds", "scans_per_sec", "peak_mb" (NaN if not measured),
+        "coef_error" (the largest coefficient difference from the reference,
+        relative to the largest reference coefficient), and "resid_ratio" (the
+        total residual norm relative to the reference fit).
+    '''
+    if isinstance(datafiles, gcf.GcmsFile):
+        datafiles = [datafiles,]
+    if fits is None:
+        fits = sorted(gcfit.fit_types)
+    kwargs.setdefault('quiet', True)
+
+    reference = _make_fit(reference, kwargs)
+    fits = [_make_fit(fit, kwargs) for fit in fits]
+
+    rows = []
+    for data in datafiles:
+        ref_data = _run_fit(reference, data)[0]
+        ref_coef = np.asarray(ref_data.fit_coef, dtype=float)
+        ref_scale = max(np.abs(ref_coef).max(initial=0.),
+                np.finfo(float).tiny)
+        ref_resid = np.linalg.norm(ref_data.fit_resid)
+
+        for fit in fits:
+            fit_data, seconds = _run_fit(fit, data)
+            peak = np.nan
+            if memory:
+                tracemalloc.start()
+                try:
+                    _run_fit(fit, data)
+                    peak = tracemalloc.get_traced_memory()[1]/1024.**2
+                finally:
+                    tracemalloc.stop()
+
+            coef = np.asarray(fit_data.fit_coef, dtype=float)
+            error = np.abs(coef - ref_coef).max(initial=0.)/ref_scale
+            resid = np.linalg.norm(fit_data.fit_resid)
+            ratio = resid/ref_resid if ref_resid > 0 else np.nan
+            nscans = data.times.size
+            rows.append( (data.filename, fit.fit_type, seconds,
+                nscans/seconds if seconds > 0 else np.nan, peak, error,
+                ratio) )
+
+    columns = ('filename', 'fit', 'seconds', 'scans_per_sec', 'peak_mb',
+            'coef_error', 'resid_ratio')
+    return pd.DataFrame(rows, columns=columns)
+
+def benchmark_store(h5, filenames=None, **kwargs):
+    '''Run `benchmark` on data sets from a GcmsStore.
+
+    Parameters
+    ----------
+    h5 : GcmsStore
+        The storage file. The data sets must have reference information.
+
+    filenames : list (default None)
+        The names of the stored data sets. If None, all of the stored data
+        sets are used.
+
+    kwargs :
+        Keyword arguments for `benchmark`.
+
+    Returns
+    -------
+    DataFrame
+        The benchmark results (see `benchmark`).
+    '''
+    if filenames is None:
+        filenames = list(h5.files.filename)
+    datafiles = [h5.extract_gcms(name) for name in filenames]
+    return benchmark(datafiles, **kwargs)
+
+def _make_fit(fit, kwargs):
+    '''Create a fitting object from a registered name, if necessary.'''
+    if isinstance(fit, gcfit.Fit):
+        return fit
+    return gcfit.get_fit(fit, **kwargs)
+
+def _run_fit(fit, data):
+    '''Fit a copy of a data set, and return the copy and the fit time.'''
+    work = copy.copy(data)
+    # The integrals are added to the metadata, so it must be copied too
+    work.ref_meta = copy.deepcopy(data.ref_meta)
+    start = time.perf_counter()
+    fit(work)
+    return work, time.perf_counter() - start
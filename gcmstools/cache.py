@@ -0,0 +1,211 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+import numpy as np
+
+
+def default_cache_dir():
+    '''The default folder for cached data.
+
+    This is "gcmstools" in the folder given by the XDG_CACHE_HOME environment
+    variable, or "~/.cache/gcmstools" if that variable is not set.
+    '''
+    base = os.environ.get('XDG_CACHE_HOME',
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'gcmstools')
+
+def file_digest(fname, blocksize=2**20):
+    '''Calculate a content hash for a file.
+
+    Parameters
+    ----------
+    fname : str
+        The name of the file.
+
+    blocksize : int (default 1 MB)
+        The file is read in blocks of this many bytes.
+
+    Returns
+    -------
+    str
+        The hexadecimal SHA1 digest of the file contents.
+    '''
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha.update(block)
+            block = f.read(blocksize)
+    return sha.hexdigest()
+
+
+class ArrayCache(object):
+    '''A size-limited folder of cached Numpy arrays.
+
+    Each cache entry is a subfolder that contains one raw ".npy" file per
+    array and an "info.json" file with any extra (JSON-compatible)
+    information. The arrays are memory-mapped when they are loaded. When the
+    total size of the cache exceeds `max_size`, the least recently used
+    entries are removed.
+
+    Parameters
+    ----------
+    cache_dir : str (default None)
+        The cache folder, which is created if necessary. If None, the folder
+        from `default_cache_dir` is used.
+
+    max_size : int (default 4 GB)
+        The maximum size of the cache in bytes.
+    '''
+    def __init__(self, cache_dir=None, max_size=4*1024**3):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, *parts):
+        '''Create a cache key from a series of values.
+
+        The values are converted to strings, so they should have a stable
+        string representation.
+        '''
+        sha = hashlib.sha1()
+        for part in parts:
+            sha.update(repr(part).encode('utf-8'))
+        return sha.hexdigest()
+
+    def load(self, key):
+        '''Load a cache entry.
+
+        Parameters
+        ----------
+        key : str
+            The key for the cache entry.
+
+        Returns
+        -------
+        (dict, dict) or None
+            A dictionary of memory-mapped arrays and the info dictionary. If
+            there isn't a complete entry for this key, None is returned.
+        '''
+        entry = os.path.join(self.cache_dir, key)
+        info_file = os.path.join(entry, 'info.json')
+        try:
+            with open(info_file) as f:
+                info = json.load(f)
+            arrays = {}
+            for name in info['arrays']:
+                fname = os.path.join(entry, name + '.npy')
+                arrays[name] = np.load(fname, mmap_mode='r')
+            # Mark this entry as recently used
+            os.utime(info_file, None)
+        except (IOError, OSError, ValueError, KeyError):
+            # Missing, incomplete, or just removed by another process
+            return None
+        return arrays, info['info']
+
+    def save(self, key, arrays, info=None):
+        '''Save a new cache entry and then trim the cache size.
+
+        Parameters
+        ----------
+        key : str
+            The key for the cache entry.
+
+        arrays : dict
+            A dictionary of Numpy arrays to store.
+
+        info : dict (default None)
+            Extra JSON-compatible information to store with the arrays.
+        '''
+        entry = os.path.join(self.cache_dir, key)
+        # Write to a temporary folder first, so that a partially written entry
+        # is never loaded
+        temp = '{}.tmp{}_{}'.format(entry, os.getpid(), 
+                threading.current_thread().ident)
+        if os.path.isdir(temp):
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+
+        for name, arr in arrays.items():
+            np.save(os.path.join(temp, name + '.npy'),
+                    np.ascontiguousarray(arr))
+        with open(os.path.join(temp, 'info.json'), 'w') as f:
+            json.dump({'arrays': sorted(arrays), 'info': info}, f)
+
+        try:
+            os.rename(temp, entry)
+        except OSError:
+            # Another process already saved this entry
+            shutil.rmtree(temp, ignore_errors=True)
+
+        self.evict()
+
+    def update_info(self, key, info):
+        '''Replace the info dictionary of a cache entry.
+
+        The arrays are not changed. Nothing is done if the entry doesn't
+        exist.
+
+        Parameters
+        ----------
+        key : str
+            The key for the cache entry.
+
+        info : dict
+            The new JSON-compatible information for the entry.
+        '''
+        entry = os.path.join(self.cache_dir, key)
+        info_file = os.path.join(entry, 'info.json')
+        temp = '{}.tmp{}_{}'.format(info_file, os.getpid(), 
+                threading.current_thread().ident)
+        try:
+            with open(info_file) as f:
+                arrays = json.load(f)['arrays']
+            with open(temp, 'w') as f:
+                json.dump({'arrays': arrays, 'info': info}, f)
+            os.replace(temp, info_file)
+        except (IOError, OSError, ValueError, KeyError):
+            # The entry was removed; the cache is only an optimization
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def remove(self, key):
+        '''Remove a cache entry, if it exists.'''
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+    def evict(self, ):
+        '''Remove least recently used entries until the cache fits.'''
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            info_file = os.path.join(entry, 'info.json')
+            if not os.path.isfile(info_file):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f))
+                        for f in os.listdir(entry))
+                used = os.path.getmtime(info_file)
+            except OSError:
+                continue
+            entries.append((used, size, entry))
+            total += size
+
+        for used, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self, ):
+        '''Remove all of the cache entries.'''
+        for key in os.listdir(self.cache_dir):
+            shutil.rmtree(os.path.join(self.cache_dir, key),
+                    ignore_errors=True)
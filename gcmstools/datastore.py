@@ -1,10 +1,13 @@
 import os
+import pickle
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sps
 import tables as tb
 
 import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
 
 class GcmsStore(pd.HDFStore):
     '''A GCMS data storage class using HDF files.
@@ -23,7 +26,15 @@ class GcmsStore(pd.HDFStore):
     -----
     This is a subclass of Pandas' HDFStore class. See the documentation for
     that object for more information about addition parameters and methods.
+
+    The reference data that is shared by many files (see
+    `gcmstools.reference.split_ref`) is only stored once, in the "/refs"
+    group, under its content hash. Each file only stores the hash and its
+    own Background spectrum and metadata.
     '''
+    # The reference attributes that are split into shared and per-file parts
+    _ref_attrs = ('ref_array', 'ref_cpds', 'ref_meta', 'ref_hashes')
+
     def __init__(self, hdfname, quiet=False, **kwargs):
         if not 'mode' in kwargs:
             kwargs['mode'] = 'a'
@@ -43,6 +54,9 @@ class GcmsStore(pd.HDFStore):
             self._handle.create_group('/', 'data', filters=self._filters)
         self.data = self._handle.root.data
 
+        # Shared reference data that has been read, keyed by content hash
+        self._refs = {}
+
     def append_gcms(self, datafiles):
         '''Append a series of GCMS files into the HDF container.
         
@@ -60,10 +74,12 @@ class GcmsStore(pd.HDFStore):
             datafiles = [datafiles,]
         
         names = []
+        replaced = False
         for data in datafiles:
             filename = data.filename
             name = self._gcms_name_fix(filename)
             names.append((name, filename))
+            replaced = replaced or hasattr(self.data, name)
             self._append_single_gcms(name, data)
         temp_df = pd.DataFrame(names, columns=self._files_df_columns)
 
@@ -73,9 +89,13 @@ class GcmsStore(pd.HDFStore):
             self.put('files', pd.merge(temp_df, self.files,
                     how='outer'))
 
+        # Rewritten files can leave shared reference data that is not used
+        if replaced:
+            self._remove_unused_refs()
+
         self.flush()
 
-    def extract_gcms(self, filename):
+    def extract_gcms(self, filename, lazy=False):
         '''Extract a data set from the HDF storage file.
         
         Paramters
@@ -84,6 +104,12 @@ class GcmsStore(pd.HDFStore):
             The full or simplified file name to be extracted from the HDF
             storage file. 
 
+        lazy : bool (default False)
+            Do not read the intensity data into memory. Instead, the intensity
+            attribute will read scans from the HDF file as they are needed,
+            and the `xic` method reads ion traces directly from the file.
+            This only works while the HDF file is open.
+
         Returns
         -------
         GcmsFile Object
@@ -105,20 +131,83 @@ class GcmsStore(pd.HDFStore):
             setattr(gcms, key, val)
         # Add all the Numpy arrays back
         for child in group:
-            setattr(gcms, child.name, child[:])
+            # Sparse matrices are stored as subgroups
+            if isinstance(child, tb.Group):
+                setattr(gcms, child._v_name, self._extract_sparse(child))
+            elif lazy and child.name == 'intensity':
+                gcms.intensity = self._lazy_carray(child)
+                gcms._h5intensity = child
+            else:
+                setattr(gcms, child.name, child[:])
+
+        # Rebuild the full reference data from the shared part
+        if hasattr(gcms, 'ref_key'):
+            shared = self._extract_ref(gcms.ref_key)
+            # The info dictionary is cached by PyTables, so it is not changed
+            local = dict(gcms.ref_local)
+            local['ref_array'] = getattr(gcms, 'ref_bkg', 
+                    shared['ref_array'][:0])
+            key = gcms.ref_key
+            for attr in ('ref_key', 'ref_local', 'ref_bkg'):
+                if hasattr(gcms, attr):
+                    delattr(gcms, attr)
+            gcr.join_ref(gcms, shared, local, key)
 
         gcms.shortname = name
     
         return gcms
     
+    def fit_quality(self, filename=None):
+        '''Read the fit quality metrics without the intensity data.
+
+        Parameters
+        ----------
+        filename : str (default None)
+            The full or simplified name of a stored file. If this is given,
+            the metrics for every scan of that file are returned. Otherwise,
+            a summary of the metrics for each stored file is returned.
+
+        Returns
+        -------
+        DataFrame
+            For a single file, the "fit_resid", "fit_relresid", and
+            "fit_ticfrac" values for every scan, indexed by time. For the
+            summary, the median and maximum relative residual, the median
+            explained TIC fraction, and the number of scans for each file,
+            indexed by file name. Files without the metrics are left out.
+        '''
+        metrics = ('fit_resid', 'fit_relresid', 'fit_ticfrac')
+        if filename is not None:
+            group = getattr(self.data, self._gcms_name_fix(filename))
+            data = dict((key, group._f_get_child(key)[:]) for key in metrics)
+            times = pd.Index(group.times[:], name='times')
+            return pd.DataFrame(data, index=times, columns=metrics)
+
+        rows = []
+        names = []
+        for group in self.data._f_iter_nodes('Group'):
+            if not all(key in group for key in metrics):
+                continue
+            relresid = group.fit_relresid[:]
+            ticfrac = group.fit_ticfrac[:]
+            names.append( group._v_name )
+            rows.append( (np.median(relresid), relresid.max(initial=0.),
+                    np.median(ticfrac), relresid.size) )
+        columns = ('relresid_median', 'relresid_max', 'ticfrac_median', 
+                'scans')
+        return pd.DataFrame(rows, index=pd.Index(names, name='name'), 
+                columns=columns)
+
     def compress(self, ):
         '''Close and compress the HDF file after creation.
         
         Notes
         -----
         This is very important if lots of files have been appended to an
-        existing HDF file.
+        existing HDF file. Shared reference data that is no longer used by
+        any file is removed first.
         '''
+        self._remove_unused_refs()
         # Close the hdf file
         self.close()
         # Make a copy of the file.
@@ -152,19 +241,189 @@ class GcmsStore(pd.HDFStore):
         group = self._handle.create_group('/data', name, 
                 filters=self._filters)
 
+        # The shared reference data is stored separately
+        attrs, ref = self._gcms_attrs(gcmsobj)
+        if ref is not None:
+            self._append_ref(*ref)
+
         # Run through the items in the GCMS file
         # Create an info dict for recreating object
         gcmsinfo = {}
-        for key, val in gcmsobj.__dict__.items():
+        for key, val in attrs.items():
+            # Private attributes (open files, caches, etc.) are not stored
+            if key.startswith('_'):
+                continue
+            # Lazy intensity data must be fully built to be stored
+            if isinstance(val, gcf.LazyIntensity):
+                val = np.asarray(val)
             # If they are Numpy arrays, add CArray
             if isinstance(val, np.ndarray):
                 self._handle.create_carray(group, key, obj=val,)
+            # Sparse matrices are stored as a group of CSR component arrays
+            elif sps.issparse(val):
+                self._append_sparse(group, key, val)
             # Or else, set a group attribute with the value
             # This is used to check if any changes have been made
             else:
                 gcmsinfo[key] = val
         group._v_attrs['gcmsinfo'] = gcmsinfo
 
+    def _gcms_attrs(self, gcmsobj):
+        '''Get the attributes of a GCMS file object that are stored.
+
+        The reference data is split with `gcmstools.reference.split_ref`.
+        The shared part is replaced by its content hash ("ref_key"), and the
+        per-file part is kept as "ref_bkg" (the Background spectrum, if there
+        is one) and "ref_local" (everything else).
+
+        Returns
+        -------
+        (dict, tuple)
+            The attributes to store and a (hash, shared data) tuple, or None
+            if the object does not have reference data.
+        '''
+        attrs = dict(gcmsobj.__dict__)
+        if not all(attr in attrs for attr in self._ref_attrs[:3]):
+            return attrs, None
+
+        key, shared, local = gcr.split_ref(gcmsobj)
+        for attr in self._ref_attrs:
+            attrs.pop(attr, None)
+        attrs['ref_key'] = key
+        bkg = local.pop('ref_array')
+        if bkg.size > 0:
+            attrs['ref_bkg'] = bkg
+        attrs['ref_local'] = local
+        return attrs, (key, shared)
+
+    def _append_ref(self, key, shared):
+        '''Store shared reference data, unless it is already stored.
+
+        Parameters
+        ----------
+        key : str
+            The content hash of the shared reference data.
+
+        shared : dict
+            The shared reference data from `gcmstools.reference.split_ref`.
+        '''
+        if not hasattr(self._handle.root, 'refs'):
+            self._handle.create_group('/', 'refs', filters=self._filters)
+        refs = self._handle.root.refs
+        name = 'ref_' + key
+        if name in refs:
+            return
+
+        group = self._handle.create_group(refs, name, filters=self._filters)
+        ref_array = shared['ref_array']
+        # The reference array of a large library is sparse
+        sparse = sps.issparse(ref_array)
+        if ref_array.size > 0:
+            if sparse:
+                self._append_sparse(group, 'ref_array', ref_array)
+            else:
+                self._handle.create_carray(group, 'ref_array', obj=ref_array)
+        group._v_attrs['shape'] = ref_array.shape
+        group._v_attrs['dtype'] = ref_array.dtype.str
+        group._v_attrs['sparse'] = sparse
+        # The metadata of a large library is too big for an HDF attribute, so
+        # it is stored as a pickled byte array
+        info = dict((attr, shared[attr]) for attr in self._ref_attrs[1:])
+        info = np.frombuffer(pickle.dumps(info, protocol=2), dtype=np.uint8)
+        self._handle.create_carray(group, 'info', obj=info)
+
+    def _extract_ref(self, key):
+        '''Read shared reference data stored by `_append_ref`.
+
+        The data is kept for other files with the same reference data, so it
+        should not be modified.
+        '''
+        if key not in self._refs:
+            group = getattr(self._handle.root.refs, 'ref_' + key)
+            shared = pickle.loads(group.info[:].tobytes())
+            sparse = getattr(group._v_attrs, 'sparse', False)
+            if 'ref_array' in group:
+                if sparse:
+                    ref_array = self._extract_sparse(group.ref_array)
+                    shared['ref_array'] = ref_array.astype(
+                            group._v_attrs.dtype, copy=False)
+                else:
+                    shared['ref_array'] = group.ref_array[:]
+            elif sparse:
+                shared['ref_array'] = sps.csr_matrix(group._v_attrs.shape,
+                        dtype=group._v_attrs.dtype)
+            else:
+                shared['ref_array'] = np.zeros(group._v_attrs.shape, 
+                        dtype=group._v_attrs.dtype)
+            self._refs[key] = shared
+        return self._refs[key]
+
+    def _remove_unused_refs(self, ):
+        '''Remove the shared reference data that no stored file uses.'''
+        if not hasattr(self._handle.root, 'refs'):
+            return
+        used = set()
+        for group in self.data._f_iter_nodes('Group'):
+            gdict = getattr(group._v_attrs, 'gcmsinfo', {})
+            if 'ref_key' in gdict:
+                used.add('ref_' + gdict['ref_key'])
+        for group in list(self._handle.root.refs._f_iter_nodes('Group')):
+            if group._v_name not in used:
+                self._refs.pop(group._v_name[len('ref_'):], None)
+                group._f_remove(recursive=True)
+
+    def _append_sparse(self, group, key, matrix):
+        '''Store a sparse matrix as a group of CSR arrays.
+
+        Parameters
+        ----------
+        group : PyTables Group
+            The group for the GCMS file.
+
+        key : str
+            The attribute name of the sparse matrix.
+
+        matrix : Scipy sparse matrix
+            The matrix to store. This is converted to CSR format if necessary.
+        '''
+        matrix = sps.csr_matrix(matrix)
+        spgroup = self._handle.create_group(group, key, filters=self._filters)
+        for comp in ('data', 'indices', 'indptr'):
+            self._handle.create_carray(spgroup, comp, 
+                    obj=getattr(matrix, comp))
+        spgroup._v_attrs['shape'] = matrix.shape
+
+    def _extract_sparse(self, spgroup):
+        '''Rebuild a CSR matrix from a group created by `_append_sparse`.
+
+        Parameters
+        ----------
+        spgroup : PyTables Group
+            The group containing the CSR component arrays.
+
+        Returns
+        -------
+        Scipy CSR matrix
+        '''
+        return sps.csr_matrix((spgroup.data[:], spgroup.indices[:],
+                spgroup.indptr[:]), shape=tuple(spgroup._v_attrs.shape))
+
+    def _lazy_carray(self, carray):
+        '''Wrap a 2D CArray so that rows are only read when accessed.
+
+        Parameters
+        ----------
+        carray : PyTables CArray
+            The array to wrap.
+
+        Returns
+        -------
+        LazyIntensity
+        '''
+        def reader(first, last):
+            return carray[first:last]
+        return gcf.LazyIntensity(reader, carray.shape, dtype=carray.dtype)
+
     def _check_gcms_data(self, name, obj):
         '''Check for equivalence between GCMS file and stored data.
         
@@ -184,10 +443,11 @@ class GcmsStore(pd.HDFStore):
         '''
         group = getattr(self.data, name)
         groupd = group._v_attrs.gcmsinfo
-        d = obj.__dict__
+        d = self._gcms_attrs(obj)[0]
         for key, val in d.items():
-            # Ignore the arrays for now
-            if isinstance(val, np.ndarray):
+            # Ignore the arrays and private attributes for now
+            if key.startswith('_') or sps.issparse(val) or \
+                    isinstance(val, (np.ndarray, gcf.LazyIntensity)):
                 continue
             # Check the other values agains the group attributes
             # If there is a mismatch, return True
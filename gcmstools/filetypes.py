@@ -1,9 +1,15 @@
+import os
+import collections
 import itertools as it
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.io.netcdf as cdf
+import scipy.sparse as sps
 import pandas as pd
 
+from gcmstools.cache import ArrayCache, file_digest
+
 
 class GcmsFile(object):
     '''Base class for all GCMS files.
@@ -12,110 +18,746 @@ class GcmsFile(object):
     Subclasses must define a _ref_file method that extracts the information
     from the reference file.
     '''
-    def __init__(self, fname, file_build=True, quiet=False, **kwargs):
+    def __init__(self, fname, file_build=True, quiet=False, dtype=float,
+            **kwargs):
         '''
         Arguments
         ---------
         * fname: string - The name of the GCMS data file.
+        * dtype: Numpy dtype (default float) - The data type of the intensity
+          array. Use np.float32 to halve the memory usage.
         '''
         self.filename = fname
+        self._dtype = np.dtype(dtype)
+        self._index_cache = {}
         if file_build == True:
             if not quiet:
                 print("Building: {}".format(fname))
             self._file_proc()
 
     def index(self, array, *vals, **kwargs):
+        '''Find the indices of the array values closest to the given values.
+
+        For sorted 1D arrays, such as the times and masses, the indices are
+        found with a binary search. Each value can also be an array of values,
+        so many (start, stop) pairs can be found with a single call.
+
+        Arguments
+        ---------
+        * array: ndarray - The array to search.
+        * vals: float or ndarray - One or more values to find in the array.
+        * axis: int (optional) - The axis of the array to search. This is
+          only used for multidimensional arrays.
+        '''
         if 'axis' in kwargs:
             axis = kwargs['axis']
         else: 
             axis = None
 
         indices = []
-        for val in vals:
-            idx = np.abs(val - array).argmin(axis=axis)
-            indices.append(idx)
+        strict = self._sorted_axis(array) if axis is None else None
+        if strict is not None:
+            for val in vals:
+                indices.append( self._sorted_index(array, val, strict) )
+        else:
+            for val in vals:
+                # Each value (if val is an array) is compared with the whole
+                # array, so the array axes come after the value axes
+                diff = np.abs(np.subtract.outer(val, array))
+                if axis is None:
+                    shape = np.shape(val) + (-1,)
+                    idx = diff.reshape(shape).argmin(axis=-1)
+                else:
+                    if axis >= 0:
+                        axis_val = axis + np.ndim(val)
+                    else:
+                        axis_val = axis
+                    idx = diff.argmin(axis=axis_val)
+                indices.append(idx)
 
         if len(indices) == 1:
             return indices[0]
         else:
             return np.array(indices, dtype=int)
 
+    def _sorted_axis(self, array):
+        '''Check (and cache) whether an array is a sorted 1D axis.
+
+        Returns None for arrays that are not sorted 1D axes. Otherwise, this
+        returns True if the array values are strictly increasing.
+        '''
+        if not hasattr(self, '_index_cache'):
+            self._index_cache = {}
+
+        # The array is kept in the cache, so its id can't be reused
+        cached = self._index_cache.get(id(array))
+        if cached is not None and cached[0] is array:
+            return cached[1]
+
+        strict = None
+        if isinstance(array, np.ndarray) and array.ndim == 1 and \
+                array.size > 0:
+            diffs = np.diff(array)
+            if np.all(diffs >= 0):
+                strict = bool(np.all(diffs > 0))
+        # Only a few axes (times, masses) are ever searched repeatedly, so
+        # don't let other arrays pile up in the cache
+        if len(self._index_cache) >= 8:
+            self._index_cache.clear()
+        self._index_cache[id(array)] = (array, strict)
+        return strict
+
+    def _sorted_index(self, array, val, strict=True):
+        '''Find the indices of the closest values in a sorted 1D array.
+
+        Ties go to the lower index, which is the same as `argmin`.
+        '''
+        last = array.size - 1
+        if np.ndim(val) == 0 and strict:
+            # Fast path for single values
+            pos = min(max(int(array.searchsorted(val)), 1), last) \
+                    if last > 0 else 0
+            if pos > 0 and val - array[pos - 1] <= array[pos] - val:
+                pos -= 1
+            return pos
+
+        if last == 0:
+            return np.zeros(np.shape(val), dtype=int)[()]
+        pos = np.searchsorted(array, val).clip(1, last)
+        left, right = pos - 1, pos
+        if not strict:
+            # Repeated values resolve to their first occurrence
+            left = np.searchsorted(array, array[left])
+            right = np.searchsorted(array, array[right])
+        idx = np.where(val - array[left] <= array[right] - val, left, right)
+        return idx[()]
+
+    def intensity_rows(self, idx=slice(None)):
+        '''Return dense MS intensity rows.
+
+        Arguments
+        ---------
+        * idx: int, slice, or index/boolean array - The scans (rows) to
+          select. By default, all scans are returned.
+        '''
+        rows = self.intensity[idx]
+        if sps.issparse(rows):
+            rows = rows.toarray()
+            if np.isscalar(idx):
+                rows = rows[0]
+        return np.asarray(rows)
+
+    def xic(self, masses, start=None, stop=None, cache=None):
+        '''Extract the ion chromatograms for one or more m/z values.
+
+        The traces are taken from a column-major copy of the intensity data,
+        which is built on first use and cached. For data extracted lazily
+        from a GcmsStore, the traces are read directly from the HDF file.
+
+        Arguments
+        ---------
+        * masses: float or sequence of floats - The m/z values to extract.
+          The closest masses in the `masses` array are used.
+        * start: float (default None) - The starting elution time. If None,
+          the traces start at the first scan.
+        * stop: float (default None) - The ending elution time (inclusive).
+          If None, the traces end at the last scan.
+        * cache: bool (default None) - Build and cache the column-major copy
+          of the intensity data. If None, this is done unless the intensity
+          data is lazy, in which case only the requested scans are decoded.
+
+        Returns
+        -------
+        * ndarray - A 2D array with one trace (row) per requested mass.
+        '''
+        massidx = np.atleast_1d(self.index(self.masses, np.asarray(masses)))
+        rows = self._time_rows(start, stop)
+
+        h5inten = getattr(self, '_h5intensity', None)
+        if h5inten is not None and h5inten._v_file.isopen:
+            # PyTables needs the column selection in increasing order
+            uniq, inverse = np.unique(massidx, return_inverse=True)
+            return np.ascontiguousarray(h5inten[rows, uniq][:, inverse].T)
+
+        if cache is None:
+            cache = not isinstance(self.intensity, LazyIntensity)
+        if not cache:
+            return np.ascontiguousarray(
+                    self.intensity_rows(rows)[:, massidx].T)
+
+        columns = self._intensity_columns()
+        if sps.issparse(columns):
+            return columns[:, massidx][rows].toarray().T
+        return np.ascontiguousarray(columns[rows, massidx].T)
+
+    def _intensity_columns(self, ):
+        '''Return a cached, column-major copy of the intensity data.
+
+        Sparse data is converted to CSC format, and dense data is converted
+        to a Fortran-ordered array.
+        '''
+        cached = getattr(self, '_xic_cache', None)
+        if cached is None or cached[0] is not self.intensity:
+            if sps.issparse(self.intensity):
+                columns = self.intensity.tocsc()
+            else:
+                columns = np.asfortranarray(self.intensity_rows())
+            self._xic_cache = (self.intensity, columns)
+        return self._xic_cache[1]
+
+    def iter_scans(self, chunk=256):
+        '''Iterate over the MS data in blocks of scans.
+
+        Only one block of dense intensity rows is held in memory at a time.
+        For lazy files, the blocks are decoded straight from the data file.
+
+        Arguments
+        ---------
+        * chunk: int (default 256) - The number of scans in each block.
+
+        Yields
+        ------
+        * (times, intensity) - The times for this block of scans and the
+          corresponding 2D array of dense intensity rows.
+        '''
+        for first in range(0, self.times.size, chunk):
+            block = slice(first, first + chunk)
+            yield self.times[block], self.intensity_rows(block)
+
+    def intensity_window(self, start, stop):
+        '''Return the MS intensity rows between two elution times.
+
+        For lazy files, only the scans in this window are decoded.
+
+        Arguments
+        ---------
+        * start: float - The starting elution time.
+        * stop: float - The ending elution time (inclusive).
+        '''
+        startidx, stopidx = self.index(self.times, start, stop)
+        return self.intensity_rows(slice(startidx, stopidx + 1))
+
+    def fit_spectra(self, start=None, stop=None, cpds=None):
+        '''Reconstruct the fitted MS spectra of the reference compounds.
+
+        The spectra are only calculated for the scans in the requested time
+        window, so this is suitable for large files.
+
+        Arguments
+        ---------
+        * start: float (default None) - The starting elution time. If None,
+          the spectra start at the first scan.
+        * stop: float (default None) - The ending elution time (inclusive).
+          If None, the spectra end at the last scan.
+        * cpds: str or list of str (default None) - The name(s) of the
+          reference compounds. If None, all of the compounds are used.
+
+        Returns
+        -------
+        * ndarray - A 3D array of the spectra with the shape (# of scans, # of
+          compounds, # of masses). 
+        '''
+        self._check_fit()
+        rows = self._time_rows(start, stop)
+        cpdidx = slice(None)
+        if cpds is not None:
+            names = [cpds] if isinstance(cpds, str) else cpds
+            cpdidx = [self.ref_cpds.index(name) for name in names]
+        coef = self.fit_coef[rows][:, cpdidx]
+        if sps.issparse(self.ref_array):
+            ref = self.ref_array[cpdidx].toarray()
+        else:
+            ref = np.asarray(self.ref_array)[cpdidx]
+        return coef[:, :, np.newaxis]*ref
+
+    def fit_residuals(self, start=None, stop=None):
+        '''Calculate the fit residuals (data - fit) for a time window.
+
+        Arguments
+        ---------
+        * start: float (default None) - The starting elution time. If None,
+          the residuals start at the first scan.
+        * stop: float (default None) - The ending elution time (inclusive).
+          If None, the residuals end at the last scan.
+
+        Returns
+        -------
+        * ndarray - A 2D array of the residuals with the shape (# of scans,
+          # of masses).
+        '''
+        self._check_fit()
+        rows = self._time_rows(start, stop)
+        if sps.issparse(self.ref_array):
+            fit = self.ref_array.T.dot(self.fit_coef[rows].T).T
+        else:
+            fit = self.fit_coef[rows].dot(np.asarray(self.ref_array))
+        return self.intensity_rows(rows) - fit
+
+    def _check_fit(self, ):
+        if not hasattr(self, 'fit_coef'):
+            error = "The datafile {} does not have fit data."
+            raise ValueError(error.format(self.filename))
+
+    def _time_rows(self, start=None, stop=None):
+        '''Return a slice of the scans between two elution times.'''
+        startidx = 0 if start is None else self.index(self.times, start)
+        stopidx = self.times.size - 1 if stop is None else \
+                self.index(self.times, stop)
+        return slice(startidx, stopidx + 1)
+
+
+class LazyIntensity(object):
+    '''A read-only, array-like proxy for an intensity matrix.
+
+    Rows are decoded on demand by the `decoder` function, which takes a
+    starting and ending scan number and returns a dense block of rows. Only
+    row selections are decoded; any column selection is applied afterward.
+    '''
+    def __init__(self, decoder, shape, dtype=float, chunk=256):
+        self._decoder = decoder
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.ndim = 2
+        self._chunk = chunk
+
+    def __len__(self, ):
+        return self.shape[0]
+
+    def __iter__(self, ):
+        for first in range(0, self.shape[0], self._chunk):
+            last = min(first + self._chunk, self.shape[0])
+            for row in self._decoder(first, last):
+                yield row
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self._decoder(0, self.shape[0])
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def __reduce__(self, ):
+        # The decoder is not picklable, so pickle as a dense array
+        return (np.array, (np.asarray(self),))
+
+    def __getitem__(self, key):
+        cols = None
+        if isinstance(key, tuple):
+            key, cols = key[0], key[1:]
+
+        nscans = self.shape[0]
+        if isinstance(key, slice):
+            first, last, step = key.indices(nscans)
+            if step == 1:
+                rows = self._decoder(first, max(first, last))
+            else:
+                rows = self._rows(np.arange(first, last, step))
+        elif np.ndim(key) == 0:
+            idx = int(key)
+            if idx < 0:
+                idx += nscans
+            if not 0 <= idx < nscans:
+                raise IndexError("Scan index {} out of range.".format(key))
+            rows = self._decoder(idx, idx + 1)[0]
+        else:
+            key = np.asarray(key)
+            if key.dtype == bool:
+                key = np.flatnonzero(key)
+            rows = self._rows(key)
+
+        if cols:
+            rows = rows[(Ellipsis,) + cols]
+        return rows
+
+    def _rows(self, idxs):
+        '''Decode an arbitrary set of scans.'''
+        idxs = np.where(idxs < 0, idxs + self.shape[0], idxs)
+        if idxs.size == 0:
+            return np.zeros((0, self.shape[1]), dtype=self.dtype)
+        # Decode the smallest contiguous block that contains all the scans
+        first, last = idxs.min(), idxs.max() + 1
+        return self._decoder(first, last)[idxs - first]
+
+
+class MassBinner(object):
+    '''Bin raw (m/z, intensity) scan data onto a regular mass axis.
+
+    All of the scans are binned at once. Each data point is assigned a scan
+    number from the point counts and a mass bin from its m/z value. The bins
+    are centered on the values `offset + n*width`, and the data points that
+    fall into the same scan/mass bin are combined with a reduction.
+
+    This object can be subclassed to use different binning rules. The
+    `bin_index` method assigns the bin numbers, and `reduce_bins` combines
+    the intensities in each bin.
+
+    Parameters
+    ----------
+    width : float (default 1.)
+        The width of each mass bin.
+
+    offset : float (default 0.)
+        The center of the mass bins is shifted by this value, e.g. a mass
+        defect of 0.3 m/z.
+
+    reduce : str (default 'mean')
+        The reduction for data points in the same bin: 'mean', 'sum', or
+        'max'.
+
+    half : str (default None)
+        The bin for values exactly halfway between two bins: 'up' (the upper
+        bin) or 'even' (the even bin, as `np.round`). If None, unit bins
+        without an offset use 'even', as the original AIA decoder did, so
+        that its output is unchanged; other bins use 'up'.
+    '''
+    reductions = ('mean', 'sum', 'max')
+
+    def __init__(self, width=1., offset=0., reduce='mean', half=None):
+        if reduce not in self.reductions:
+            error = "Unknown reduction '{}'. Use one of: {}"
+            raise ValueError(error.format(reduce, ', '.join(self.reductions)))
+        self.width = float(width)
+        self.offset = float(offset)
+        self.reduce = reduce
+        if half is None:
+            half = 'even' if width == 1. and offset == 0. else 'up'
+        if half not in ('up', 'even'):
+            raise ValueError("The half option must be 'up' or 'even'.")
+        self.half = half
+
+    def __repr__(self, ):
+        return "{}(width={!r}, offset={!r}, reduce={!r}, half={!r})".format(
+                self.__class__.__name__, self.width, self.offset, self.reduce,
+                self.half)
+
+    def bin_index(self, mass):
+        '''Find the bin number for m/z values.
+
+        Values exactly halfway between two bins go to the bin set by the
+        `half` option. The bins don't depend on the reduction.
+        '''
+        if self.half == 'even':
+            mass = (np.asarray(mass) - self.offset)/self.width
+            bins = np.round(mass)
+        else:
+            # Float32 m/z values aren't precise enough at the bin edges.
+            # np.round would send alternate halves to alternate bins.
+            mass = np.asarray(mass, dtype=float)
+            bins = np.floor((mass - self.offset)/self.width + 0.5)
+        return bins.astype(int)
+
+    def bin_masses(self, first, last):
+        '''Generate the mass axis for a range of bin numbers (inclusive).
+
+        Integer mass axes are returned for integer bin widths and offsets.
+        '''
+        bins = np.arange(first, last + 1)
+        if self.width.is_integer() and self.offset.is_integer():
+            return bins*int(self.width) + int(self.offset)
+        return np.round(self.offset + bins*self.width, 6)
+
+    def reduce_bins(self, idx, inten, size):
+        '''Combine the intensities that fall into the same bins.
+
+        Parameters
+        ----------
+        idx : ndarray
+            The (integer) bin for every intensity value.
+
+        inten : ndarray
+            The intensity values.
+
+        size : int
+            The total number of bins.
+
+        Returns
+        -------
+        ndarray
+            The reduced intensity for each bin. Empty bins are zero.
+        '''
+        if self.reduce == 'max':
+            out = np.full(size, -np.inf)
+            np.maximum.at(out, idx, inten)
+            out[np.isneginf(out)] = 0.
+            return out
+
+        # Empty input gives an integer array, so make sure this is float
+        out = np.asarray(np.bincount(idx, weights=inten, minlength=size),
+                dtype=float)
+        if self.reduce == 'mean':
+            # Empty bins have a count of zero, so divide only where there were
+            # data points
+            counts = np.bincount(idx, minlength=size)
+            mask = counts > 0
+            out[mask] /= counts[mask]
+        return out
+
+    def __call__(self, points, mass, inten, first_bin, nbins, sparse=False,
+            dtype=float):
+        '''Bin the raw scan data into a (scans x masses) intensity array.
+
+        Parameters
+        ----------
+        points : ndarray
+            The number of data points in each scan.
+
+        mass, inten : ndarray
+            The m/z and intensity values for all of the scans.
+
+        first_bin : int
+            The bin number of the first column of the output.
+
+        nbins : int
+            The number of mass bins (columns) in the output.
+
+        sparse : bool (default False)
+            Return a Scipy CSR sparse matrix rather than a dense array.
+
+        dtype : Numpy dtype (default float)
+            The data type of the output.
+        '''
+        nscans = points.size
+        npoints = points.sum()
+
+        scan_ids = np.repeat(np.arange(nscans), points)
+        mass_idx = self.bin_index( mass[:npoints] ) - first_bin
+        flat_idx = scan_ids*nbins + mass_idx
+        inten = inten[:npoints]
+
+        if sparse:
+            # Only keep the occupied bins, which are sorted by scan and mass
+            bins, inverse = np.unique(flat_idx, return_inverse=True)
+            values = self.reduce_bins(inverse, inten, bins.size)
+            indptr = np.searchsorted(bins, np.arange(nscans + 1)*nbins)
+            return sps.csr_matrix((values.astype(dtype), bins % nbins, 
+                    indptr), shape=(nscans, nbins))
+
+        values = self.reduce_bins(flat_idx, inten, nscans*nbins)
+        return values.astype(dtype).reshape(nscans, nbins)
+
 
 class AiaFile(GcmsFile):
     '''AIA GCMS File type.
 
     This subclass reads GCMS data from an AIA (CDF) file type.
+
+    If the keyword argument `lazy` is True, the CDF file is kept memory-mapped
+    and the `intensity` attribute is a LazyIntensity proxy. Intensity rows
+    are only built for the scans that are accessed.
+
+    If the keyword argument `sparse` is True, the `intensity` attribute is a
+    Scipy CSR sparse matrix with one row per scan. This can save a lot of
+    memory for wide mass ranges, where most intensity values are zero.
+
+    The keyword argument `cache` turns on a persistent cache of the decoded
+    data arrays. This can be True (use the default cache folder), the name of
+    a cache folder, or an ArrayCache instance. The cache entries are keyed by
+    the file path and the decoding options, and they also hold the size,
+    modification time, and content hash of the file. Files that haven't
+    changed are loaded (memory-mapped) without being decoded or read again.
+    The file is only hashed if its size or modification time have changed,
+    and the entry is reused if the contents are the same. The cache is not
+    used for lazy files.
+
+    The keyword argument `binner` sets the MassBinner instance that is used to
+    bin the raw m/z values. By default, the masses are rounded to integer
+    values, and repeated values in a scan are averaged.
     '''
     def __init__(self, *args, **kwargs):
         self.filetype = 'AiaFile'
+        self._lazy = kwargs.pop('lazy', False)
+        self._sparse = kwargs.pop('sparse', False)
+        if self._lazy and self._sparse:
+            raise ValueError("The lazy and sparse options can't be combined.")
+
+        cache = kwargs.pop('cache', None)
+        if cache is True:
+            cache = ArrayCache()
+        elif isinstance(cache, str):
+            cache = ArrayCache(cache)
+        self._cache = cache or None
+
+        self._binner = kwargs.pop('binner', None) or MassBinner()
+
         super(AiaFile, self).__init__(*args, **kwargs)
 
-    def _groupkey(self, x):
-        return x[0]
+    def __getstate__(self, ):
+        # The memory-mapped file can't be pickled, so lazy files are pickled
+        # as regular files. Cached copies of the data are not pickled.
+        state = self.__dict__.copy()
+        state.pop('_xic_cache', None)
+        state.pop('_h5intensity', None)
+        state.pop('_ref_shared', None)
+        if '_cdf' in state:
+            state.pop('_cdf')
+            state['intensity'] = np.asarray(self.intensity)
+            state['_lazy'] = False
+        return state
 
     def _file_proc(self, ):
-        data = cdf.netcdf_file(self.filename, mmap=False)
+        use_cache = self._cache is not None and not self._lazy
+        if use_cache:
+            key = self._cache_key()
+            stat = os.stat(self.filename)
+            stat = [stat.st_size, stat.st_mtime]
+            digest = None
+            cached = self._cache.load(key)
+            if cached is not None and cached[1].get('stat') != stat:
+                # The file was changed or touched, so check the contents
+                digest = file_digest(self.filename)
+                if cached[1].get('digest') == digest:
+                    info = dict(cached[1], stat=stat)
+                    self._cache.update_info(key, info)
+                else:
+                    self._cache.remove(key)
+                    cached = None
+            if cached is not None:
+                self._cache_restore(*cached)
+                return
 
-        points = data.variables['point_count'][:]
+        data = cdf.netcdf_file(self.filename, mmap=self._lazy)
+
+        points = np.array(data.variables['point_count'][:], dtype=int)
 
         times_cdf = data.variables['scan_acquisition_time']
         times = times_cdf[:]/60.
 
         mass_cdf = data.variables['mass_values'][:]
-        mass_min = int( np.round( mass_cdf.min() ) )
-        mass_max = int( np.round( mass_cdf.max() ) )
-        masses = np.arange(mass_min, mass_max +1)
+        self._first_bin = self._binner.bin_index( mass_cdf.min() )
+        last_bin = self._binner.bin_index( mass_cdf.max() )
+        masses = self._binner.bin_masses(self._first_bin, last_bin)
         
-        inten_cdf = data.variables['intensity_values'][:]
+        self.times = times
+        self.masses = masses
 
-        intens = []
-        start = 0
-        
-        for point in points:
-            int_zero = np.zeros(masses.size, dtype=float)
-            
-            if point == 0: 
-                intens.append( int_zero )
-                continue
-                
-            mass_tmp = np.round( mass_cdf[start:start+point] ).astype(int)
-            ints_tmp = inten_cdf[start:start+point]
-            
-            mass_tmp2 = []
-            ints_tmp2 = []
-            for mass, mass_int in it.groupby( zip(mass_tmp, ints_tmp),
-                    key=self._groupkey):
-                ints = [i[1] for i in mass_int]
-                if len(ints) > 1:
-                    ints = np.array( ints ).mean()
-                else:
-                    ints = ints[0]
-                mass_tmp2.append(mass)
-                ints_tmp2.append(ints)
-            mass_tmp2 = np.array(mass_tmp2)
-            ints_tmp2 = np.array(ints_tmp2)
-                    
-            mask = mass_tmp2 - mass_min
-            int_zero[mask] = ints_tmp2
+        if self._lazy:
+            # Keep the file open and decode the scans on demand
+            self._cdf = data
+            self._points = points
+            self._offsets = np.append(0, np.cumsum(points))
+
+            self.intensity = LazyIntensity(self._scan_range,
+                    (points.size, masses.size), dtype=self._dtype)
+            tics = [rows.sum(axis=1, dtype=float) for t, rows in 
+                    self.iter_scans()]
+            self.tic = np.concatenate(tics) if tics else np.zeros(0)
+            return
 
-            intens.append( int_zero )
+        inten_cdf = data.variables['intensity_values'][:]
 
-            start += point
+        self.intensity = self._binner(points, mass_cdf, inten_cdf,
+                self._first_bin, masses.size, sparse=self._sparse,
+                dtype=self._dtype)
 
         data.close()
-        
-        self.intensity = np.array(intens)
-        self.times = times
-        self.masses = masses
 
-        self.tic = self.intensity.sum(axis=1)
+        self.tic = np.asarray(self.intensity.sum(axis=1, dtype=float)).ravel()
+
+        if use_cache:
+            if digest is None:
+                digest = file_digest(self.filename)
+            self._cache_save(key, {'stat': stat, 'digest': digest})
+
+    def _cache_key(self, ):
+        '''Generate the cache key for this file and the decoding options.'''
+        return self._cache.key(os.path.abspath(self.filename), self.filetype,
+                self._binner, self._sparse, self._dtype.str)
+
+    def _cache_save(self, key, info):
+        '''Save the decoded data arrays into the cache.
+
+        The `info` dictionary holds the file size, modification time, and
+        content hash that the entry is checked against.
+        '''
+        arrays = {'times': self.times, 'masses': self.masses, 'tic': self.tic}
+        if sps.issparse(self.intensity):
+            for comp in ('data', 'indices', 'indptr'):
+                arrays['intensity_' + comp] = getattr(self.intensity, comp)
+        else:
+            arrays['intensity'] = self.intensity
+        info = dict(info, shape=self.intensity.shape)
+        self._cache.save(key, arrays, info)
+
+    def _cache_restore(self, arrays, info):
+        '''Set the data arrays from a cache entry.'''
+        self.times = arrays['times']
+        self.masses = arrays['masses']
+        self.tic = arrays['tic']
+        if 'intensity' in arrays:
+            self.intensity = arrays['intensity']
+        else:
+            self.intensity = sps.csr_matrix((arrays['intensity_data'],
+                    arrays['intensity_indices'], arrays['intensity_indptr']),
+                    shape=tuple(info['shape']))
+
+    def _scan_range(self, first, last):
+        '''Decode the scans from first up to (not including) last.
+
+        This is only used for lazy files.
+        '''
+        start, stop = self._offsets[first], self._offsets[last]
+        mass_cdf = self._cdf.variables['mass_values'][start:stop]
+        inten_cdf = self._cdf.variables['intensity_values'][start:stop]
+        return self._binner(self._points[first:last], mass_cdf, inten_cdf,
+                self._first_bin, self.masses.size, dtype=self._dtype)
 
     def _int_extract(self, name, start, stop):
-        '''Integrate the simulated data over a given range.'''
-        cpdidx = self.ref_cpds.index(name)
-        startidx, stopidx = self.index(self.times, start, stop)
+        '''Integrate the simulated data over a given range.
+
+        The name, start, and stop values can also be sequences of equal
+        length, in which case an array of integrals is returned.
+        '''
+        if isinstance(name, str):
+            cpdidx = self.ref_cpds.index(name)
+        else:
+            cpdidx = np.array([self.ref_cpds.index(n) for n in name],
+                    dtype=int)
+        startidx, stopidx = self.index(self.times, np.asarray(start),
+                np.asarray(stop))
         cpdint = self.fit_csum[stopidx, cpdidx] - self.fit_csum[startidx, cpdidx]
         return cpdint
 
 
+def iter_many(fnames, filetype=AiaFile, workers=4, prefetch=None, **kwargs):
+    '''Read a series of GCMS files using a pool of threads.
+
+    The file reading and decoding is overlapped, which is helpful when the
+    files are on a slow (e.g. network) drive. The file objects are yielded in
+    the same order as the file names.
+
+    Arguments
+    ---------
+    * fnames: iterable - The names of the GCMS data files.
+    * filetype: GcmsFile subclass (default AiaFile) - The file type object.
+    * workers: int (default 4) - The number of reader threads.
+    * prefetch: int (default None) - The maximum number of files that are
+      read ahead of the file being yielded. If None, this is the same as the
+      number of workers.
+    * kwargs: Extra keyword arguments for the file type object.
+    '''
+    if prefetch is None:
+        prefetch = workers
+    prefetch = max(prefetch, 1)
+
+    fnames = iter(fnames)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for fname in it.islice(fnames, prefetch):
+            pending.append( pool.submit(filetype, fname, **kwargs) )
 
+        while pending:
+            data = pending.popleft().result()
+            # Replace the file that was just finished
+            for fname in it.islice(fnames, 1):
+                pending.append( pool.submit(filetype, fname, **kwargs) )
+            yield data
+
+def read_many(fnames, filetype=AiaFile, workers=4, **kwargs):
+    '''Read a list of GCMS files using a pool of threads.
+
+    See `iter_many` for a description of the arguments.
+
+    Returns
+    -------
+    * list - The GCMS file objects in the same order as the file names.
+    '''
+    return list( iter_many(fnames, filetype, workers, **kwargs) )
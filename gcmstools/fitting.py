@@ -1,8 +1,651 @@
+import hashlib
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
 import numpy as np
 import scipy.optimize as spo
+import scipy.sparse as sps
+import scipy.ndimage as spnd
 
 import gcmstools.filetypes as gcf
 
+
+def fnnls(AtA, AtB, tol=None, max_iter=None, A=None, B=None):
+    '''Solve non-negative least squares problems from their cross-products.
+
+    This is the fast NNLS (FNNLS) method of Bro and de Jong (J. Chemometrics
+    1997, 11, 393), which is the Lawson-Hanson active set method using only
+    the cross-products AtA = A.T*A and AtB = A.T*B. Every step solves small
+    (n x n) problems instead of problems on the full (m x n) matrix A.
+    All of the columns of AtB are solved together. In each step, the
+    unconstrained problems for the positive (passive) variables of every
+    column are solved as one stack of (n x n) systems.
+
+    Parameters
+    ----------
+    AtA : ndarray
+        The (n x n) cross-product matrix, A.T*A.
+
+    AtB : ndarray
+        The (n,) or (n x k) cross-products, A.T*B.
+
+    tol : float (default None)
+        The tolerance for the optimality conditions. The default is based on
+        the machine precision and the size of AtA.
+
+    max_iter : int (default None)
+        The maximum number of outer (variable adding) iterations. The default
+        is 3*n. The columns that are not solved in this many iterations are
+        solved again with `scipy.optimize.nnls` (see `_nnls_columns`). This
+        happens for nearly collinear problems.
+
+    A, B : ndarray (default None)
+        The original (m x n) problem matrix and (m,) or (m x k) right-hand
+        sides. These are only used for the columns that are solved again.
+
+    Returns
+    -------
+    ndarray
+        The (n,) or (n x k) solutions, with the same shape as AtB.
+    '''
+    AtA = np.asarray(AtA, dtype=float)
+    AtB = np.asarray(AtB, dtype=float)
+    vector = AtB.ndim == 1
+    if vector:
+        AtB = AtB[:, np.newaxis]
+    n, k = AtB.shape
+
+    if tol is None:
+        tol = 10*np.finfo(float).eps*np.abs(AtA).sum(axis=0).max()*n
+    if max_iter is None:
+        max_iter = 3*n
+
+    # Start from the unconstrained solution with the negative values removed.
+    # This is feasible, and it is usually close to the final passive sets.
+    P = np.ones((n, k), dtype=bool)
+    X = _passive_solve(AtA, AtB, P, np.arange(k))
+    P = X > tol
+    X[~P] = 0.
+    _feasible_update(AtA, AtB, X, P, np.flatnonzero(P.any(axis=0)), tol)
+
+    # The columns that are not yet optimal
+    W = AtB - AtA.dot(X)
+    cols = np.flatnonzero( np.where(P, -np.inf, W).max(axis=0) > tol )
+    for outer in range(max_iter):
+        if cols.size == 0:
+            break
+
+        # Add the variable with the largest gradient to each passive set
+        Wc = np.where(P[:, cols], -np.inf, W[:, cols])
+        P[Wc.argmax(axis=0), cols] = True
+        _feasible_update(AtA, AtB, X, P, cols, tol)
+
+        # Recheck the optimality of the updated columns
+        W[:, cols] = AtB[:, cols] - AtA.dot(X[:, cols])
+        Wc = np.where(P[:, cols], -np.inf, W[:, cols])
+        cols = cols[Wc.max(axis=0) > tol]
+
+    if cols.size > 0:
+        if B is not None and vector:
+            B = np.asarray(B)[:, np.newaxis]
+        _nnls_columns(AtA, AtB, X, cols, A, B)
+    if vector:
+        return X[:, 0]
+    return X
+
+def nnls_batch(A, B, tol=None, max_iter=None):
+    '''Solve many non-negative least squares problems with the same matrix.
+
+    This finds the X that minimizes ||A*x_k - b_k|| subject to x_k >= 0 for
+    every column b_k of B. The cross-products of A and B are calculated, and
+    the problems are solved together with `fnnls`.
+
+    Parameters
+    ----------
+    A : ndarray
+        The (m x n) problem matrix.
+
+    B : ndarray
+        The (m x k) array of right-hand side columns.
+
+    tol : float (default None)
+        The tolerance for the optimality conditions. The default is based on
+        the machine precision and the size of A.
+
+    max_iter : int (default None)
+        The maximum number of outer (variable adding) iterations. The default
+        is 3*n. The columns that are not solved in this many iterations are
+        solved again with `scipy.optimize.nnls`.
+
+    Returns
+    -------
+    ndarray
+        The (n x k) array of solutions.
+    '''
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    AtA = A.T.dot(A)
+    if tol is None:
+        tol = 10*np.finfo(float).eps*np.abs(AtA).sum(axis=0).max()*max(A.shape)
+    return fnnls(AtA, A.T.dot(B), tol=tol, max_iter=max_iter, A=A, B=B)
+
+def _nnls_columns(AtA, AtB, X, cols, A=None, B=None):
+    '''Solve some of the problems again with `scipy.optimize.nnls`.
+
+    The active set steps of the cross-product solvers can cycle when the
+    reference spectra are nearly collinear, because the passive set solves
+    on AtA lose about twice as many digits as solves on A. Scipy's solver
+    works on A, so it is used for the (rare) problems that were not solved.
+    If A is not given, a square root of AtA is used in its place. The
+    selected columns of X are replaced.
+    '''
+    if A is None:
+        # AtA = R.T*R, and R.T*b = Atb for the part of Atb in the range of
+        # AtA, which is all of it for real problems
+        w, V = np.linalg.eigh(AtA)
+        keep = w > w.max(initial=0.)*AtA.shape[0]*np.finfo(float).eps
+        root = np.sqrt(w[keep])
+        A = (root[:, np.newaxis]*V[:, keep].T)
+        B = V[:, keep].T.dot(AtB[:, cols])/root[:, np.newaxis]
+    else:
+        A = np.asarray(A, dtype=float)
+        B = np.asarray(B, dtype=float)[:, cols]
+    for num, col in enumerate(cols):
+        X[:, col] = spo.nnls(A, B[:, num])[0]
+
+def fnnls_warm(AtA, AtB, tol=None, max_iter=None, warm=True, x0=None,
+        A=None, B=None):
+    '''Solve a sequence of non-negative least squares problems, using each
+    solution as the starting point for the next problem.
+
+    The problems are defined by their cross-products, as in `fnnls`. For GCMS
+    data, adjacent scans usually have nearly the same set of positive
+    (passive) compounds, so starting from the previous solution takes fewer
+    steps than starting from zero. If a warm started solution is not optimal,
+    that problem is solved again from a cold start.
+
+    Parameters
+    ----------
+    AtA : ndarray
+        The (n x n) cross-product matrix, A.T*A.
+
+    AtB : ndarray
+        The (n x k) cross-products, A.T*B. The columns are solved in order.
+
+    tol : float (default None)
+        The tolerance for the optimality conditions. The default is based on
+        the machine precision and the size of AtA.
+
+    max_iter : int (default None)
+        The maximum number of outer (variable adding) iterations for each
+        problem. The default is 3*n. The problems that are not solved in
+        this many iterations, even from a cold start, are solved again with
+        `scipy.optimize.nnls`.
+
+    warm : bool (default True)
+        Start each problem from the previous solution. If False, every problem
+        is started from zero, which is useful to compare the step counts.
+
+    x0 : ndarray (default None)
+        The starting point for the first problem.
+
+    A, B : ndarray (default None)
+        The original (m x n) problem matrix and (m x k) right-hand sides.
+        These are only used for the problems that are solved again.
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        The (n x k) solutions and the number of passive set solves that were
+        needed for each problem.
+    '''
+    AtA = np.asarray(AtA, dtype=float)
+    AtB = np.asarray(AtB, dtype=float)
+    n, k = AtB.shape
+    if tol is None:
+        tol = 10*np.finfo(float).eps*np.abs(AtA).sum(axis=0).max()*n
+    if max_iter is None:
+        max_iter = 3*n
+
+    X = np.zeros((n, k))
+    iters = np.zeros(k, dtype=int)
+    x = x0
+    for col in range(k):
+        Atb = AtB[:, col]
+        count = 0
+        optimal = False
+        if warm and x is not None:
+            x, count, optimal = _fnnls_single(AtA, Atb, tol, max_iter, x)
+        if not optimal:
+            x, more, optimal = _fnnls_single(AtA, Atb, tol, max_iter)
+            count += more
+            if not optimal:
+                X[:, col] = x
+                _nnls_columns(AtA, AtB, X, [col], A, B)
+                x = X[:, col].copy()
+        X[:, col] = x
+        iters[col] = count
+    return X, iters
+
+def _fnnls_single(AtA, Atb, tol, max_iter, x0=None):
+    '''Solve one NNLS problem from its cross-products.
+
+    If `x0` is given, its positive values are the starting passive set and
+    solution. Returns the solution, the number of passive set solves, and
+    whether the solution is optimal.
+    '''
+    n = AtA.shape[0]
+    x = np.zeros(n)
+    P = np.zeros(n, dtype=bool)
+    count = 0
+    if x0 is not None:
+        P = x0 > tol
+        if P.any():
+            x[P] = x0[P]
+            x, count = _fnnls_feasible(AtA, Atb, x, P, tol)
+
+    w = Atb - AtA.dot(x)
+    for outer in range(max_iter):
+        if P.all() or w[~P].max() <= tol:
+            return x, count, True
+        # Add the variable with the largest gradient to the passive set
+        P[np.where(P, -np.inf, w).argmax()] = True
+        x, more = _fnnls_feasible(AtA, Atb, x, P, tol)
+        count += more
+        w = Atb - AtA.dot(x)
+    return x, count, bool(P.all() or w[~P].max() <= tol)
+
+def _fnnls_feasible(AtA, Atb, x, P, tol):
+    '''Solve for the passive variables, keeping the solution positive.
+
+    The feasible solution `x` and the passive set `P` are updated; variables
+    that reach zero are removed from P. Returns the new solution and the
+    number of passive set solves.
+    '''
+    n = x.size
+    s = _gram_solve(AtA, Atb, P)
+    count = 1
+    for inner in range(3*n):
+        neg = P & (s <= tol)
+        if not neg.any():
+            break
+        # Step back toward the last solution until a value reaches zero. A
+        # new variable that is still zero is already at its bound.
+        xn, sn = x[neg], s[neg]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            alpha = np.where(xn > sn, xn/(xn - sn), 0.).min()
+        x = x + alpha*(s - x)
+        P &= x > tol
+        s = _gram_solve(AtA, Atb, P)
+        count += 1
+    return s, count
+
+def _gram_solve(AtA, Atb, P):
+    '''Solve the normal equations for only the passive variables, P.'''
+    s = np.zeros(AtA.shape[0])
+    idx = np.flatnonzero(P)
+    if idx.size:
+        sub = AtA[idx[:, np.newaxis], idx]
+        try:
+            s[idx] = np.linalg.solve(sub, Atb[idx])
+        except np.linalg.LinAlgError:
+            s[idx] = np.linalg.lstsq(sub, Atb[idx], rcond=None)[0]
+    return s
+
+def nnls_pg(AtA, AtB, max_iter=500, tol=1e-6, lipschitz=None):
+    '''Solve non-negative least squares problems by projected gradient.
+
+    This is an accelerated (FISTA) projected gradient method that works on
+    the cross-products, as in `fnnls`, and solves all of the columns of AtB
+    together. The step size is the inverse of the largest eigenvalue of AtA
+    (the Lipschitz constant of the gradient).
+
+    Parameters
+    ----------
+    AtA : ndarray
+        The (n x n) cross-product matrix, A.T*A.
+
+    AtB : ndarray
+        The (n x k) cross-products, A.T*B.
+
+    max_iter : int (default 500)
+        The maximum number of iterations.
+
+    tol : float (default 1e-6)
+        The iterations stop when the largest change in the solutions is less
+        than this fraction of the largest solution value.
+
+    lipschitz : float (default None)
+        The largest eigenvalue of AtA, or an upper bound for it. This is
+        calculated if it is not given; pass it to solve many blocks with the
+        same AtA.
+
+    Returns
+    -------
+    ndarray
+        The (n x k) approximate solutions.
+    '''
+    AtA = np.asarray(AtA, dtype=float)
+    AtB = np.asarray(AtB, dtype=float)
+    X = np.zeros(AtB.shape)
+    if X.size == 0:
+        return X
+    if lipschitz is None:
+        lipschitz = _lipschitz(AtA)
+    if lipschitz <= 0:
+        return X
+    step = 1./lipschitz
+
+    Y = X
+    t = 1.
+    for num in range(max_iter):
+        X_new = np.maximum(Y - step*(AtA.dot(Y) - AtB), 0.)
+        change = np.abs(X_new - X).max()
+        t_new = 0.5*(1. + np.sqrt(1. + 4.*t*t))
+        Y = X_new + ((t - 1.)/t_new)*(X_new - X)
+        X, t = X_new, t_new
+        if change <= tol*max(np.abs(X).max(), np.finfo(float).tiny):
+            break
+    return X
+
+def _lipschitz(AtA):
+    '''The largest eigenvalue of a cross-product matrix.'''
+    if AtA.size == 0:
+        return 0.
+    return np.linalg.eigvalsh(AtA).max()
+
+def nnls_cd(AtA, AtB, max_iter=200, tol=1e-6):
+    '''Solve non-negative least squares problems by coordinate descent.
+
+    Each variable is updated in turn with the exact minimizer along that
+    coordinate, clipped at zero. The method works on the cross-products, as
+    in `fnnls`, and all of the columns of AtB are updated together.
+
+    Parameters
+    ----------
+    AtA : ndarray
+        The (n x n) cross-product matrix, A.T*A.
+
+    AtB : ndarray
+        The (n x k) cross-products, A.T*B.
+
+    max_iter : int (default 200)
+        The maximum number of sweeps over the variables.
+
+    tol : float (default 1e-6)
+        The sweeps stop when the largest change in the solutions is less than
+        this fraction of the largest solution value.
+
+    Returns
+    -------
+    ndarray
+        The (n x k) approximate solutions.
+    '''
+    AtA = np.asarray(AtA, dtype=float)
+    AtB = np.asarray(AtB, dtype=float)
+    n = AtA.shape[0]
+    X = np.zeros(AtB.shape)
+    if X.size == 0:
+        return X
+    # The gradient, AtA*X - AtB, is updated as each variable changes
+    G = -AtB.copy()
+    diag = np.diag(AtA)
+    for sweep in range(max_iter):
+        change = 0.
+        for j in range(n):
+            if diag[j] <= 0:
+                continue
+            new = np.maximum(X[j] - G[j]/diag[j], 0.)
+            delta = new - X[j]
+            X[j] = new
+            G += np.outer(AtA[:, j], delta)
+            change = max(change, np.abs(delta).max())
+        if change <= tol*max(np.abs(X).max(), np.finfo(float).tiny):
+            break
+    return X
+
+def _feasible_update(AtA, AtB, X, P, cols, tol):
+    '''Update the solutions for new passive sets, keeping them positive.
+
+    The unconstrained problems for the passive variables are solved. If any
+    of the solutions are not positive, the solution steps back toward the
+    last (feasible) solution, and the variables that hit zero are removed
+    from the passive set. X and P are modified in place.
+    '''
+    n = X.shape[0]
+    S = _passive_solve(AtA, AtB, P, cols)
+    for inner in range(3*n):
+        bad = ((S <= tol) & P[:, cols]).any(axis=0)
+        if not bad.any():
+            break
+        bcols = cols[bad]
+        Xb = X[:, bcols]
+        Sb = S[:, bad]
+        neg = P[:, bcols] & (Sb <= tol)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(neg, Xb/(Xb - Sb), np.inf)
+        alpha = ratio.min(axis=0)
+        Xb = Xb + alpha*(Sb - Xb)
+        P[:, bcols] &= Xb > tol
+        Xb[~P[:, bcols]] = 0.
+        X[:, bcols] = Xb
+        S[:, bad] = _passive_solve(AtA, AtB, P, bcols)
+
+    S[~P[:, cols]] = 0.
+    X[:, cols] = S
+
+def _passive_solve(AtA, AtB, P, cols, max_bytes=2**26):
+    '''Least squares solutions restricted to the passive variables.
+
+    For each selected column of AtB, the normal equations of the passive
+    variables are embedded in an (n x n) system, with an identity block for
+    the other variables. All of these systems are solved with one stacked
+    call, in batches that are limited to `max_bytes` of memory. Singular
+    systems fall back to grouped least squares solutions.
+    '''
+    n = AtA.shape[0]
+    S = np.zeros((n, cols.size))
+    diag = np.arange(n)
+    step = max(1, max_bytes//(8*n*n))
+    for first in range(0, cols.size, step):
+        sel = slice(first, first + step)
+        Pt = P[:, cols[sel]].T
+        M = AtA*(Pt[:, :, np.newaxis] & Pt[:, np.newaxis, :])
+        M[:, diag, diag] += ~Pt
+        rhs = np.where(Pt, AtB[:, cols[sel]].T, 0.)
+        try:
+            S[:, sel] = np.linalg.solve(M, rhs[:, :, np.newaxis])[:, :, 0].T
+        except np.linalg.LinAlgError:
+            S[:, sel] = _passive_lstsq(AtA, AtB, P, cols[sel])
+    return S
+
+def _passive_lstsq(AtA, AtB, P, cols):
+    '''Least squares solutions restricted to the passive variables.
+
+    The columns of AtB (selected by `cols`) with the same passive set are
+    solved together with a least squares call on the passive block of AtA.
+    '''
+    S = np.zeros((AtA.shape[0], cols.size))
+    patterns, groups = np.unique(P[:, cols].T, axis=0, return_inverse=True)
+    for num, pattern in enumerate(patterns):
+        if not pattern.any():
+            continue
+        sel = np.flatnonzero(groups.ravel() == num)
+        sol = np.linalg.lstsq(AtA[np.ix_(pattern, pattern)],
+                AtB[np.ix_(pattern, cols[sel])], rcond=None)[0]
+        S[np.ix_(pattern, sel)] = sol
+    return S
+
+
+def screen_candidates(inten, ref_array, k, window=0, mode='cosine'):
+    '''Select the candidate compounds for each scan by spectral similarity.
+
+    The similarities of all of the scans with all of the reference spectra
+    are found with one matrix product. Each similarity is replaced by its
+    maximum over a window of neighboring scans, so that a compound stays a
+    candidate over the whole width of its peak. Then the `k` most similar
+    compounds are selected for each scan. 
+
+    Parameters
+    ----------
+    inten : ndarray
+        The (scans x masses) intensity array.
+
+    ref_array : ndarray or scipy.sparse matrix
+        The (cpds x masses) reference array. A sparse array (e.g. the
+        reference array of a large library) is much faster for large
+        libraries.
+
+    k : int
+        The number of candidates for each scan.
+
+    window : int (default 0)
+        The number of scans on each side of a scan that are used for the
+        windowed maximum.
+
+    mode : str (default 'cosine')
+        The similarity measure, 'cosine' for the cosine of the angle between
+        the spectra or 'dot' for their dot product.
+
+    Returns
+    -------
+    ndarray
+        A (scans x cpds) boolean array of the candidates for each scan.
+        Compounds that have no overlap with any scan in the window are never
+        candidates, because they can't be part of a non-negative fit.
+    '''
+    inten = np.asarray(inten, dtype=float)
+    sim = np.asarray(ref_array.dot(inten.T), dtype=float).T
+
+    if mode == 'cosine':
+        if sps.issparse(ref_array):
+            ref_norm = np.asarray(ref_array.multiply(ref_array).sum(axis=1))
+        else:
+            ref = np.asarray(ref_array, dtype=float)
+            ref_norm = np.einsum('ij,ij->i', ref, ref)
+        norms = [np.sqrt(np.ravel(ref_norm)), 
+                np.sqrt(np.einsum('ij,ij->i', inten, inten))]
+        # Empty spectra have no similarity with anything
+        for norm in norms:
+            norm[norm == 0.] = np.inf
+        sim /= norms[0]
+        sim /= norms[1][:, np.newaxis]
+
+    if window > 0 and sim.shape[0] > 1:
+        sim = spnd.maximum_filter1d(sim, 2*window + 1, axis=0, 
+                mode='nearest')
+
+    masks = sim > 0.
+    if k < sim.shape[1]:
+        top = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+        keep = np.zeros(masks.shape, dtype=bool)
+        np.put_along_axis(keep, top, True, axis=1)
+        masks &= keep
+    return masks
+
+def _mask_groups(masks):
+    '''Group the rows of a boolean mask array by their mask pattern.
+
+    Yields the unique mask patterns and the row numbers that have each one.
+    '''
+    if len(masks) == 0:
+        return
+    patterns, groups = np.unique(masks, axis=0, return_inverse=True)
+    groups = groups.ravel()
+    for num, mask in enumerate(patterns):
+        yield mask, np.flatnonzero(groups == num)
+
+
+def _ref_rows(ref_array, idx):
+    '''Get rows of a dense or sparse (CSR) reference array as a dense float
+    array.
+
+    `idx` can be an integer, an index array, or a boolean mask.
+    '''
+    if not sps.issparse(ref_array):
+        return np.asarray(ref_array[idx], dtype=float)
+    idx = np.asarray(idx)
+    if idx.dtype == bool:
+        idx = np.flatnonzero(idx)
+    rows = ref_array[np.atleast_1d(idx)].toarray().astype(float, copy=False)
+    return rows if idx.ndim else rows[0]
+
+
+class _SubsetCache(object):
+    '''A least recently used cache of reference array subsets.
+
+    The entries are (rows, cross-product, Lipschitz constant) lists for a
+    subset of the reference compounds. They are keyed by a hash of the
+    reference spectra and the subset mask, so they are shared between files
+    that use the same reference set. The rows are dense, even if the
+    reference array is sparse. The Lipschitz constant (the largest eigenvalue
+    of the cross-product) is only found if it is requested, and it is None
+    otherwise.
+    '''
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def get(self, ref_key, ref, mask, lipschitz=False):
+        key = (ref_key, mask.tobytes())
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            rows = _ref_rows(ref, mask)
+            entry = [rows, rows.dot(rows.T), None]
+        if lipschitz and entry[2] is None:
+            entry[2] = _lipschitz(entry[1])
+        # Reinsert to mark as recently used
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+
+def _fit_worker(fitter, specs, ref_cpds, ret_times, times, first, last,
+        chunk=256, pruned=None, screened=None, ref_array=None):
+    '''Fit a range of scans in a worker process.
+
+    The intensity, reference, coefficient, and fit quality arrays (and
+    optionally, an array of solver step counts) are attached from the shared
+    memory blocks described by `specs`, a list of (name, shape, dtype)
+    tuples. The results are written directly into the shared arrays.
+    `pruned` is an optional boolean array of the scans in this range to
+    prune, and `screened` is an optional array of the candidate compounds for
+    each scan.
+    A sparse reference array is sent as `ref_array` instead of being shared.
+    '''
+    blocks = [shared_memory.SharedMemory(name=spec[0]) for spec in specs]
+    arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) 
+            for shm, (name, shape, dtype) in zip(blocks, specs)]
+    if ref_array is None:
+        ref_array = arrays[1]
+    if fitter._ref_key is not None:
+        # The key was found for the same reference array in the main process
+        fitter._ref_key = (ref_array, fitter._ref_key[1])
+    try:
+        for start in range(first, last, chunk):
+            stop = min(start + chunk, last)
+            sel = slice(start - first, stop - first)
+            fit = fitter._fit_pruned_block(times[sel], arrays[0][start:stop],
+                    ref_array, ref_cpds, ret_times,
+                    None if pruned is None else pruned[sel],
+                    None if screened is None else screened[sel])
+            arrays[2][start:stop] = fit
+            arrays[3][start:stop] = fitter._fit_quality(arrays[0][start:stop],
+                    fit, ref_array)
+            # The solver step counts, if they are collected
+            if len(arrays) > 4:
+                arrays[4][start:stop] = fitter._block_iters
+    finally:
+        # The array views must be released before the blocks are closed
+        del arrays[:]
+        for shm in blocks:
+            shm.close()
+
+
 class Fit(object):
     def __call__(self, datafiles):
         if isinstance(datafiles, gcf.GcmsFile):
@@ -12,42 +655,176 @@ class Fit(object):
             for data in datafiles:
                 self.fit(data)
 
+    def close(self, ):
+        '''Release any resources (e.g. worker processes) of the fit.'''
+        pass
+
 class Nnls(Fit):
-    '''A non-negative least squares fitting object.'''
+    '''A non-negative least squares fitting object.
+
+    The `solver` keyword sets how the scans are solved. The default, 'scipy',
+    solves every scan separately with `scipy.optimize.nnls`. The 'batch'
+    solver solves a whole block of scans at once with `nnls_batch`, which is
+    much faster for files with many scans. The 'warm' solver fits the scans
+    in order, starting each fit from the solution of the previous scan (see
+    `fnnls_warm`). It also adds the number of solver steps for every scan to
+    the data object as `fit_iters`.
+
+    For retention time filtered fits, the scans that fit the same set of
+    compounds are solved together. The reference array subsets for each
+    compound set are cached, and they are reused for other files with the
+    same reference spectra.
+
+    The `workers` keyword splits the scans of each file across a pool of
+    processes. The intensity data, reference array, and fit coefficients are
+    placed in shared memory, so they are not copied to the workers. Note that
+    the full (dense) intensity array is placed in shared memory, even for
+    sparse or lazy data. The pool is started on first use and kept for the
+    following files; use the `close` method to stop it. The workers are
+    started with the 'forkserver' method (or 'spawn' where that isn't
+    available), because forking a process that has other running threads,
+    such as the file readers of `proc_data`, can deadlock.
+
+    The `prune` keyword skips the fits of scans in the baseline regions. Scans
+    with a total ion count below a threshold are fit with only the
+    Background (or set to zero if there isn't a Background). The threshold
+    is set by `prune_mode`: 'abs' uses `prune` as the threshold, 'percentile'
+    uses that percentile of the TIC, and 'snr' uses the TIC median plus
+    `prune` times a noise estimate (the scaled median absolute deviation of
+    the TIC). The pruned scans are added to the data object as a boolean
+    array, `fit_pruned`.
+
+    The `screen` keyword fits only the `screen` reference compounds that are
+    most similar to each scan (see `screen_candidates`), which is much
+    faster for large reference sets. The similarity is set by `screen_mode`
+    ('cosine' or 'dot'), and each compound is ranked by its best similarity
+    within `screen_win` scans on either side. The Background is always fit.
+    A small compound that overlaps with a large one can be missed, so the fit
+    residuals are screened again for `screen_rounds` - 1 more rounds, adding
+    `screen` more candidates each time, and the file is refit. The screening
+    is combined with the retention time filter, if it is used.
+
+    The quality of the fit for every scan is calculated from the
+    cross-products of the reference and intensity data, and it is added to
+    the data object: `fit_resid` is the norm of the fit residual, 
+    `fit_relresid` is that norm relative to the norm of the scan, and
+    `fit_ticfrac` is the fraction of the TIC that is explained by the fit.
+    '''
+    solvers = ('scipy', 'batch', 'warm')
+    prune_modes = ('abs', 'percentile', 'snr')
+    screen_modes = ('cosine', 'dot')
+    # The options that change the fits. Their values are added to the data
+    # object as `fit_options`, so that `refit` only reuses matching fits.
+    _fit_options = ('dtype', 'solver', 'rt_filter', 'rt_win', 'rt_adj', 
+            'prune', 'prune_mode', 'screen', 'screen_win', 'screen_mode',
+            'screen_rounds')
+    # Set if `_solve_gram` uses the largest eigenvalue of the cross-products
+    _use_lipschitz = False
+
     def __init__(self, rt_filter=False, rt_win=0.2, rt_adj=0., quiet=False,
-            **kwargs):
+            dtype=float, solver='scipy', workers=None, prune=None,
+            prune_mode='abs', screen=None, screen_win=5, 
+            screen_mode='cosine', screen_rounds=2, **kwargs):
+        if solver not in self.solvers:
+            error = "Unknown NNLS solver '{}'. Use one of: {}"
+            raise ValueError(error.format(solver, ', '.join(self.solvers)))
+        if prune_mode not in self.prune_modes:
+            error = "Unknown prune mode '{}'. Use one of: {}"
+            raise ValueError(error.format(prune_mode, 
+                ', '.join(self.prune_modes)))
+        if screen_mode not in self.screen_modes:
+            error = "Unknown screen mode '{}'. Use one of: {}"
+            raise ValueError(error.format(screen_mode, 
+                ', '.join(self.screen_modes)))
+        if screen is not None and screen < 1:
+            raise ValueError("The screen size must be at least 1.")
         self.fit_type = 'Nnls'
         self._quiet = quiet
+        self.dtype = np.dtype(dtype)
+        self.solver = solver
         self.rt_filter = rt_filter
         if rt_filter:
             self.rt_win = rt_win
             self.rt_adj = rt_adj
+        self.workers = workers
+        self.prune = prune
+        self.prune_mode = prune_mode
+        self.screen = screen
+        self.screen_win = screen_win
+        self.screen_mode = screen_mode
+        self.screen_rounds = screen_rounds
+        self._subsets = _SubsetCache()
+        self._ref_key = None
+        self._screen_ref = None
+        self._gram = None
+        self._warm_starts = {}
+        self._block_iters = None
+        self._pool = None
+
+    def __getstate__(self, ):
+        # The caches are not sent to worker processes; they are rebuilt as
+        # needed
+        state = self.__dict__.copy()
+        state['_subsets'] = _SubsetCache()
+        # The content key is kept, so the workers don't hash the reference
+        # array again. (See `_fit_worker`.)
+        if self._ref_key is not None:
+            state['_ref_key'] = (None, self._ref_key[1])
+        state['_screen_ref'] = None
+        state['_gram'] = None
+        state['_warm_starts'] = {}
+        state['_pool'] = None
+        return state
+
+    def close(self, ):
+        '''Stop the worker processes, if they were started.'''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _worker_pool(self, ):
+        '''Get the pool of worker processes, which is started on first use.'''
+        if self._pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            method = 'forkserver' if 'forkserver' in methods else 'spawn'
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(method))
+        return self._pool
 
     def _integrate(self, data):
-        # Make the fits array 3D -> [len(times), len(cpds), 1]
-        # multiply by the ref_array -> [len(cpds), len(masses)]
-        # fit_ms = [len(times), len(cpds), len(masses)]
-        # This is a huge array, so we won't store it in the object
-        fit_ms = data.fit_coef[:,:,np.newaxis]*data.ref_array
-
-        # Generate simulated MS for each component
-        # Sum along the 3d dimmension (masses)
+        # Generate simulated GC traces for each component. The simulated MS
+        # of a compound is its fit coefficient times its reference spectrum,
+        # so the sum of that spectrum is just the coefficient times the sum
+        # of the reference spectrum. The [len(times), len(cpds), len(masses)]
+        # array of fitted spectra is never needed. (See `fit_spectra` of the
+        # data object to get those spectra for a time window.)
         # sim = [len(times), len(cpds)]
-        sim = fit_ms.sum(axis=2)
-        data.fit_sim = sim.copy()
+        if sps.issparse(data.ref_array):
+            ref_sums = np.asarray(data.ref_array.sum(axis=1, 
+                dtype=float)).ravel()
+        else:
+            ref_sums = np.asarray(data.ref_array, dtype=float).sum(axis=1)
+        sim = data.fit_coef*ref_sums
+        data.fit_sim = sim.astype(self.dtype, copy=False)
         
         # Run a cummulative sum along the time axis of the simulation to get a
         # total integral, the difference between any two points is relative
         # integrals
         # fit_csum -> [len(times, len(cpds)]
-        fit_csum = np.cumsum(sim, axis=0)
-        data.fit_csum = fit_csum.copy()
+        # This is always accumulated (and kept) as float64, so that the
+        # integrals are accurate even if the other arrays are float32
+        fit_csum = np.cumsum(sim, axis=0, dtype=np.float64)
+        data.fit_csum = fit_csum
 
         # Find the integrals and add them to the metadata
-        for name, meta in data.ref_meta.items():
-            if "START" in meta:
-                start, stop = float(meta["START"]), float(meta["STOP"])
-                integral = data._int_extract(name, start, stop)
+        # All of the integration windows are found at once
+        names = [name for name, meta in data.ref_meta.items() 
+                if "START" in meta]
+        if names:
+            starts = [float(data.ref_meta[name]["START"]) for name in names]
+            stops = [float(data.ref_meta[name]["STOP"]) for name in names]
+            integrals = data._int_extract(names, starts, stops)
+            for name, integral in zip(names, integrals):
                 data.ref_meta[name]["integral"] = integral
 
     def fit(self, data):
@@ -58,33 +835,480 @@ class Nnls(Fit):
         if not self._quiet:
             print("Fitting: {}".format(data.filename))
 
-        fits = []
         ref_cpds = data.ref_cpds
-        times = data.times
-        inten = data.intensity
         ref_meta = data.ref_meta 
-        ref_array = data.ref_array
+        ref_array = self._fit_ref_array(data)
         
         # If a retention time filter is requested, then build up an array of
         # retention times from the meta data
+        ret_times = None
         if self.rt_filter == True:
             ret_times = self._rt_filter_times(ref_cpds, ref_meta)
 
-        for time, ms in zip(times, inten):
-            if self.rt_filter == False:
-                # If no retention time filter, just do standard fit
-                fit, junk = spo.nnls(ref_array.T, ms)
-            else:
-                # Or else to a special retention time filtered fit
-                fit = self._rt_filter_fit(ret_times, time, ms, ref_array,
-                        ref_cpds)
+        pruned = self._prune_mask(data)
+        screened = self._screen_mask(data, ref_array, ref_cpds)
+        fit_coef, quality, fit_iters = self._fit_scans(data, ref_array, 
+                ref_cpds, ret_times, pruned, screened)
 
-            fits.append( fit )
+        if screened is not None:
+            # Compounds that are hidden by larger, overlapping compounds are
+            # found by screening the fit residuals
+            for num in range(1, self.screen_rounds):
+                screened |= self._screen_mask(data, ref_array, ref_cpds,
+                        fit_coef)
+                fit_coef, quality, fit_iters = self._fit_scans(data, 
+                        ref_array, ref_cpds, ret_times, pruned, screened)
+            if not self._quiet:
+                print("Fit {:.1f} of {} compounds per scan".format(
+                    screened.sum(axis=1).mean() if screened.size else 0.,
+                    len(ref_cpds)))
         
+        self._set_fit(data, fit_coef, quality, fit_iters, pruned)
+
+    def _fit_scans(self, data, ref_array, ref_cpds, ret_times, pruned=None,
+            screened=None):
+        '''Fit all of the scans of a file.
+
+        Returns the coefficients, the fit quality metrics (see
+        `_fit_quality`), and the solver step counts (or None).
+        '''
+        # Warm starts are not carried over from other files
+        self._warm_starts = {}
+
+        if self.workers and self.workers > 1 and data.times.size > 0:
+            return self._fit_parallel(data, ref_array, ref_cpds, ret_times,
+                    pruned=pruned, screened=screened)
+
+        # Work through the scans in dense blocks, so that sparse or lazy
+        # intensity data is never fully expanded in memory
+        fits = []
+        iters = []
+        quality = [np.zeros((0, 3))]
+        first = 0
+        for block_times, inten in data.iter_scans():
+            last = first + len(block_times)
+            fit = self._fit_pruned_block(block_times, inten, ref_array,
+                    ref_cpds, ret_times, 
+                    None if pruned is None else pruned[first:last],
+                    None if screened is None else screened[first:last])
+            fits.append( fit.astype(self.dtype) )
+            quality.append( self._fit_quality(inten, fit, ref_array) )
+            iters.append( self._block_iters )
+            first = last
+        if fits:
+            fit_coef = np.concatenate( fits )
+        else:
+            fit_coef = np.zeros((0, len(ref_cpds)), dtype=self.dtype)
+        quality = np.concatenate( quality )
+        fit_iters = None
+        if self.solver == 'warm':
+            fit_iters = np.concatenate( iters + [np.zeros(0, int)] )
+        return fit_coef, quality, fit_iters
+
+    def refit(self, data, prev):
+        '''Update a fit after the reference set has been changed.
+
+        The new reference set of `data` is compared with the reference set of
+        a previous fit, `prev`, using the reference hashes. If they are the
+        same, the previous fit is reused. If they are different and a
+        retention time filter is used, only the scans with a changed compound
+        (old or new) inside the retention window are refit. Otherwise (or if
+        candidate screening is used), the whole file is refit. The whole file
+        is also refit if the previous fit used a different fit type or
+        different fitting options (see the `fit_options` of the data).
+
+        Parameters
+        ----------
+        data : GcmsFile object
+            The data, which has already been processed with the new reference
+            object.
+
+        prev : GcmsFile object
+            An object with the previous reference and fit information, e.g.
+            the same file extracted from a GcmsStore before the new reference
+            set was applied.
+
+        Returns
+        -------
+        int
+            The number of scans that were refit.
+        '''
+        nscans = data.times.size
+        old_hashes = getattr(prev, 'ref_hashes', None)
+        if old_hashes is None or not hasattr(prev, 'fit_coef') or \
+                getattr(prev, 'fit_type', None) != self.fit_type or \
+                getattr(prev, 'fit_options', None) != self._option_values():
+            self.fit(data)
+            return nscans
+
+        if prev.ref_hash == data.ref_hash:
+            if not self._quiet:
+                print("Reusing fit: {}".format(data.filename))
+            quality = np.column_stack([prev.fit_resid, prev.fit_relresid,
+                prev.fit_ticfrac])
+            self._set_fit(data, prev.fit_coef, quality,
+                    getattr(prev, 'fit_iters', None), 
+                    getattr(prev, 'fit_pruned', None))
+            return 0
+
+        new_hashes = data.ref_hashes
+        changed = set(name for name in set(new_hashes) | set(old_hashes)
+                if new_hashes.get(name) != old_hashes.get(name))
+        if not self.rt_filter or 'Background' in changed or \
+                self.screen is not None:
+            self.fit(data)
+            return nscans
+
+        ref_cpds = data.ref_cpds
+        ref_array = data.ref_array
+        ret_times = self._rt_filter_times(ref_cpds, data.ref_meta)
+        old_times = self._rt_filter_times(prev.ref_cpds, prev.ref_meta)
+
+        # Find the scans with a changed compound in the retention window
+        affected = np.zeros(nscans, dtype=bool)
+        for rts, cpds in ((ret_times, ref_cpds), (old_times, prev.ref_cpds)):
+            idx = [num for num, name in enumerate(cpds) if name in changed]
+            if idx:
+                rts = rts[idx] + self.rt_adj
+                diff = np.abs(data.times[:, np.newaxis] - rts)
+                affected |= (diff < self.rt_win).any(axis=1)
+
+        if not self._quiet:
+            print("Refitting {} of {} scans: {}".format(affected.sum(), 
+                nscans, data.filename))
+
+        # Reuse the old fits of the unchanged compounds
+        fit_coef = np.zeros((nscans, len(ref_cpds)))
+        for num, name in enumerate(ref_cpds):
+            if name in prev.ref_cpds and name not in changed:
+                fit_coef[:, num] = prev.fit_coef[:, prev.ref_cpds.index(name)]
+        fit_iters = None
+        if self.solver == 'warm':
+            fit_iters = np.zeros(nscans, dtype=int)
+            if hasattr(prev, 'fit_iters'):
+                fit_iters[:] = prev.fit_iters
+
+        self._warm_starts = {}
+        self._set_ref_key(data)
+        pruned = self._prune_mask(data)
+        quality = np.zeros((nscans, 3))
+        first = 0
+        for block_times, inten in data.iter_scans():
+            last = first + len(block_times)
+            sel = affected[first:last]
+            if sel.any():
+                fit = self._fit_pruned_block(block_times[sel], inten[sel],
+                        ref_array, ref_cpds, ret_times,
+                        None if pruned is None else pruned[first:last][sel])
+                fit_coef[first:last][sel] = fit
+                if fit_iters is not None:
+                    fit_iters[first:last][sel] = self._block_iters
+            # The quality metrics are cheap, so they are found for all scans
+            quality[first:last] = self._fit_quality(inten, 
+                    fit_coef[first:last], ref_array)
+            first = last
+
+        self._set_fit(data, fit_coef.astype(self.dtype), quality, fit_iters,
+                pruned)
+        return int(affected.sum())
+
+    def _option_values(self, ):
+        '''Get a dictionary of the values of the fitting options.'''
+        values = dict((name, getattr(self, name, None)) for name in 
+                self._fit_options)
+        values['dtype'] = self.dtype.str
+        return values
+
+    def _set_fit(self, data, fit_coef, quality, fit_iters, pruned):
+        '''Add the fit results to a data object and integrate the fits.'''
         data.fit_type = self.fit_type
-        data.fit_coef = np.array( fits )
+        data.fit_options = self._option_values()
+        data.fit_coef = fit_coef
+        data.fit_resid, data.fit_relresid, data.fit_ticfrac = quality.T
+        if fit_iters is not None:
+            data.fit_iters = fit_iters
+        elif hasattr(data, 'fit_iters'):
+            # Remove the step counts of an older fit
+            del data.fit_iters
+        if pruned is not None:
+            data.fit_pruned = pruned
+        elif hasattr(data, 'fit_pruned'):
+            del data.fit_pruned
         self._integrate(data)
 
+    def _fit_quality(self, inten, fit, ref_array):
+        '''Calculate the fit quality metrics for a block of scans.
+
+        The squared residual norm of each scan, ||b - A*x||**2, is found from
+        the cross-products as b.b - 2*x.(A.T*b) + x.(A.T*A).x, so the
+        simulated spectra are never needed. Only the compounds with a nonzero
+        coefficient in the block are used. Because of rounding, residuals
+        below about 1e-7 of the scan norm are not precise.
+
+        Returns
+        -------
+        ndarray
+            A (scans x 3) array of the residual norms, the relative residuals,
+            and the explained TIC fractions.
+        '''
+        inten = np.asarray(inten, dtype=float)
+        fit = np.asarray(fit, dtype=float)
+        # Only the compounds that are in the fits are needed, which keeps
+        # this small for screened fits of large reference sets
+        cols = np.flatnonzero(fit.any(axis=0))
+        ref = _ref_rows(ref_array, cols)
+        fit = fit[:, cols]
+        if self._gram is not None and self._gram[0] is ref_array:
+            AtA = self._gram[1][np.ix_(cols, cols)]
+        else:
+            AtA = ref.dot(ref.T)
+
+        bb = np.einsum('ij,ij->i', inten, inten)
+        xAtb = np.einsum('ij,ji->i', fit, ref.dot(inten.T))
+        xAtAx = np.einsum('ij,ij->i', fit.dot(AtA), fit)
+        # Rounding can make a nearly perfect fit slightly negative
+        resid = np.sqrt(np.maximum(bb - 2*xAtb + xAtAx, 0.))
+
+        tic = inten.sum(axis=1)
+        fit_tic = fit.dot(ref.sum(axis=1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relresid = np.where(bb > 0, resid/np.sqrt(bb), 0.)
+            ticfrac = np.where(tic > 0, fit_tic/tic, 0.)
+        return np.column_stack([resid, relresid, ticfrac])
+
+    def _prune_mask(self, data):
+        '''Find the scans that are below the pruning threshold.
+
+        Returns a boolean array of the pruned scans, or None if pruning is
+        not used.
+        '''
+        if self.prune is None:
+            return None
+
+        tic = np.asarray(data.tic, dtype=float)
+        if tic.size == 0:
+            return np.zeros(0, dtype=bool)
+        if self.prune_mode == 'abs':
+            threshold = self.prune
+        elif self.prune_mode == 'percentile':
+            threshold = np.percentile(tic, self.prune)
+        else:
+            # The noise is estimated from the median absolute deviation,
+            # which is mostly unaffected by the peaks
+            median = np.median(tic)
+            noise = 1.4826*np.median(np.abs(tic - median))
+            threshold = median + self.prune*noise
+        pruned = tic < threshold
+
+        if not self._quiet:
+            print("Pruned {} of {} scans".format(pruned.sum(), pruned.size))
+        return pruned
+
+    def _screen_mask(self, data, ref_array, ref_cpds, fit_coef=None, 
+            chunk=256):
+        '''Find the candidate compounds for every scan of a file.
+
+        The scans are screened in blocks, which are extended by `screen_win`
+        scans on each side so that the windowed maximum is the same as for
+        the whole file. If the fit coefficients are given, the fit residuals
+        are screened instead of the scans. Returns a (scans x cpds) boolean
+        array, or None if screening is not used. The Background is always a
+        candidate.
+        '''
+        if self.screen is None:
+            return None
+
+        nscans = data.times.size
+        ncpds = len(ref_cpds)
+        if ref_cpds[-1] == 'Background':
+            ncpds -= 1
+        # The compound spectra are screened as a sparse matrix, which is
+        # kept for other files with the same reference set
+        ref_key = self._ref_content_key(ref_array, ref_cpds)
+        if self._screen_ref is None or self._screen_ref[0] != ref_key:
+            if sps.issparse(ref_array):
+                ref = sps.csr_matrix(ref_array[:ncpds], dtype=float)
+            else:
+                ref = sps.csr_matrix(np.asarray(ref_array[:ncpds], 
+                    dtype=float))
+            self._screen_ref = (ref_key, ref)
+        ref = self._screen_ref[1]
+        win = self.screen_win
+
+        screened = np.ones((nscans, len(ref_cpds)), dtype=bool)
+        for start in range(0, nscans, chunk):
+            stop = min(start + chunk, nscans)
+            first = max(start - win, 0)
+            last = min(stop + win, nscans)
+            inten = data.intensity_rows(slice(first, last))
+            if fit_coef is not None:
+                # The intensity rows can be a view of the data, so the
+                # residuals are a new array
+                fit = np.asarray(fit_coef[first:last], dtype=float)
+                cols = np.flatnonzero(fit.any(axis=0))
+                inten = np.asarray(inten, dtype=float) - fit[:, cols].dot(
+                        _ref_rows(ref_array, cols))
+            masks = screen_candidates(inten, ref, self.screen, win, 
+                    self.screen_mode)
+            screened[start:stop, :ncpds] = masks[start - first:stop - first]
+        return screened
+
+    def _fit_pruned_block(self, times, inten, ref_array, ref_cpds, 
+            ret_times=None, pruned=None, screened=None):
+        '''Fit a block of scans, skipping the full fit of pruned scans.
+
+        The pruned scans are fit with only the Background.
+        '''
+        if pruned is None or not pruned.any():
+            return self._fit_block(times, inten, ref_array, ref_cpds,
+                    ret_times, screened)
+
+        fits = np.zeros((len(times), len(ref_cpds)))
+        keep = ~pruned
+        iters = np.zeros(len(times), dtype=int)
+        if keep.any():
+            fits[keep] = self._fit_block(times[keep], inten[keep], ref_array,
+                    ref_cpds, ret_times, 
+                    None if screened is None else screened[keep])
+            if self._block_iters is not None:
+                iters[keep] = self._block_iters
+        if self.solver == 'warm':
+            self._block_iters = iters
+
+        if ref_cpds[-1] == 'Background':
+            # A one compound NNLS fit is a clipped projection
+            bkg = _ref_rows(ref_array, -1)
+            norm = bkg.dot(bkg)
+            if norm > 0:
+                coef = np.asarray(inten[pruned], dtype=float).dot(bkg)/norm
+                fits[pruned, -1] = np.maximum(coef, 0.)
+        return fits
+
+    def _fit_parallel(self, data, ref_array, ref_cpds, ret_times, chunk=256,
+            pruned=None, screened=None):
+        '''Fit the scans of a file with a pool of worker processes.
+
+        The scans are split into contiguous ranges, which are fit by the
+        workers using `_fit_block`. The workers write the coefficients
+        directly into shared output arrays. A sparse reference array is sent
+        to the workers with each range of scans. Returns the coefficients,
+        the fit quality metrics (see `_fit_quality`), and the solver step
+        counts (or None).
+        '''
+        nscans = data.times.size
+        inten_dtype = np.dtype(getattr(data.intensity, 'dtype', float))
+        sparse = sps.issparse(ref_array)
+        if not sparse:
+            ref_array = np.asarray(ref_array)
+        shapes = [((nscans, data.masses.size), inten_dtype),
+                ((0, 0) if sparse else ref_array.shape, ref_array.dtype),
+                ((nscans, len(ref_cpds)), np.float64),
+                ((nscans, 3), np.float64)]
+        if self.solver == 'warm':
+            shapes.append( ((nscans,), np.int64) )
+
+        blocks = []
+        arrays = []
+        try:
+            for shape, dtype in shapes:
+                size = int(np.prod(shape))*np.dtype(dtype).itemsize
+                blocks.append( shared_memory.SharedMemory(create=True, 
+                    size=max(size, 1)) )
+            arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                    for shm, (shape, dtype) in zip(blocks, shapes)]
+            # Fill the shared intensity array in blocks, so that sparse or
+            # lazy data is only expanded once
+            first = 0
+            for block_times, inten in data.iter_scans(chunk):
+                arrays[0][first:first + len(block_times)] = inten
+                first += len(block_times)
+            if not sparse:
+                arrays[1][:] = ref_array
+
+            specs = [(shm.name, arr.shape, arr.dtype.str) 
+                    for shm, arr in zip(blocks, arrays)]
+            # A few ranges per worker helps to balance the load
+            bounds = np.linspace(0, nscans, 2*self.workers + 1).astype(int)
+            pool = self._worker_pool()
+            jobs = [pool.submit(_fit_worker, self, specs, ref_cpds,
+                        ret_times, data.times[start:stop], start, stop,
+                        chunk, 
+                        None if pruned is None else pruned[start:stop],
+                        None if screened is None else screened[start:stop],
+                        ref_array if sparse else None)
+                    for start, stop in zip(bounds[:-1], bounds[1:])
+                    if stop > start]
+            # All of the jobs must finish before the shared memory is removed
+            wait(jobs)
+            try:
+                for job in jobs:
+                    job.result()
+            except BrokenProcessPool:
+                # A worker process died, so the next file starts a new pool
+                self._pool = None
+                raise
+
+            fit_coef = arrays[2].astype(self.dtype)
+            quality = arrays[3].copy()
+            fit_iters = arrays[4].astype(int) if len(arrays) > 4 else None
+        finally:
+            # The array views must be released before the blocks are closed
+            del arrays[:]
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        return fit_coef, quality, fit_iters
+
+    def _fit_block(self, times, inten, ref_array, ref_cpds, ret_times=None,
+            screened=None):
+        '''Fit a block of scans.
+
+        Parameters
+        ----------
+        times : ndarray
+            The times for the block of scans.
+
+        inten : ndarray
+            The dense (scans x masses) intensity array for the block.
+
+        ref_array : ndarray or scipy.sparse matrix
+            The (cpds x masses) reference array. This is only sparse for
+            retention time filtered or screened fits.
+
+        ref_cpds : list
+            The names of the reference compounds.
+
+        ret_times : ndarray (default None)
+            The compound retention times for retention time filtered fits.
+
+        screened : ndarray (default None)
+            The (scans x cpds) boolean array of the candidate compounds for
+            screened fits.
+
+        Returns
+        -------
+        ndarray
+            The (scans x cpds) fit coefficients.
+        '''
+        if self.rt_filter == True or screened is not None:
+            return self._masked_block(times, inten, ref_array, ref_cpds,
+                    ret_times, screened)
+
+        if self.solver == 'batch':
+            return nnls_batch(ref_array.T, inten.T).T
+
+        if self.solver == 'warm':
+            AtA, tol, junk = self._gram_matrix(ref_array)
+            AtB = np.asarray(ref_array, dtype=float).dot(inten.T)
+            return self._warm_fit(AtA, AtB, tol, A=ref_array.T,
+                    B=inten.T).T
+
+        fits = []
+        for ms in inten:
+            fit, junk = spo.nnls(ref_array.T, ms)
+            fits.append( fit )
+        return np.array( fits ).reshape(-1, len(ref_cpds))
+
     def _rt_filter_times(self, ref_cpds, ref_meta):
         '''Collect a list of retention times from metadata.'''
         rts = []
@@ -97,27 +1321,328 @@ class Nnls(Fit):
         ret_times = np.array(rts, dtype=float)
         return ret_times
 
-    def _rt_filter_fit(self, ret_times, time, ms, ref_array, ref_cpds):
-        '''Fit only compounds that are within a certain retention window.'''
-        # Create a boolean RT filter mask
-        mask = ((ret_times + self.rt_adj) > (time - self.rt_win)) & \
-                ((ret_times + self.rt_adj) < (time + self.rt_win))
-        zeros = np.zeros( len(ref_cpds) )
-        # Check if the filter has any hits
-        msum = mask.sum()
-        if msum != 0:
-            if ref_cpds[-1] == 'Background':
-                mask[-1] = True
-            ref_arr_mask = ref_array[mask]
-            fit, junk = spo.nnls(ref_arr_mask.T, ms)
-            zeros[mask] = fit
-            fit = zeros
-        # If no RT hits, fit the data with either the background or
-        # use only zeros
+    def _rt_masks(self, ret_times, times, ref_cpds):
+        '''Create the retention time filter masks for a block of scans.
+
+        Returns a (scans x cpds) boolean array of the compounds that are fit
+        in each scan. The Background is always fit, and it is the only
+        compound fit when no compounds are within the retention window.
+        '''
+        rts = ret_times + self.rt_adj
+        times = np.asarray(times, dtype=float)[:, np.newaxis]
+        masks = (rts > (times - self.rt_win)) & (rts < (times + self.rt_win))
+        if ref_cpds[-1] == 'Background':
+            masks[:, -1] = True
+        return masks
+
+    def _masked_block(self, times, inten, ref_array, ref_cpds, ret_times,
+            screened=None):
+        '''Fit a block of scans using a retention time filter and/or the
+        screened candidate compounds.
+
+        The scans with the same compound mask are fit together, using only
+        the reference compounds in that mask.
+        '''
+        fits = np.zeros((len(times), len(ref_cpds)))
+        iters = np.zeros(len(times), dtype=int)
+        if self.rt_filter == True:
+            masks = self._rt_masks(ret_times, times, ref_cpds)
+            if screened is not None:
+                masks &= screened
         else:
-            if self.ref_cpds[-1] == 'Background':
-                fit, junk = spo.nnls(ref_array[-1].reshape(-1,1),
-                        ms)
-                zeros[-1] = fit[0]
-            fit = zeros
-        return fit
+            masks = screened
+        for mask, rows in _mask_groups(masks):
+            if not mask.any():
+                continue
+            A, AtA, lipschitz = self._masked_ref(ref_array, ref_cpds, mask)
+            if self.solver in ('batch', 'warm'):
+                tol = 10*np.finfo(float).eps*\
+                        np.abs(AtA).sum(axis=0).max()*max(A.shape)
+                AtB = A.T.dot(inten[rows].T)
+            if self.solver == 'batch':
+                sub = self._solve_gram(AtA, AtB, tol, lipschitz, A=A,
+                        B=inten[rows].T).T
+            elif self.solver == 'warm':
+                # Each compound set keeps its own warm start
+                sub = self._warm_fit(AtA, AtB, tol, mask.tobytes(), A=A,
+                        B=inten[rows].T).T
+                iters[rows] = self._block_iters
+            else:
+                sub = [spo.nnls(A, inten[row])[0] for row in rows]
+            fits[np.ix_(rows, mask)] = sub
+        self._block_iters = iters if self.solver == 'warm' else None
+        return fits
+
+    def _solve_gram(self, AtA, AtB, tol, lipschitz=None, A=None, B=None):
+        '''Solve a block of scans from the reference and intensity
+        cross-products. This is used by the 'batch' solver, and subclasses
+        can replace it to use other methods. The largest eigenvalue of AtA,
+        `lipschitz`, is only given to solvers with `_use_lipschitz` set. The
+        (masses x cpds) reference array and (masses x scans) intensity
+        array, A and B, are only used for scans that `fnnls` doesn't
+        solve.'''
+        return fnnls(AtA, AtB, tol=tol, A=A, B=B)
+
+    def _warm_fit(self, AtA, AtB, tol, key=None, A=None, B=None):
+        '''Fit a block of scans with `fnnls_warm`, starting from the last
+        solution with the same key. The step counts are kept in
+        `_block_iters`.'''
+        X, self._block_iters = fnnls_warm(AtA, AtB, tol=tol, 
+                x0=self._warm_starts.get(key), A=A, B=B)
+        if X.shape[1] > 0:
+            self._warm_starts[key] = X[:, -1]
+        return X
+
+    def _gram_matrix(self, ref_array):
+        '''The reference cross-product matrix, which is kept for reuse.
+
+        Returns the matrix, the tolerance for the solvers, and its largest
+        eigenvalue (or None, if the solver doesn't use it).
+        '''
+        if self._gram is None or self._gram[0] is not ref_array:
+            ref = np.asarray(ref_array, dtype=float)
+            AtA = ref.dot(ref.T)
+            tol = 10*np.finfo(float).eps*np.abs(AtA).sum(axis=0).max()*\
+                    max(ref.shape)
+            lipschitz = _lipschitz(AtA) if self._use_lipschitz else None
+            self._gram = (ref_array, AtA, tol, lipschitz)
+        return self._gram[1:]
+
+    def _fit_ref_array(self, data):
+        '''Get the reference array for the fits of a data file, and set its
+        content key.
+
+        A sparse reference array is kept for retention time filtered or
+        screened fits, which only use a few compounds at a time. The other
+        fits need a dense array.
+        '''
+        ref_array = data.ref_array
+        if sps.issparse(ref_array) and self.rt_filter != True and \
+                self.screen is None:
+            ref_array = ref_array.toarray()
+        self._set_ref_key(data, ref_array)
+        return ref_array
+
+    def _set_ref_key(self, data, ref_array=None):
+        '''Set the content key of the compound spectra of a data file.
+
+        The key is made from the compound hashes of the data (see
+        `ref_hashes`), so that a large reference array doesn't need to be
+        hashed again for every file. Data without hashes is hashed by
+        `_ref_content_key` when the key is needed. The key is set for
+        `ref_array`, if it is given, instead of the reference array of the
+        data.
+        '''
+        self._ref_key = None
+        if ref_array is None:
+            ref_array = data.ref_array
+        ref_cpds = data.ref_cpds
+        hashes = getattr(data, 'ref_hashes', None)
+        names = ref_cpds[:-1] if ref_cpds[-1] == 'Background' else ref_cpds
+        if not hashes or any(name not in hashes for name in names):
+            return
+        sha = hashlib.sha1()
+        sha.update(repr(ref_array.shape).encode('utf-8'))
+        for name in names:
+            sha.update(hashes[name].encode('utf-8'))
+        self._ref_key = (ref_array, sha.hexdigest())
+
+    def _ref_content_key(self, ref_array, ref_cpds):
+        '''Get a content key for the compound spectra of a reference array.
+
+        This is used to share the cached reference subsets between files with
+        the same reference set. The Background row is not included.
+        '''
+        if self._ref_key is None or self._ref_key[0] is not ref_array:
+            has_bkg = ref_cpds[-1] == 'Background'
+            cpd_rows = ref_array[:-1] if has_bkg else ref_array
+            sha = hashlib.sha1()
+            sha.update(repr(ref_array.shape).encode('utf-8'))
+            if sps.issparse(cpd_rows):
+                cpd_rows = sps.csr_matrix(cpd_rows, dtype=float)
+                cpd_rows.sort_indices()
+                for comp in (cpd_rows.data, cpd_rows.indices, 
+                        cpd_rows.indptr):
+                    sha.update(np.ascontiguousarray(comp).tobytes())
+            else:
+                sha.update(np.ascontiguousarray(cpd_rows, 
+                    dtype=float).tobytes())
+            self._ref_key = (ref_array, sha.hexdigest())
+        return self._ref_key[1]
+
+    def _masked_ref(self, ref_array, ref_cpds, mask):
+        '''Get the (masses x cpds) reference matrix and its cross-product
+        matrix for the compounds in a mask.
+
+        The compound spectra are taken from the subset cache. The Background
+        row is different for every file, so it is added separately. The
+        largest eigenvalue of the cross-product matrix (or an upper bound, if
+        the Background is included) is also returned if the solver uses it;
+        otherwise, this is None.
+        '''
+        has_bkg = ref_cpds[-1] == 'Background'
+        ref_key = self._ref_content_key(ref_array, ref_cpds)
+
+        background = has_bkg and mask[-1]
+        cmask = mask.copy()
+        if has_bkg:
+            cmask[-1] = False
+        rows, AtA, lipschitz = self._subsets.get(ref_key, ref_array, cmask,
+                self._use_lipschitz)
+        if not background:
+            return rows.T, AtA, lipschitz
+
+        bkg = _ref_rows(ref_array, -1)
+        cross = rows.dot(bkg)
+        n = AtA.shape[0]
+        full = np.empty((n + 1, n + 1))
+        full[:n, :n] = AtA
+        full[:n, n] = cross
+        full[n, :n] = cross
+        full[n, n] = bkg.dot(bkg)
+        if lipschitz is not None:
+            # The largest eigenvalue of [[AtA, c], [c.T, b.b]] is at most the
+            # largest eigenvalue of [[L, |c|], [|c|, b.b]], so the subset
+            # eigenvalue can be reused
+            norm = np.sqrt(cross.dot(cross))
+            lipschitz = 0.5*(lipschitz + full[n, n] + 
+                    np.hypot(lipschitz - full[n, n], 2*norm))
+        return np.vstack([rows, bkg]).T, full, lipschitz
+
+class Fnnls(Nnls):
+    '''A fast non-negative least squares fitting object.
+
+    This gives the same fits as `Nnls`, but it uses the FNNLS method (see
+    `fnnls`). The reference cross-product matrix, ref_array*ref_array.T, is
+    only calculated once per file, and the cross-products with the intensity
+    data are calculated for a whole block of scans at once. The fits then
+    only need small (cpds x cpds) problems, rather than problems on the full
+    (masses x cpds) reference array. This always uses the 'batch' solver.
+    '''
+    def __init__(self, rt_filter=False, rt_win=0.2, rt_adj=0., quiet=False,
+            dtype=float, **kwargs):
+        solver = kwargs.setdefault('solver', 'batch')
+        if solver != 'batch':
+            error = "The {} fit only uses the 'batch' solver, not '{}'."
+            raise ValueError(error.format(type(self).__name__, solver))
+        super(Fnnls, self).__init__(rt_filter=rt_filter, rt_win=rt_win,
+                rt_adj=rt_adj, quiet=quiet, dtype=dtype, **kwargs)
+        self.fit_type = 'Fnnls'
+
+    def _fit_block(self, times, inten, ref_array, ref_cpds, ret_times=None,
+            screened=None):
+        if self.rt_filter == True or screened is not None:
+            return self._masked_block(times, inten, ref_array, ref_cpds,
+                    ret_times, screened)
+
+        AtA, tol, lipschitz = self._gram_matrix(ref_array)
+        AtB = np.asarray(ref_array, dtype=float).dot(inten.T)
+        return self._solve_gram(AtA, AtB, tol, lipschitz, A=ref_array.T,
+                B=inten.T).T
+
+
+class PgNnls(Fnnls):
+    '''A projected gradient non-negative least squares fitting object.
+
+    The scans are fit together with an accelerated projected gradient method
+    (see `nnls_pg`). This is an iterative method, so the fits are
+    approximate.
+
+    Parameters
+    ----------
+    max_iter : int (default 500)
+        The maximum number of iterations for each block of scans.
+
+    pg_tol : float (default 1e-6)
+        The relative change in the coefficients that stops the iterations.
+    '''
+    _fit_options = Fnnls._fit_options + ('max_iter', 'pg_tol')
+    _use_lipschitz = True
+
+    def __init__(self, max_iter=500, pg_tol=1e-6, **kwargs):
+        super(PgNnls, self).__init__(**kwargs)
+        self.fit_type = 'PgNnls'
+        self.max_iter = max_iter
+        self.pg_tol = pg_tol
+
+    def _solve_gram(self, AtA, AtB, tol, lipschitz=None, A=None, B=None):
+        return nnls_pg(AtA, AtB, max_iter=self.max_iter, tol=self.pg_tol,
+                lipschitz=lipschitz)
+
+
+class CdNnls(Fnnls):
+    '''A coordinate descent non-negative least squares fitting object.
+
+    The scans are fit together with a cyclic coordinate descent method (see
+    `nnls_cd`). This is an iterative method, so the fits are approximate.
+
+    Parameters
+    ----------
+    max_iter : int (default 200)
+        The maximum number of sweeps over the compounds.
+
+    cd_tol : float (default 1e-6)
+        The relative change in the coefficients that stops the sweeps.
+    '''
+    _fit_options = Fnnls._fit_options + ('max_iter', 'cd_tol')
+
+    def __init__(self, max_iter=200, cd_tol=1e-6, **kwargs):
+        super(CdNnls, self).__init__(**kwargs)
+        self.fit_type = 'CdNnls'
+        self.max_iter = max_iter
+        self.cd_tol = cd_tol
+
+    def _solve_gram(self, AtA, AtB, tol, lipschitz=None, A=None, B=None):
+        return nnls_cd(AtA, AtB, max_iter=self.max_iter, tol=self.cd_tol)
+
+
+class LstsqClip(Fnnls):
+    '''An unconstrained least squares fitting object.
+
+    The scans are fit with ordinary least squares, and the negative
+    coefficients are set to zero. This is very fast, but it is only a rough
+    approximation of the non-negative fit when compounds overlap.
+    '''
+    def __init__(self, **kwargs):
+        super(LstsqClip, self).__init__(**kwargs)
+        self.fit_type = 'LstsqClip'
+
+    def _solve_gram(self, AtA, AtB, tol, lipschitz=None, A=None, B=None):
+        X = np.linalg.lstsq(AtA, AtB, rcond=None)[0]
+        return np.maximum(X, 0.)
+
+
+# The fitting objects that can be selected by name, e.g. in `proc_data`
+fit_types = {
+        'nnls': Nnls,
+        'fnnls': Fnnls,
+        'pgnnls': PgNnls,
+        'cdnnls': CdNnls,
+        'lstsq-clip': LstsqClip,
+        }
+
+def register_fit(name, fitclass):
+    '''Add a fitting object to the `fit_types` registry.
+
+    Parameters
+    ----------
+    name : str
+        The name for the fitting object. Names are not case sensitive.
+
+    fitclass : Fit subclass
+        The fitting object. It must accept the same keyword arguments as
+        `Nnls`, and extra keywords should be ignored.
+    '''
+    if not (isinstance(fitclass, type) and issubclass(fitclass, Fit)):
+        raise TypeError("The fitting object must be a Fit subclass.")
+    fit_types[name.lower()] = fitclass
+
+def get_fit(name, **kwargs):
+    '''Create a fitting object from its name in the `fit_types` registry.
+    The keyword arguments are passed to the fitting object.'''
+    try:
+        fitclass = fit_types[name.lower()]
+    except KeyError:
+        error = "Unknown fit type '{}'. Use one of: {}"
+        raise ValueError(error.format(name, ', '.join(sorted(fit_types))))
+    return fitclass(**kwargs)
@@ -1,4 +1,5 @@
 import os
+import copy
 from urllib.request import urlopen
 
 from IPython.parallel import Client, interactive
@@ -27,7 +28,8 @@ def get_sample_data(fname=None):
 
 def proc_data(data_folder, h5name, multiproc=False, chunk_size=4,
         filetype='aia', reffile=None, fittype=None, calfile=None,
-        picts=False, **kwargs):
+        picts=False, io_workers=None, fit_workers=None, incremental=False,
+        **kwargs):
 
     if filetype == 'aia':
         GcmsObj = gcf.AiaFile
@@ -41,14 +43,29 @@ def proc_data(data_folder, h5name, multiproc=False, chunk_size=4,
     if reffile:
         if reffile.endswith(('txt', 'TXT')):
             ref = gcr.TxtReference(reffile, **kwargs)
+        elif reffile.endswith(('msl', 'MSL')):
+            ref = gcr.MslReference(reffile, **kwargs)
+        elif reffile.endswith(('msp', 'MSP')):
+            ref = gcr.MspReference(reffile, **kwargs)
     
     fit = None
     if fittype:
-        if fittype.lower() == 'nnls':
-            fit = gcfit.Nnls(**kwargs)
+        fit = gcfit.get_fit(fittype, workers=fit_workers, **kwargs)
 
     h5 = gcd.GcmsStore(h5name, **kwargs)
 
+    # Files that are already stored are updated from the stored data, and
+    # only the parts affected by reference changes are refit
+    if incremental and ref and fit:
+        stored = [f for f in files if h5._gcms_name_fix(f) in h5.data]
+        for f in stored:
+            data = h5.extract_gcms(f)
+            prev = copy.copy(data)
+            ref(data)
+            fit.refit(data, prev)
+            h5.append_gcms(data)
+        files = [f for f in files if f not in stored]
+
     if multiproc:
         try:
             client = Client()
@@ -66,15 +83,30 @@ def proc_data(data_folder, h5name, multiproc=False, chunk_size=4,
         dview['ref'] = ref
         dview['fit'] = fit
         dview['GcmsObj'] = GcmsObj
+        # Each engine only returns the shared reference data once (see
+        # gcmstools.reference.pack_ref)
+        dview.execute('import gcmstools.reference as gcr')
+        dview['ref_sent'] = set()
+        shared_refs = {}
         chunk_size = len(dview)
 
+    # Read the files using a pool of threads, which overlaps the file reading
+    # and decoding. The next chunk of files is read during processing.
+    elif io_workers:
+        reader = gcf.iter_many(files, filetype=GcmsObj, workers=io_workers,
+                prefetch=chunk_size, **kwargs)
+
     # Chunk the data so lots of data files aren't opened in memory.
     for chunk in _chunker(files, chunk_size):
         if multiproc:
             datafiles = dview.map_sync(_proc_file, 
                     [(i, kwargs) for i in chunk])
+            gcr.unpack_refs(datafiles, shared_refs)
         else:
-            datafiles = [GcmsObj(f, **kwargs) for f in chunk]
+            if io_workers:
+                datafiles = [next(reader) for f in chunk]
+            else:
+                datafiles = [GcmsObj(f, **kwargs) for f in chunk]
             if ref:
                 ref(datafiles)
             if fit:
@@ -87,6 +119,10 @@ def proc_data(data_folder, h5name, multiproc=False, chunk_size=4,
         cal.curvegen(calfile, picts=picts, **kwargs)
         cal.datagen(picts=picts, **kwargs)
 
+    if fit:
+        # Stop the fit worker processes
+        fit.close()
+
     h5.compress()
 
 # This function is from: http://stackoverflow.com/questions/434287
@@ -103,6 +139,8 @@ def _proc_file(file_kwargs):
         ref(datafile)
     if fit:
         fit(datafile)
+    if ref:
+        gcr.pack_ref(datafile, ref_sent)
     return datafile
 
 
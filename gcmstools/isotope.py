@@ -203,12 +203,12 @@ class Isotope(object):
         if not self.stop:
             # Just grab a single slice
             idx = gcms.index(gcms.times, self.start)
-            ms = gcms.intensity[idx]
+            ms = gcms.intensity_rows(idx)
             return ms/ms.max()
         else:
             # Select a range of MS spectra
             mask = (gcms.times > self.start) & (gcms.times < self.stop)
-            region = gcms.intensity[mask]
+            region = gcms.intensity_rows(mask)
             if self.rmbkg and self.stop:
                 # Subtract the first MS
                 region = region - region[0]
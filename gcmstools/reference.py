@@ -1,23 +1,452 @@
+import os
 import re
-from copy import deepcopy
+import copy
+import json
+import collections
+import collections.abc
+import array
+import hashlib
 
 import numpy as np
+import scipy.sparse as sps
 
 import gcmstools.filetypes as gcf
+from gcmstools.cache import ArrayCache, file_digest
+
+# The version of the compiled reference library format. This is part of the
+# cache key, so it must be increased whenever the parsed arrays or metadata
+# change; otherwise, libraries compiled by an older parser are still loaded.
+_cache_version = 2
+
+def ref_hashes(ref_array, ref_cpds, ref_meta, known=None):
+    '''Calculate content hashes for a set of reference compounds.
+
+    The hash of each compound covers the parts of the reference that change
+    a fit: the reference spectrum and the retention time.
+
+    Parameters
+    ----------
+    ref_array : ndarray or scipy.sparse matrix
+        The (cpds x masses) reference array. The hashes of a sparse array are
+        the same as for the dense array.
+
+    ref_cpds : list
+        The names of the reference compounds.
+
+    ref_meta : dict
+        The reference metadata dictionaries for each compound.
+
+    known : dict (default None)
+        Hashes that are already known for some of the compounds. These are
+        not calculated again.
+
+    Returns
+    -------
+    (str, dict)
+        The hash of the full reference set and a dictionary of the hashes for
+        each compound.
+    '''
+    known = known or {}
+    ref_cpds = ref_cpds[:ref_array.shape[0]]
+    # Only the rows of the unknown compounds are used
+    todo = [num for num, name in enumerate(ref_cpds) if name not in known]
+    if sps.issparse(ref_array):
+        rows = _dense_rows(sps.csr_matrix(ref_array)[todo])
+    else:
+        rows = (ref_array[num] for num in todo)
+    new = {}
+    for num, row in zip(todo, rows):
+        name = ref_cpds[num]
+        sha = hashlib.sha1()
+        sha.update(np.ascontiguousarray(row, dtype=float).tobytes())
+        rt = ref_meta.get(name, {}).get('RT')
+        sha.update(repr(rt).encode('utf-8'))
+        new[name] = sha.hexdigest()
+
+    hashes = {}
+    total = hashlib.sha1()
+    for name in ref_cpds:
+        hashes[name] = new[name] if name in new else known[name]
+        total.update(name.encode('utf-8'))
+        total.update(hashes[name].encode('utf-8'))
+    return total.hexdigest(), hashes
+
+def _dense_rows(matrix):
+    '''Iterate over the rows of a CSR matrix as dense (float) arrays.
+
+    The same array is reused for every row, so it should not be kept.
+    '''
+    row = np.zeros(matrix.shape[1])
+    for start, stop in zip(matrix.indptr[:-1], matrix.indptr[1:]):
+        cols = matrix.indices[start:stop]
+        row[cols] = matrix.data[start:stop]
+        yield row
+        row[cols] = 0.
+
+# Metadata that is added to each data file by the fits
+_file_meta = ('integral',)
+
+
+class RefMeta(collections.abc.Mapping):
+    '''The reference metadata of a data file.
+
+    The static metadata of the library compounds is shared with the
+    reference object (and the other data files), so it is not copied for
+    every file. Each compound entry is a dictionary-like object. Values that
+    are set in an entry, such as the fit integrals, are stored in a per-file
+    overlay, and the shared metadata is never changed. Entries that are only
+    in the overlay (the Background) belong to this file.
+
+    Parameters
+    ----------
+    shared : dict
+        The shared metadata dictionaries for each compound.
+
+    local : dict (default None)
+        The per-file metadata dictionaries, which are changed in place.
+    '''
+    def __init__(self, shared, local=None):
+        self.shared = shared
+        self.local = {} if local is None else local
+
+    def __getitem__(self, name):
+        if name in self.shared:
+            return _CpdMeta(self.shared[name], self.local, name)
+        return self.local[name]
+
+    def __contains__(self, name):
+        return name in self.shared or name in self.local
+
+    def __iter__(self, ):
+        for name in self.shared:
+            yield name
+        for name in self.local:
+            if name not in self.shared:
+                yield name
+
+    def __len__(self, ):
+        return len(self.shared) + sum(1 for name in self.local 
+                if name not in self.shared)
+
+    def __repr__(self, ):
+        return "{}({!r})".format(self.__class__.__name__, dict(self.items()))
+
+
+class _CpdMeta(collections.abc.MutableMapping):
+    '''The metadata of one compound in a RefMeta object.
+
+    The values in the per-file overlay replace the shared values.
+    '''
+    def __init__(self, shared, local, name):
+        self._shared = shared
+        self._local = local
+        self._name = name
+
+    def __getitem__(self, key):
+        vals = self._local.get(self._name)
+        if vals is not None and key in vals:
+            return vals[key]
+        return self._shared[key]
+
+    def __setitem__(self, key, val):
+        self._local.setdefault(self._name, {})[key] = val
+
+    def __delitem__(self, key):
+        vals = self._local.get(self._name, {})
+        if key in vals:
+            del vals[key]
+        elif key in self._shared:
+            raise TypeError("The shared reference metadata can't be changed.")
+        else:
+            raise KeyError(key)
+
+    def __iter__(self, ):
+        vals = self._local.get(self._name, {})
+        for key in self._shared:
+            yield key
+        for key in vals:
+            if key not in self._shared:
+                yield key
+
+    def __len__(self, ):
+        vals = self._local.get(self._name, {})
+        return len(self._shared) + sum(1 for key in vals 
+                if key not in self._shared)
+
+    def __repr__(self, ):
+        return repr(dict(self.items()))
+
+
+def split_ref(data):
+    '''Split the reference data of a data file into shared and per-file parts.
+
+    The compound part of the reference data (the spectra, names, metadata,
+    and hashes) is the same for every file processed with the same reference
+    object, so it only needs to be stored or sent once. The Background
+    spectrum and the metadata added to each file (the Background information
+    and the fit integrals) are kept with each file. See `join_ref`.
+
+    Parameters
+    ----------
+    data : GcmsFile
+        A data file with reference information.
+
+    Returns
+    -------
+    (str, dict, dict)
+        A content hash of the shared part, the shared part, and the per-file
+        part. Both parts are dictionaries with "ref_array", "ref_cpds",
+        "ref_meta", and "ref_hashes" keys. The shared "ref_array" is sparse if
+        the reference array of the file is sparse; the per-file one is always
+        dense.
+    '''
+    memo = _shared_memo(data)
+    if memo is not None:
+        return memo.key, memo.parts, _split_local(data, memo.parts)
+
+    cpds = list(data.ref_cpds)
+    ncpds = len(cpds)
+    if cpds and cpds[-1] == 'Background':
+        ncpds -= 1
+    ref_array = data.ref_array
+    if sps.issparse(ref_array):
+        ref_array = sps.csr_matrix(ref_array)
+        local_array = ref_array[ncpds:].toarray()
+    else:
+        ref_array = np.asarray(ref_array)
+        local_array = ref_array[ncpds:]
+    hashes = getattr(data, 'ref_hashes', None) or {}
+    shared_cpds = set(cpds[:ncpds])
+
+    shared = {'ref_array': ref_array[:ncpds], 'ref_cpds': cpds[:ncpds],
+            'ref_meta': {}, 'ref_hashes': {}}
+    local = {'ref_array': local_array, 'ref_cpds': cpds[ncpds:],
+            'ref_meta': {}, 'ref_hashes': {}}
+    for name, meta in data.ref_meta.items():
+        if name not in shared_cpds:
+            local['ref_meta'][name] = meta
+            continue
+        shared['ref_meta'][name] = dict((key, val) for key, val in 
+                meta.items() if key not in _file_meta)
+        file_meta = dict((key, val) for key, val in meta.items() 
+                if key in _file_meta)
+        if file_meta:
+            local['ref_meta'][name] = file_meta
+    for name, val in hashes.items():
+        part = shared if name in shared_cpds else local
+        part['ref_hashes'][name] = val
+    return _shared_key(shared), shared, local
+
+def _shared_key(shared):
+    '''Calculate the content hash of the shared part of the reference
+    data.'''
+    sha = hashlib.sha1()
+    shared_array = shared['ref_array']
+    sha.update(repr((shared_array.dtype.str, 
+        shared_array.shape)).encode('utf-8'))
+    if sps.issparse(shared_array):
+        shared_array.sort_indices()
+        sha.update(b'csr')
+        sha.update(np.ascontiguousarray(shared_array.data).tobytes())
+        # The index type depends on how the matrix was built
+        for comp in (shared_array.indices, shared_array.indptr):
+            sha.update(np.asarray(comp, dtype=np.int64).tobytes())
+    else:
+        sha.update(np.ascontiguousarray(shared_array).tobytes())
+    info = [shared['ref_cpds'], shared['ref_meta'], shared['ref_hashes']]
+    sha.update(json.dumps(info, sort_keys=True, default=repr).encode('utf-8'))
+    return sha.hexdigest()
+
+def _shared_memo(data):
+    '''Get the memoized shared part of the reference data of a file.
+
+    Returns None if the file has no memo, or if its reference data no longer
+    matches the memo.
+    '''
+    memo = getattr(data, '_ref_shared', None)
+    meta = getattr(data, 'ref_meta', None)
+    if memo is None or not isinstance(meta, RefMeta) or \
+            meta.shared is not memo.parts['ref_meta']:
+        return None
+    cpds = memo.parts['ref_cpds']
+    if data.ref_cpds[:len(cpds)] != cpds or \
+            data.ref_array.shape[0] < len(cpds):
+        return None
+    # Values set for the shared compounds must be per-file values
+    for name, vals in meta.local.items():
+        if name in meta.shared and not set(vals).issubset(_file_meta):
+            return None
+    return memo
+
+def _split_local(data, shared):
+    '''Get the per-file part of the reference data for a known shared
+    part. See `split_ref`.'''
+    ncpds = len(shared['ref_cpds'])
+    local_array = data.ref_array[ncpds:]
+    if sps.issparse(local_array):
+        local_array = local_array.toarray()
+    local_cpds = list(data.ref_cpds[ncpds:])
+    hashes = getattr(data, 'ref_hashes', None) or {}
+    local = {'ref_array': np.asarray(local_array), 'ref_cpds': local_cpds,
+            'ref_meta': {}, 'ref_hashes': {}}
+    for name, vals in data.ref_meta.local.items():
+        if vals or name not in shared['ref_meta']:
+            local['ref_meta'][name] = dict(vals)
+    for name in local_cpds:
+        if name in hashes:
+            local['ref_hashes'][name] = hashes[name]
+    return local
+
+
+class _SharedRef(object):
+    '''The shared part of the reference data of data files (see
+    `split_ref`).
+
+    The same object is kept by all of the files that share the data, so the
+    content hash, `key`, is only calculated once.
+    '''
+    def __init__(self, parts, key=None):
+        self.parts = parts
+        self._key = key
+
+    @property
+    def key(self, ):
+        if self._key is None:
+            self._key = _shared_key(self.parts)
+        return self._key
+
+def join_ref(data, shared, local, key=None):
+    '''Add reference data that was split by `split_ref` to a data file.
+
+    Parameters
+    ----------
+    data : GcmsFile
+        The data file.
+
+    shared : dict
+        The shared part of the reference data, which is not copied.
+
+    local : dict
+        The per-file part of the reference data.
+
+    key : str (default None)
+        The content hash of the shared part. If this is given, it is kept, so
+        that `split_ref` doesn't need to calculate it again.
+    '''
+    if sps.issparse(shared['ref_array']):
+        data.ref_array = sps.vstack([shared['ref_array'], 
+            sps.csr_matrix(local['ref_array'])], format='csr')
+    else:
+        data.ref_array = np.concatenate([shared['ref_array'], 
+            local['ref_array']])
+    data.ref_cpds = shared['ref_cpds'] + local['ref_cpds']
+    data.ref_meta = RefMeta(shared['ref_meta'], dict((name, dict(vals)) 
+        for name, vals in local['ref_meta'].items()))
+    if shared['ref_hashes'] or local['ref_hashes']:
+        hashes = dict(shared['ref_hashes'])
+        hashes.update(local['ref_hashes'])
+        data.ref_hashes = hashes
+    if key is not None:
+        data._ref_shared = _SharedRef(shared, key)
+
+def pack_ref(data, sent):
+    '''Remove the shared reference data before a file is sent to another
+    process.
+
+    The shared part is only kept the first time it is sent. See
+    `unpack_refs`.
+
+    Parameters
+    ----------
+    data : GcmsFile
+        The data file. The reference attributes are replaced by a private
+        `_ref_parts` attribute.
+
+    sent : set
+        The keys of the shared reference data that were already sent by this
+        process. This is updated.
+    '''
+    key, shared, local = split_ref(data)
+    if key in sent:
+        shared = None
+    sent.add(key)
+    for attr in ('ref_array', 'ref_cpds', 'ref_meta', 'ref_hashes',
+            '_ref_shared'):
+        if hasattr(data, attr):
+            delattr(data, attr)
+    data._ref_parts = (key, shared, local)
+
+def unpack_refs(datafiles, shared_refs):
+    '''Restore the reference data of files that were packed by `pack_ref`.
+
+    Parameters
+    ----------
+    datafiles : list
+        The data files, which are changed in place.
+
+    shared_refs : dict
+        The shared reference data that is already known, keyed by the
+        content hash. This is updated with the shared parts of these files.
+    '''
+    packed = [data for data in datafiles if hasattr(data, '_ref_parts')]
+    for data in packed:
+        key, shared, local = data._ref_parts
+        if shared is not None:
+            shared_refs.setdefault(key, shared)
+    for data in packed:
+        key, shared, local = data._ref_parts
+        del data._ref_parts
+        join_ref(data, shared_refs[key], local, key)
+
 
 class ReferenceFileGeneric(object):
     '''Generic object that defines refernce file methods.
     
     Requires subclass objects that have a _ref_entry_proc method that processes
     the reference mass/intensity information.
+
+    The parsed reference library is cached in a compiled (binary) form, which
+    is loaded (memory-mapped) instead of parsing the file again if the file
+    contents have not changed. The `cache` keyword argument can be True (use a
+    ".gcmstools" folder next to the reference file), the name of a cache
+    folder, an ArrayCache instance, or False to turn off the cache. If the
+    cache folder can't be written, the file is simply parsed.
+
+    The spectra are stored as concatenated arrays, so very large libraries
+    can be loaded. Use the `select` keyword argument (a dictionary of keyword
+    arguments for the `select` method) to keep only some of the compounds.
+    The `sparse_ref` keyword sets whether the `ref_array` of the data files
+    is a sparse (CSR) matrix: True, False, or None (the default) to use a
+    sparse array for libraries of more than `sparse_min` compounds. A dense
+    array of a large library is never built.
     '''
-    def __init__(self, ref_file, bkg=True, bkg_time=0., quiet=False, **kwargs):
+    # The number of mass axes that keep a compound reference array
+    _max_cpd_arrays = 4
+    # Larger libraries use a sparse reference array by default
+    sparse_min = 2000
+
+    def __init__(self, ref_file, bkg=True, bkg_time=0., quiet=False,
+            dtype=float, cache=True, select=None, sparse_ref=None, **kwargs):
         self.ref_file = ref_file
         self.bkg = bkg
         self.bkg_time = bkg_time
+        self.dtype = np.dtype(dtype)
+        self.sparse_ref = sparse_ref
         self._quiet = quiet
 
+        if cache is True:
+            folder = os.path.dirname(os.path.abspath(ref_file))
+            cache = os.path.join(folder, '.gcmstools')
+        if isinstance(cache, str):
+            try:
+                cache = ArrayCache(cache)
+            except OSError:
+                cache = None
+        self._cache = cache or None
+
         self._ref_build()
+        if select:
+            self._ref_subset(self._select_idx(**select))
 
     def __call__(self, datafiles):
         if isinstance(datafiles, gcf.GcmsFile):
@@ -31,34 +460,31 @@ class ReferenceFileGeneric(object):
         if not self._quiet:
             print("Referencing: {}".format(data.filename))
 
-        ref_array = []
-        data_min = data.masses.min()
-        data_max = data.masses.max()
-        spec = np.empty(data.masses.size, dtype=float)
-
-        # Generate the reference spectrum over the mass range defined by the
-        # data.
-        for mass, inten in self.ref_mass_inten:
-            spec[:] = 0.
-            mask = (mass > data_min) & (mass < data_max)
-            mass_mask = mass[mask] - data_min
-            inten_mask = inten[mask]
-
-            spec[mass_mask] = inten_mask
-            ref_array.append( spec/spec.max() )
+        cpd_array, cpd_hashes, shared = self._cpd_array(data)
+        ncpds = cpd_array.shape[0]
 
         # Add a background spectrum to the reference array
         if self.bkg == True:
             times = data.times
-            inten = data.intensity
             bkg_idx = data.index(times, self.bkg_time)
-            bkg = inten[bkg_idx]/inten[bkg_idx].max()
-            ref_array.append( bkg )
+            bkg_ms = data.intensity_rows(bkg_idx)
+            bkg_ms = (bkg_ms/bkg_ms.max()).astype(self.dtype)
+
+            if sps.issparse(cpd_array):
+                ref_array = sps.vstack([cpd_array, 
+                    sps.csr_matrix(bkg_ms[np.newaxis])], format='csr')
+            else:
+                ref_array = np.empty((ncpds + 1, cpd_array.shape[1]), 
+                        dtype=self.dtype)
+                ref_array[:ncpds] = cpd_array
+                ref_array[ncpds] = bkg_ms
 
             bkg_dict = {'bkg_time': self.bkg_time,
                     'bkg_idx': bkg_idx, 
                     }
             self.ref_meta['Background'] = bkg_dict
+        else:
+            ref_array = cpd_array.copy()
 
         # Remove Background if present. This may be necessary if the object is
         # modified in some way, but usually not a problem
@@ -66,14 +492,286 @@ class ReferenceFileGeneric(object):
             self.ref_meta.pop('Background')
         
         data.ref_type = self.ref_type
-        data.ref_array = np.array(ref_array)
-        data.ref_meta = deepcopy(self.ref_meta)
-        data.ref_cpds = deepcopy(self.ref_cpds)
+        data.ref_array = ref_array
+        # The library metadata is shared. The Background information and the
+        # fit integrals are kept for each file.
+        local = {}
+        if 'Background' in self.ref_meta:
+            local['Background'] = dict(self.ref_meta['Background'])
+        data.ref_meta = RefMeta(self._cpd_meta(), local)
+        data.ref_cpds = list(self.ref_cpds)
+        data.ref_hash, data.ref_hashes = ref_hashes(data.ref_array, 
+                data.ref_cpds, data.ref_meta, known=cpd_hashes)
+        # The shared part for `split_ref`, which is the same for every file
+        # with this mass axis
+        data._ref_shared = shared
+
+    @property
+    def ref_mass_inten(self, ):
+        '''A list of (mass, intensity) arrays for each reference compound.'''
+        offsets = self._ref_offsets
+        return [(self._ref_masses[start:stop], self._ref_intens[start:stop])
+                for start, stop in zip(offsets[:-1], offsets[1:])]
+
+    def select(self, names=None, rt=None, query=None):
+        '''Create a reference object for a subset of the compounds.
+
+        Only the compounds that match all of the given conditions are kept.
+        The Background compound (if used) is always kept.
+
+        Parameters
+        ----------
+        names : list of str (default None)
+            The names of the compounds to keep.
+
+        rt : (float, float) (default None)
+            The retention time range. Compounds without an "RT" value are
+            removed.
+
+        query : dict or callable (default None)
+            A dictionary of metadata labels and values that must match, which
+            are compared as strings. Or a function that takes the metadata
+            dictionary of a compound and returns True to keep the compound.
+
+        Returns
+        -------
+        Reference object
+            A new object of the same type. The original object is not
+            changed.
+        '''
+        ref = copy.copy(self)
+        ref._ref_subset(self._select_idx(names, rt, query))
+        return ref
+
+    def sparse_ref_array(self, data):
+        '''Create a sparse reference array for the masses of a data file.
+
+        This is the same as the compound part of the `ref_array` that is
+        added to the data file when `sparse_ref` is used. A sparse (CSR)
+        matrix is much smaller for large libraries.
+
+        Parameters
+        ----------
+        data : GcmsFile
+            The data file that defines the masses.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            The normalized (cpds x masses) reference array. The Background is
+            not included.
+        '''
+        return self._cpd_array(data, sparse=True)[0].copy()
+
+    def _select_idx(self, names=None, rt=None, query=None):
+        '''Find the indices of the compounds that match a selection.'''
+        ncpds = self._ref_offsets.size - 1
+        cpds = self.ref_cpds[:ncpds]
+        keep = np.ones(ncpds, dtype=bool)
+
+        if names is not None:
+            names = set(names)
+            missing = names.difference(cpds)
+            if missing:
+                raise ValueError("Unknown reference compounds: " + 
+                        ", ".join(sorted(missing)))
+            keep &= [name in names for name in cpds]
+
+        if rt is not None:
+            keep &= [_in_range(self.ref_meta[name].get('RT'), rt) 
+                    for name in cpds]
+
+        if callable(query):
+            keep &= [bool(query(self.ref_meta[name])) for name in cpds]
+        elif query is not None:
+            query = dict((label, str(val)) for label, val in query.items())
+            keep &= [all(self.ref_meta[name].get(label) == val 
+                for label, val in query.items()) for name in cpds]
+
+        return np.flatnonzero(keep)
+
+    def _ref_subset(self, idx):
+        '''Keep only the reference compounds with the given indices.'''
+        offsets = self._ref_offsets
+        ncpds = offsets.size - 1
+        starts = offsets[idx]
+        sizes = offsets[idx + 1] - starts
+        new_offsets = np.zeros(idx.size + 1, dtype=np.int64)
+        np.cumsum(sizes, out=new_offsets[1:])
+        peaks = np.arange(new_offsets[-1]) + \
+                np.repeat(starts - new_offsets[:-1], sizes)
+
+        self._ref_masses = self._ref_masses[peaks]
+        self._ref_intens = self._ref_intens[peaks]
+        self._ref_offsets = new_offsets
+
+        cpds = [self.ref_cpds[i] for i in idx]
+        meta = dict((name, self.ref_meta[name]) for name in cpds)
+        if 'Background' in self.ref_meta:
+            meta['Background'] = self.ref_meta['Background']
+        self.ref_cpds = cpds + self.ref_cpds[ncpds:]
+        self.ref_meta = meta
+
+        self._ref_rows = None
+        self._cpd_arrays = collections.OrderedDict()
+        self._shared_meta = None
+
+    def _ref_peaks(self, data):
+        '''Find the library peaks inside the mass range of a data file.
+
+        The peaks are binned with the MassBinner of the data file, so they
+        land in the same mass bins as the data, and the peaks of a compound
+        in the same bin are combined with the same reduction as the data.
+        Files without a binner use the closest mass. Returns the compound
+        (row) index, the mass (column) index, and the intensity of each peak.
+        '''
+        if self._ref_rows is None:
+            self._ref_rows = np.repeat(np.arange(self._ref_offsets.size - 1),
+                    np.diff(self._ref_offsets))
+
+        masses = data.masses
+        mass = self._ref_masses
+        binner = getattr(data, '_binner', None)
+        if binner is None:
+            mask = (mass > masses.min()) & (mass < masses.max())
+            cols = data.index(masses, mass[mask])
+            return self._ref_rows[mask], cols, self._ref_intens[mask]
+
+        cols = binner.bin_index(mass) - binner.bin_index(masses[:1])[0]
+        mask = (cols >= 0) & (cols < masses.size)
+        flat = self._ref_rows[mask]*masses.size + cols[mask]
+        bins, inverse = np.unique(flat, return_inverse=True)
+        inten = binner.reduce_bins(inverse.ravel(), self._ref_intens[mask],
+                bins.size)
+        rows, cols = np.divmod(bins, masses.size)
+        return rows, cols, inten
+
+    def _cpd_meta(self, ):
+        '''The metadata dictionaries of the compounds (not the Background),
+        which are shared by the data files.'''
+        if self._shared_meta is None:
+            self._shared_meta = dict((name, meta) for name, meta in 
+                    self.ref_meta.items() if name != 'Background')
+        return self._shared_meta
+
+    def _use_sparse(self):
+        '''Check if the reference arrays should be sparse.'''
+        if self.sparse_ref is None:
+            return self._ref_offsets.size - 1 > self.sparse_min
+        return bool(self.sparse_ref)
+
+    def _cpd_array(self, data, sparse=None):
+        '''Get the compound part of the reference array for a mass axis.
+
+        The array is sparse (CSR) if `sparse` is True; if it is None, this is
+        set by `_use_sparse`. The arrays are cached for each mass axis (and
+        mass binner), because most of the data files in a batch have the
+        same masses. Only the `_max_cpd_arrays` most recently used mass axes
+        are kept. (Dense arrays are only used for small libraries.) The array
+        should not be modified. The content hashes of the compounds and the
+        shared reference data for `split_ref` (a _SharedRef object) are also
+        returned.
+        '''
+        if sparse is None:
+            sparse = self._use_sparse()
+        masses = data.masses
+        key = (sparse, masses.min(), masses.max(), masses.size,
+                repr(getattr(data, '_binner', None)))
+        cached = self._cpd_arrays.pop(key, None)
+        if cached is not None and np.array_equal(cached[0], masses):
+            # Reinsert to mark as recently used
+            self._cpd_arrays[key] = cached
+            return cached[1:]
+
+        # Generate the reference spectra over the mass range defined by the
+        # data.
+        rows, cols, inten = self._ref_peaks(data)
+        ncpds = self._ref_offsets.size - 1
+        if sparse:
+            # Repeated masses (only for files without a binner) keep the last
+            # value, as in the dense array
+            flat = rows*masses.size + cols
+            last = np.unique(flat[::-1], return_index=True)[1]
+            keep = flat.size - 1 - last
+            cpd_array = sps.csr_matrix((inten[keep], 
+                (rows[keep], cols[keep])), shape=(ncpds, masses.size),
+                dtype=float)
+            scale = cpd_array.max(axis=1).toarray().ravel()
+            scale[scale == 0.] = 1.
+            cpd_array.data /= np.repeat(scale, np.diff(cpd_array.indptr))
+            cpd_array = cpd_array.astype(self.dtype)
+        else:
+            spec = np.zeros((ncpds, masses.size), dtype=float)
+            spec[rows, cols] = inten
+            spec /= spec.max(axis=1, initial=0.)[:, np.newaxis]
+            cpd_array = spec.astype(self.dtype, copy=False)
+        cpd_hashes = ref_hashes(cpd_array, self.ref_cpds, self.ref_meta)[1]
+        shared = _SharedRef({'ref_array': cpd_array, 
+            'ref_cpds': self.ref_cpds[:ncpds], 'ref_meta': self._cpd_meta(),
+            'ref_hashes': cpd_hashes})
+
+        self._cpd_arrays[key] = (masses.copy(), cpd_array, cpd_hashes, shared)
+        while len(self._cpd_arrays) > self._max_cpd_arrays:
+            self._cpd_arrays.popitem(last=False)
+        return cpd_array, cpd_hashes, shared
         
     def _ref_build(self, ):
-        self.ref_mass_inten = []
+        key = None
+        cached = None
+        if self._cache is not None:
+            key = self._cache.key(type(self).__name__, _cache_version,
+                    file_digest(self.ref_file))
+            cached = self._cache.load(key)
+
+        if cached is not None:
+            self._ref_restore(*cached)
+        else:
+            self._ref_parse()
+            if key is not None:
+                self._ref_save(key)
+
+        if self.bkg == True:
+            self.ref_cpds.append( 'Background' )
+
+        # Compound reference arrays for each mass axis
+        self._ref_rows = None
+        self._cpd_arrays = collections.OrderedDict()
+        self._shared_meta = None
+
+    def _ref_save(self, key):
+        '''Save the parsed reference library into the cache.'''
+        arrays = {
+                'masses': self._ref_masses,
+                'intens': self._ref_intens,
+                'offsets': self._ref_offsets,
+                }
+        info = {'ref_cpds': self.ref_cpds, 'ref_meta': self.ref_meta}
+        try:
+            self._cache.save(key, arrays, info)
+        except OSError:
+            # The cache is optional
+            pass
+
+    def _ref_restore(self, arrays, info):
+        '''Restore the parsed reference library from the cache.'''
+        self._ref_masses = arrays['masses']
+        self._ref_intens = arrays['intens']
+        self._ref_offsets = arrays['offsets']
+        self.ref_cpds = list(info['ref_cpds'])
+        self.ref_meta = info['ref_meta']
+
+    def _ref_parse(self, ):
+        '''Parse the reference file.
+
+        The file is read one line at a time. The spectra are stored as
+        concatenated mass and intensity arrays, with an array of the starting
+        offset for each compound.
+        '''
         self.ref_cpds = []
         self.ref_meta = {}
+        self._mass_buf = array.array('q')
+        self._inten_buf = array.array('d')
+        offsets = array.array('q')
 
         fname = self.ref_file
         f = open(fname)
@@ -91,6 +789,7 @@ class ReferenceFileGeneric(object):
                 name = sp[1]
                 self.ref_cpds.append(name)
                 self.ref_meta[name] = {}
+                offsets.append(len(self._mass_buf))
             elif sp[0].lower() == "num peaks":
                 line = self._ref_entry_proc(f, name=name)
                 if line:
@@ -100,8 +799,27 @@ class ReferenceFileGeneric(object):
             else:
                 self.ref_meta[name][sp[0]] = sp[1]
 
-        if self.bkg == True:
-            self.ref_cpds.append( 'Background' )
+        f.close()
+
+        offsets.append(len(self._mass_buf))
+        self._ref_masses = np.frombuffer(self._mass_buf, dtype=np.int64)
+        self._ref_intens = np.frombuffer(self._inten_buf, dtype=float)
+        self._ref_offsets = np.frombuffer(offsets, dtype=np.int64)
+        del self._mass_buf, self._inten_buf
+
+    def _add_peaks(self, mass, inten):
+        '''Add the peaks of the current compound while parsing.'''
+        self._mass_buf.extend(map(int, mass))
+        self._inten_buf.extend(map(float, inten))
+
+
+def _in_range(val, limits):
+    '''Check if a metadata value is a number in a (start, stop) range.'''
+    try:
+        val = float(val)
+    except (TypeError, ValueError):
+        return False
+    return limits[0] <= val <= limits[1]
 
 
 class TxtReference(ReferenceFileGeneric):
@@ -129,9 +847,7 @@ class TxtReference(ReferenceFileGeneric):
             mass.append(vals[0])
             inten.append(vals[1])
 
-        mass = np.array(mass, dtype=int)
-        inten = np.array(inten, dtype=float)
-        self.ref_mass_inten.append((mass, inten))
+        self._add_peaks(mass, inten)
 
         return return_line
 
@@ -147,25 +863,21 @@ class MslReference(ReferenceFileGeneric):
         super(MslReference, self).__init__(*args, **kwargs)
 
     def _ref_entry_proc(self, fobj, name):
-        inten = []
-        mass = []
+        lines = []
+        return_line = None
 
         for line in fobj:
             if line[0] == '#': continue
             elif line.isspace(): break
             elif ":" in line:
-                return line
+                return_line = line
+                break
+            lines.append(line)
 
-            vals = self.recomp.findall(line)
-            for val in vals:
-                mass.append(val[0])
-                inten.append(val[1])
-            
-        mass = np.array(mass, dtype=int)
-        inten = np.array(inten, dtype=float)
-        self.ref_mass_inten.append((mass, inten))
+        vals = self.recomp.findall(''.join(lines))
+        self._add_peaks([val[0] for val in vals], [val[1] for val in vals])
 
-        return None
+        return return_line
 
 
 class MspReference(ReferenceFileGeneric):
@@ -180,23 +892,22 @@ class MspReference(ReferenceFileGeneric):
         super(MspReference, self).__init__(*args, **kwargs)
 
     def _ref_entry_proc(self, fobj, name):
-        inten = []
-        mass = []
+        lines = []
+        return_line = None
 
         for line in fobj:
             if line[0] == '#': continue
             elif line.isspace(): break
             elif ":" in line:
-                return line
+                return_line = line
+                break
+            elif ";" not in line:
+                # One "mass intensity" pair per line
+                line = line.rstrip() + ';'
+            lines.append(line)
 
-            vals = self.recomp.findall(line)
-            for val in vals:
-                mass.append(val[0])
-                inten.append(val[1])
-            
-        mass = np.array(mass, dtype=int)
-        inten = np.array(inten, dtype=float)
-        self.ref_mass_inten.append((mass, inten))
+        vals = self.recomp.findall(''.join(lines))
+        self._add_peaks([val[0] for val in vals], [val[1] for val in vals])
 
-        return None
+        return return_line
 
@@ -0,0 +1,144 @@
+'''Shared helpers for the tests, which are available as fixtures.'''
+import itertools as it
+
+import numpy as np
+import pytest
+from scipy.io import netcdf_file
+
+
+def groupby_decode(fname):
+    '''The original, scan-by-scan AiaFile decoder.
+
+    Repeated (rounded) masses in a scan are averaged with itertools.groupby.
+    Returns the times, masses, and intensity arrays.
+    '''
+    data = netcdf_file(fname, mmap=False)
+    points = data.variables['point_count'][:]
+    times = data.variables['scan_acquisition_time'][:]/60.
+    mass_cdf = data.variables['mass_values'][:]
+    inten_cdf = data.variables['intensity_values'][:]
+    mass_min = int( np.round( mass_cdf.min() ) )
+    mass_max = int( np.round( mass_cdf.max() ) )
+    masses = np.arange(mass_min, mass_max + 1)
+
+    intens = []
+    start = 0
+    for point in points:
+        int_zero = np.zeros(masses.size, dtype=float)
+        if point == 0:
+            intens.append( int_zero )
+            continue
+
+        mass_tmp = np.round( mass_cdf[start:start+point] ).astype(int)
+        ints_tmp = inten_cdf[start:start+point]
+        mass_tmp2 = []
+        ints_tmp2 = []
+        for mass, mass_int in it.groupby( zip(mass_tmp, ints_tmp),
+                key=lambda x: x[0]):
+            ints = [i[1] for i in mass_int]
+            mass_tmp2.append(mass)
+            ints_tmp2.append(np.array(ints).mean())
+        int_zero[np.array(mass_tmp2) - mass_min] = ints_tmp2
+        intens.append( int_zero )
+        start += point
+    data.close()
+
+    return times, masses, np.array(intens)
+
+def write_cdf(fname, nscans=300, seed=0):
+    '''Write a synthetic AIA file.
+
+    Every 17th scan is empty, and most scans have repeated masses, both
+    exact duplicates and different values that round to the same mass.
+    '''
+    rng = np.random.RandomState(seed)
+    masses = []
+    intens = []
+    points = []
+    for num in range(nscans):
+        n = 0 if num % 17 == 5 else rng.randint(1, 80)
+        mass = np.round(rng.uniform(35., 300., n), 1)
+        if n > 3:
+            # An exact duplicate and a pair that rounds to the same mass
+            mass[1] = mass[0]
+            mass[2] = np.round(mass[3]) + 0.2
+            mass[3] = np.round(mass[3]) - 0.3
+        masses.append(np.sort(mass))
+        intens.append(rng.uniform(0., 1e4, n).round())
+        points.append(n)
+
+    f = netcdf_file(fname, 'w')
+    f.createDimension('scan_number', nscans)
+    f.createDimension('point_number', sum(points))
+    var = f.createVariable('point_count', 'i', ('scan_number',))
+    var[:] = points
+    var = f.createVariable('scan_acquisition_time', 'd', ('scan_number',))
+    var[:] = np.arange(nscans)*0.4 + 5.
+    var = f.createVariable('mass_values', 'f', ('point_number',))
+    var[:] = np.concatenate(masses)
+    var = f.createVariable('intensity_values', 'f', ('point_number',))
+    var[:] = np.concatenate(intens)
+    f.close()
+
+def write_ref(fname, ncpds=40, seed=0):
+    '''Write a synthetic txt reference file with random spectra.'''
+    rng = np.random.RandomState(seed)
+    with open(fname, 'w') as f:
+        for num in range(ncpds):
+            f.write('NAME:cpd{}\nRT:{:.3f}\nNUM PEAKS:\n'.format(num,
+                rng.uniform(5., 50.)))
+            masses = np.sort(rng.choice(np.arange(40, 290), 12,
+                replace=False))
+            for mass, inten in zip(masses, rng.uniform(1., 999., 12)):
+                f.write('  {} {:.1f}\n'.format(mass, inten))
+            f.write('\n')
+
+def write_known(tmp_path, spectra, coef):
+    '''Write a data file and a reference file for known spectra.
+
+    Each spectrum is a dictionary of m/z and intensity values, and each scan
+    of the data is a combination of the spectra with one row of `coef`.
+    '''
+    mass = np.array(sorted(set().union(*spectra)), dtype=float)
+    spec = np.array([[s.get(m, 0.) for m in mass] for s in spectra])
+    inten = coef.dot(spec)
+
+    cdfname = str(tmp_path / 'known.CDF')
+    f = netcdf_file(cdfname, 'w')
+    f.createDimension('scan_number', coef.shape[0])
+    f.createDimension('point_number', inten.size)
+    var = f.createVariable('point_count', 'i', ('scan_number',))
+    var[:] = np.full(coef.shape[0], mass.size)
+    var = f.createVariable('scan_acquisition_time', 'd', ('scan_number',))
+    var[:] = np.arange(coef.shape[0])*0.4 + 5.
+    var = f.createVariable('mass_values', 'f', ('point_number',))
+    var[:] = np.tile(mass, coef.shape[0])
+    var = f.createVariable('intensity_values', 'f', ('point_number',))
+    var[:] = inten.ravel()
+    f.close()
+
+    refname = str(tmp_path / 'known.txt')
+    with open(refname, 'w') as f:
+        for num, s in enumerate(spectra):
+            f.write('NAME:cpd{}\nNUM PEAKS:\n'.format(num))
+            for m in sorted(s):
+                f.write('  {} {}\n'.format(m, s[m]))
+            f.write('\n')
+    return cdfname, refname
+
+
+@pytest.fixture(name='groupby_decode')
+def groupby_decode_fixture():
+    return groupby_decode
+
+@pytest.fixture(name='write_cdf')
+def write_cdf_fixture():
+    return write_cdf
+
+@pytest.fixture(name='write_ref')
+def write_ref_fixture():
+    return write_ref
+
+@pytest.fixture(name='write_known')
+def write_known_fixture():
+    return write_known
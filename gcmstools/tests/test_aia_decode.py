@@ -0,0 +1,32 @@
+'''Parity tests of the AIA scan decoding against the original decoder.'''
+import numpy as np
+import scipy.sparse as sps
+
+import gcmstools.filetypes as gcf
+
+
+def test_decode_parity(tmp_path, write_cdf, groupby_decode):
+    fname = str(tmp_path / 'parity.CDF')
+    write_cdf(fname)
+    times, masses, inten = groupby_decode(fname)
+    # The synthetic file must exercise the edge cases
+    assert (inten == 0.).all(axis=1).any()
+
+    data = gcf.AiaFile(fname, quiet=True)
+    np.testing.assert_array_equal(data.times, times)
+    np.testing.assert_array_equal(data.masses, masses)
+    np.testing.assert_allclose(data.intensity, inten, rtol=1e-6)
+    np.testing.assert_allclose(data.tic, inten.sum(axis=1), rtol=1e-6)
+
+def test_decode_parity_sparse_lazy(tmp_path, write_cdf, groupby_decode):
+    fname = str(tmp_path / 'parity.CDF')
+    write_cdf(fname, seed=1)
+    times, masses, inten = groupby_decode(fname)
+
+    data = gcf.AiaFile(fname, quiet=True, sparse=True)
+    assert sps.issparse(data.intensity)
+    np.testing.assert_allclose(data.intensity.toarray(), inten, rtol=1e-6)
+
+    data = gcf.AiaFile(fname, quiet=True, lazy=True)
+    np.testing.assert_allclose(np.asarray(data.intensity), inten, rtol=1e-6)
+    np.testing.assert_allclose(data.tic, inten.sum(axis=1), rtol=1e-6)
@@ -0,0 +1,78 @@
+'''Tests of the persistent decoded-file cache.'''
+import os
+
+import numpy as np
+import pytest
+
+import gcmstools.filetypes as gcf
+from gcmstools.cache import ArrayCache
+
+
+def no_decode(*args, **kwargs):
+    raise AssertionError("The file was decoded or hashed again.")
+
+@pytest.fixture
+def cached_file(tmp_path, write_cdf):
+    '''Write a data file and decode it once into an empty cache.'''
+    fname = str(tmp_path / 'data.CDF')
+    write_cdf(fname, nscans=60)
+    cache = ArrayCache(str(tmp_path / 'cache'))
+    gcf.AiaFile(fname, quiet=True, cache=cache)
+    return fname, cache
+
+def check_data(data, fname, groupby_decode):
+    times, masses, inten = groupby_decode(fname)
+    np.testing.assert_array_equal(data.times, times)
+    np.testing.assert_array_equal(data.masses, masses)
+    np.testing.assert_allclose(data.intensity, inten, rtol=1e-6)
+
+
+def test_cache_hit(cached_file, groupby_decode, monkeypatch):
+    fname, cache = cached_file
+    monkeypatch.setattr(gcf.cdf, 'netcdf_file', no_decode)
+    monkeypatch.setattr(gcf, 'file_digest', no_decode)
+    data = gcf.AiaFile(fname, quiet=True, cache=cache)
+    assert isinstance(data.intensity, np.memmap)
+    check_data(data, fname, groupby_decode)
+
+def test_cache_touched(cached_file, groupby_decode, monkeypatch):
+    fname, cache = cached_file
+    stat = os.stat(fname)
+    os.utime(fname, (stat.st_atime, stat.st_mtime + 100.))
+
+    # The contents are hashed, but the file isn't decoded again
+    monkeypatch.setattr(gcf.cdf, 'netcdf_file', no_decode)
+    data = gcf.AiaFile(fname, quiet=True, cache=cache)
+    check_data(data, fname, groupby_decode)
+
+    # The new modification time is saved, so the file isn't hashed again
+    monkeypatch.setattr(gcf, 'file_digest', no_decode)
+    gcf.AiaFile(fname, quiet=True, cache=cache)
+
+def test_cache_replaced(cached_file, groupby_decode, write_cdf):
+    fname, cache = cached_file
+    write_cdf(fname, nscans=60, seed=1)
+    stat = os.stat(fname)
+    os.utime(fname, (stat.st_atime, stat.st_mtime + 100.))
+
+    data = gcf.AiaFile(fname, quiet=True, cache=cache)
+    check_data(data, fname, groupby_decode)
+    assert len(os.listdir(cache.cache_dir)) == 1
+
+def test_cache_eviction(tmp_path):
+    cache = ArrayCache(str(tmp_path / 'cache'))
+    arrays = {'values': np.zeros(1000)}
+    cache.save('a', arrays)
+    size = sum(os.path.getsize(os.path.join(cache.cache_dir, 'a', f))
+            for f in os.listdir(os.path.join(cache.cache_dir, 'a')))
+    cache.save('b', arrays)
+    for num, key in enumerate(['a', 'b']):
+        info = os.path.join(cache.cache_dir, key, 'info.json')
+        os.utime(info, (1000. + num, 1000. + num))
+
+    # Loading "a" makes "b" the least recently used entry
+    assert cache.load('a') is not None
+    cache.max_size = 2*size + size//2
+    cache.save('c', arrays)
+    assert sorted(os.listdir(cache.cache_dir)) == ['a', 'c']
+    assert cache.load('b') is None
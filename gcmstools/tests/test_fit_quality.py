@@ -0,0 +1,77 @@
+'''Tests of the fit-quality metrics stored with the fits.'''
+import copy
+
+import numpy as np
+import pytest
+
+import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
+import gcmstools.fitting as gcfit
+from gcmstools.datastore import GcmsStore
+
+
+@pytest.fixture
+def referenced(tmp_path, write_cdf, write_ref):
+    cdfname = str(tmp_path / 'data.CDF')
+    refname = str(tmp_path / 'ref.txt')
+    write_cdf(cdfname, nscans=120)
+    write_ref(refname)
+    data = gcf.AiaFile(cdfname, quiet=True)
+    gcr.TxtReference(refname, quiet=True, cache=False)(data)
+    return data
+
+def check_quality(data):
+    '''Compare the stored metrics with the simulated spectra.'''
+    inten = data.intensity_rows()
+    resid = np.linalg.norm(data.fit_residuals(), axis=1)
+    norm = np.linalg.norm(inten, axis=1)
+    tic = inten.sum(axis=1)
+    fit_tic = data.fit_coef.dot(np.asarray(data.ref_array).sum(axis=1))
+    # Every 17th scan is empty, and its metrics are zero. Residuals below
+    # about 1e-7 of the scan norm are rounding errors.
+    empty = tic == 0
+    assert empty.any()
+
+    np.testing.assert_allclose(data.fit_resid, resid, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(data.fit_relresid[~empty],
+            resid[~empty]/norm[~empty], rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(data.fit_ticfrac[~empty],
+            fit_tic[~empty]/tic[~empty], rtol=1e-6)
+    assert not data.fit_relresid[empty].any()
+    assert not data.fit_ticfrac[empty].any()
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'solver': 'batch'},
+    {'rt_filter': True, 'rt_win': 5.}, {'prune': 2e4}, {'screen': 5}])
+def test_fit_quality(referenced, kwargs):
+    gcfit.Nnls(quiet=True, **kwargs)(referenced)
+    check_quality(referenced)
+
+def test_fit_quality_fnnls(referenced):
+    gcfit.Fnnls(quiet=True)(referenced)
+    check_quality(referenced)
+
+def test_fit_quality_store(tmp_path, referenced):
+    gcfit.Nnls(quiet=True)(referenced)
+    other = copy.copy(referenced)
+    other.filename = str(tmp_path / 'other.CDF')
+    gcfit.Nnls(quiet=True, prune=np.inf)(other)
+
+    h5 = GcmsStore(str(tmp_path / 'store.h5'))
+    h5.append_gcms([referenced, other])
+    scans = h5.fit_quality('data')
+    summary = h5.fit_quality()
+    h5.close()
+
+    np.testing.assert_allclose(scans.index, referenced.times)
+    for key in ('fit_resid', 'fit_relresid', 'fit_ticfrac'):
+        np.testing.assert_allclose(scans[key], getattr(referenced, key))
+    assert sorted(summary.index) == ['data', 'other']
+    for name, data in (('data', referenced), ('other', other)):
+        row = summary.loc[name]
+        assert row['scans'] == data.times.size
+        assert row['relresid_max'] == pytest.approx(data.fit_relresid.max())
+        assert row['relresid_median'] == pytest.approx(
+                np.median(data.fit_relresid))
+        assert row['ticfrac_median'] == pytest.approx(
+                np.median(data.fit_ticfrac))
@@ -0,0 +1,86 @@
+'''Tests of the cross-product NNLS solvers.'''
+import warnings
+
+import numpy as np
+import pytest
+import scipy.optimize as spo
+
+import gcmstools.fitting as gcfit
+
+
+def problem(seed=0):
+    '''A random problem with some negative unconstrained coefficients.'''
+    rng = np.random.RandomState(seed)
+    A = rng.rand(50, 20)
+    B = rng.rand(50, 30) - 0.3
+    return A, B
+
+
+def test_fnnls_matches_scipy():
+    A, B = problem()
+    X = gcfit.nnls_batch(A, B)
+    W, iters = gcfit.fnnls_warm(A.T.dot(A), A.T.dot(B))
+    for col in range(B.shape[1]):
+        x = spo.nnls(A, B[:, col])[0]
+        np.testing.assert_allclose(X[:, col], x, atol=1e-10)
+        np.testing.assert_allclose(W[:, col], x, atol=1e-10)
+
+def collinear_problem(seed=0):
+    '''A problem with pairs of nearly identical reference spectra.'''
+    rng = np.random.RandomState(seed)
+    A = rng.rand(200, 20)
+    A[:, 1::2] = A[:, ::2]*(1. + 1e-9*rng.randn(200, 10))
+    B = rng.rand(200, 10)
+    return A, B
+
+def assert_nnls_optimal(A, B, X):
+    '''Check solutions against scipy by their residuals. (The coefficients
+    of nearly collinear problems are not unique.)'''
+    for col in range(B.shape[1]):
+        x, rnorm = spo.nnls(A, B[:, col])
+        assert X[:, col].min() >= 0.
+        resid = np.linalg.norm(A.dot(X[:, col]) - B[:, col])
+        np.testing.assert_allclose(resid, rnorm, rtol=1e-6)
+
+def test_fnnls_max_iter():
+    # Unsolved columns are solved again by scipy
+    A, B = problem()
+    X = gcfit.nnls_batch(A, B, max_iter=0)
+    W, iters = gcfit.fnnls_warm(A.T.dot(A), A.T.dot(B), max_iter=1)
+    for col in range(B.shape[1]):
+        x = spo.nnls(A, B[:, col])[0]
+        np.testing.assert_allclose(X[:, col], x, atol=1e-10)
+        np.testing.assert_allclose(W[:, col], x, atol=1e-8)
+
+def test_fnnls_collinear():
+    for seed in range(5):
+        A, B = collinear_problem(seed)
+        AtA, AtB = A.T.dot(A), A.T.dot(B)
+        assert_nnls_optimal(A, B, gcfit.nnls_batch(A, B))
+        assert_nnls_optimal(A, B, gcfit.fnnls(AtA, AtB))
+        assert_nnls_optimal(A, B, gcfit.fnnls_warm(AtA, AtB, A=A, B=B)[0])
+        assert_nnls_optimal(A, B, gcfit.fnnls_warm(AtA, AtB)[0])
+
+def test_fnnls_zero_step():
+    # A new passive variable with a zero solution gives a 0/0 step
+    AtA = np.array([[1., 1.], [1., 1.]])
+    x = np.zeros(2)
+    P = np.array([False, True])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        x, count = gcfit._fnnls_feasible(AtA, np.zeros(2), x, P, 1e-12)
+    np.testing.assert_array_equal(x, 0.)
+    assert not P.any()
+
+def test_fnnls_solver():
+    assert gcfit.Fnnls().solver == 'batch'
+    assert gcfit.PgNnls(solver='batch').solver == 'batch'
+    with pytest.raises(ValueError):
+        gcfit.Fnnls(solver='warm')
+
+def test_nnls_pg_lipschitz():
+    A, B = problem()
+    AtA, AtB = A.T.dot(A), A.T.dot(B)
+    lipschitz = np.linalg.eigvalsh(AtA).max()
+    np.testing.assert_array_equal(gcfit.nnls_pg(AtA, AtB),
+            gcfit.nnls_pg(AtA, AtB, lipschitz=lipschitz))
@@ -0,0 +1,68 @@
+'''Tests of GcmsFile.index and xic on sorted and unsorted axes.'''
+import numpy as np
+import pytest
+
+import gcmstools.filetypes as gcf
+
+
+@pytest.fixture
+def data(tmp_path, write_cdf):
+    fname = str(tmp_path / 'data.CDF')
+    write_cdf(fname, nscans=60)
+    return gcf.AiaFile(fname, quiet=True)
+
+def argmin_index(array, vals):
+    '''The closest indices found by brute force.'''
+    return np.abs(np.subtract.outer(vals, array)).argmin(axis=-1)
+
+
+def test_index_sorted(data):
+    vals = np.array([[0., 0.3], [0.25, 0.5], [1., 0.1234]])
+    np.testing.assert_array_equal(data.index(data.times, vals),
+            argmin_index(data.times, vals))
+    # Ties go to the lower index
+    mid = data.times[:2].mean()
+    assert data.index(data.times, mid) == 0
+    start, stop = data.index(data.times, 0.2, 0.4)
+    assert (start, stop) == tuple(argmin_index(data.times, [0.2, 0.4]))
+
+def test_index_unsorted(data):
+    rng = np.random.RandomState(0)
+    array = rng.permutation(data.times)
+    vals = rng.uniform(0., 1., (4, 3))
+    np.testing.assert_array_equal(data.index(array, vals),
+            argmin_index(array, vals))
+    assert data.index(array, vals[0, 0]) == argmin_index(array, vals[0, 0])
+
+    # A reversed copy of a sorted axis is not sorted
+    array = data.times[::-1].copy()
+    np.testing.assert_array_equal(data.index(array, vals),
+            argmin_index(array, vals))
+    np.testing.assert_array_equal(data.index(data.times, vals),
+            argmin_index(data.times, vals))
+
+def test_index_repeated(data):
+    # Repeated values resolve to their first occurrence, like argmin
+    array = np.repeat(np.arange(10.), 3)
+    vals = np.array([-1., 0.4, 0.5, 2.5, 4.6, 20.])
+    np.testing.assert_array_equal(data.index(array, vals),
+            argmin_index(array, vals))
+    for val in vals:
+        assert data.index(array, val) == argmin_index(array, val)
+
+def test_xic_unsorted(data):
+    masses = np.array([50., 91., 43.2, 150.])
+    start, stop = data.times[10], data.times[40]
+    xic = data.xic(masses, start, stop)
+    expect = data.intensity[10:41][:, data.index(data.masses, masses)].T
+    np.testing.assert_array_equal(xic, expect)
+
+    # The same traces are found if the mass axis (and the intensity columns)
+    # are not in order
+    rng = np.random.RandomState(0)
+    order = rng.permutation(data.masses.size)
+    data.masses = data.masses[order]
+    data.intensity = np.ascontiguousarray(data.intensity[:, order])
+    np.testing.assert_array_equal(data.xic(masses, start, stop), expect)
+    np.testing.assert_array_equal(data.xic(masses, start, stop,
+        cache=False), expect)
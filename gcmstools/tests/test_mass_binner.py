@@ -0,0 +1,98 @@
+'''Tests of the MassBinner bin assignment.'''
+import numpy as np
+
+import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
+import gcmstools.fitting as gcfit
+from gcmstools.filetypes import MassBinner
+
+
+def bin_scan(binner, mass, inten):
+    '''Bin a single scan, returning the masses and binned intensities.'''
+    bins = binner.bin_index(mass)
+    first, last = bins.min(), bins.max()
+    values = binner(np.array([mass.size]), mass, inten, first, 
+            last - first + 1)
+    return binner.bin_masses(first, last), values[0]
+
+def test_sum_tenth_amu():
+    # 0.1 amu data, stored as float32 as in AIA files
+    mass = (np.arange(350, 651)*0.1).astype(np.float32)
+    inten = np.ones(mass.size)
+    masses, values = bin_scan(MassBinner(reduce='sum', half='up'), mass,
+            inten)
+
+    # Each whole bin (n - 0.5 up to n + 0.4) has 10 points
+    np.testing.assert_array_equal(masses, np.arange(35, 66))
+    np.testing.assert_array_equal(values[1:-1], 10.)
+    assert values.sum() == mass.size
+
+def test_integer_width_two():
+    mass = np.arange(35., 45.)
+    inten = np.arange(mass.size, dtype=float)
+    masses, values = bin_scan(MassBinner(width=2, reduce='sum'), mass, inten)
+
+    # Each bin has the masses 2n - 1 and 2n
+    np.testing.assert_array_equal(masses, np.arange(36, 46, 2))
+    np.testing.assert_array_equal(values, inten.reshape(-1, 2).sum(axis=1))
+
+def test_default_rounds_half_to_even():
+    # The default binner matches the original AIA decoder
+    mass = np.array([35.5, 36.5, 37.4])
+    np.testing.assert_array_equal(MassBinner().bin_index(mass), [36, 36, 37])
+
+def test_rounding_ignores_reduction():
+    mass = np.array([35.5, 36.5, 40.5])
+    for reduce in MassBinner.reductions:
+        np.testing.assert_array_equal(
+                MassBinner(reduce=reduce).bin_index(mass), [36, 36, 40])
+        np.testing.assert_array_equal(
+                MassBinner(reduce=reduce, half='up').bin_index(mass), 
+                [36, 37, 41])
+
+
+def fit_known(tmp_path, write_known, binner, spectra, scale=None):
+    '''Fit known combinations of the spectra with a binner.
+
+    The fit coefficients are scaled by the maximum of each binned spectrum,
+    `scale`, which is the maximum of the raw spectrum by default.
+    '''
+    rng = np.random.RandomState(0)
+    coef = rng.uniform(0., 2., (20, len(spectra)))
+    # The spectra are normalized in the reference array
+    coef[:, 0] = 0.
+    cdfname, refname = write_known(tmp_path, spectra, coef)
+    data = gcf.AiaFile(cdfname, quiet=True, binner=binner)
+    gcr.TxtReference(refname, quiet=True, cache=False, bkg=False)(data)
+    gcfit.Nnls(quiet=True)(data)
+    if scale is None:
+        scale = [max(s.values()) for s in spectra]
+    np.testing.assert_allclose(data.fit_coef, coef*scale, atol=1e-3)
+    assert data.fit_relresid.max() < 1e-6
+
+def test_fit_width_two(tmp_path, write_known):
+    # Odd masses are halfway between bins, so they go to the upper bin
+    spectra = [{37: 100., 41: 50.}, {39: 80., 43: 100., 47: 20.}, 
+            {41: 30., 45: 100.}]
+    fit_known(tmp_path, write_known, MassBinner(width=2), spectra)
+
+def test_fit_offset(tmp_path, write_known):
+    # Integer masses are halfway between bins centered on n + 0.5
+    spectra = [{40: 100., 42: 50.}, {41: 80., 43: 100.}, 
+            {40: 30., 44: 100.}]
+    fit_known(tmp_path, write_known, MassBinner(offset=0.5), spectra)
+
+def test_fit_width_two_shared_bin(tmp_path, write_known):
+    # m/z 37 and 38 are both in bin 38, so the reference peaks are reduced
+    # like the data
+    spectra = [{37: 100., 38: 60., 41: 50.}, {39: 80., 43: 100.}, 
+            {41: 30., 42: 40., 45: 100.}]
+    fit_known(tmp_path, write_known, MassBinner(width=2, reduce='sum'),
+            spectra, scale=[160., 100., 100.])
+
+    # The mean of a bin is only linear if every compound in the bin has all
+    # of its masses
+    spectra = [{37: 100., 38: 60., 41: 50.}, {39: 80., 43: 100.}, 
+            {45: 100., 47: 30.}]
+    fit_known(tmp_path, write_known, MassBinner(width=2), spectra, 
+            scale=[80., 100., 100.])
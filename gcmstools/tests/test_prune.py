@@ -0,0 +1,66 @@
+'''Tests of the noise-floor scan pruning of Nnls.'''
+import copy
+
+import numpy as np
+import pytest
+
+import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
+import gcmstools.fitting as gcfit
+
+
+@pytest.fixture
+def referenced(tmp_path, write_cdf, write_ref):
+    cdfname = str(tmp_path / 'data.CDF')
+    refname = str(tmp_path / 'ref.txt')
+    write_cdf(cdfname, nscans=120)
+    write_ref(refname)
+    data = gcf.AiaFile(cdfname, quiet=True)
+    gcr.TxtReference(refname, quiet=True, cache=False)(data)
+    return data
+
+
+@pytest.mark.parametrize('solver', ['scipy', 'batch', 'warm'])
+def test_prune_abs(referenced, solver):
+    full = copy.copy(referenced)
+    gcfit.Nnls(quiet=True, solver=solver)(full)
+    pruned = copy.copy(referenced)
+    threshold = np.median(referenced.tic)
+    gcfit.Nnls(quiet=True, solver=solver, prune=threshold)(pruned)
+
+    mask = referenced.tic < threshold
+    np.testing.assert_array_equal(pruned.fit_pruned, mask)
+    assert pruned.fit_coef.shape == full.fit_coef.shape
+    assert pruned.fit_sim.shape == full.fit_sim.shape
+    assert pruned.fit_csum.shape == full.fit_csum.shape
+    # The other scans are fit as before
+    np.testing.assert_allclose(pruned.fit_coef[~mask], full.fit_coef[~mask],
+            atol=1e-8)
+
+    # The pruned scans are fit with the Background only
+    assert referenced.ref_cpds[-1] == 'Background'
+    assert not pruned.fit_coef[mask, :-1].any()
+    bkg = np.asarray(referenced.ref_array[-1], dtype=float)
+    inten = referenced.intensity[mask].dot(bkg)/bkg.dot(bkg)
+    np.testing.assert_allclose(pruned.fit_coef[mask, -1],
+            np.maximum(inten, 0.))
+
+def test_prune_modes(referenced):
+    tic = np.asarray(referenced.tic, dtype=float)
+    fitter = gcfit.Nnls(quiet=True, prune=25., prune_mode='percentile')
+    fitter(referenced)
+    np.testing.assert_array_equal(referenced.fit_pruned,
+            tic < np.percentile(tic, 25.))
+
+    fitter = gcfit.Nnls(quiet=True, prune=0., prune_mode='snr')
+    fitter(referenced)
+    np.testing.assert_array_equal(referenced.fit_pruned,
+            tic < np.median(tic))
+
+    # A fit without pruning removes the mask of an older fit
+    gcfit.Nnls(quiet=True)(referenced)
+    assert not hasattr(referenced, 'fit_pruned')
+
+def test_prune_mode_error():
+    with pytest.raises(ValueError):
+        gcfit.Nnls(prune=1., prune_mode='median')
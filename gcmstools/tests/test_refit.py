@@ -0,0 +1,79 @@
+'''Tests of refitting after the reference set changes.'''
+import copy
+
+import numpy as np
+
+import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
+import gcmstools.fitting as gcfit
+
+
+def edit_ref(fname, names, rt=None, peak=None):
+    '''Change the RT or the first peak intensity of reference compounds.
+
+    Each compound gets the value with the same index, if a list is given.
+    '''
+    if isinstance(names, str):
+        names = [names]
+    rts = np.broadcast_to(rt, len(names))
+    with open(fname) as f:
+        entries = f.read().split('\n\n')
+    for num, entry in enumerate(entries):
+        lines = entry.split('\n')
+        if lines[0][5:] not in names:
+            continue
+        if rt is not None:
+            lines[1] = 'RT:{:.3f}'.format(rts[names.index(lines[0][5:])])
+        if peak is not None:
+            mass = lines[3].split()[0]
+            lines[3] = '  {} {:.1f}'.format(mass, peak)
+        entries[num] = '\n'.join(lines)
+    with open(fname, 'w') as f:
+        f.write('\n\n'.join(entries))
+
+def referenced(data, refname):
+    dfile = copy.copy(data)
+    gcr.TxtReference(refname, quiet=True, cache=False)(dfile)
+    return dfile
+
+def check_refit(tmp_path, write_cdf, write_ref, **edit):
+    cdfname = str(tmp_path / 'data.CDF')
+    refname = str(tmp_path / 'ref.txt')
+    write_cdf(cdfname, nscans=120)
+    write_ref(refname)
+    # Spread the compounds over the elution times of the data
+    data = gcf.AiaFile(cdfname, quiet=True)
+    rng = np.random.RandomState(0)
+    edit_ref(refname, ['cpd{}'.format(num) for num in range(40)], 
+            rt=rng.uniform(data.times[0], data.times[-1], 40))
+    fitter = gcfit.Nnls(quiet=True, rt_filter=True, rt_win=0.05)
+
+    prev = referenced(data, refname)
+    fitter(prev)
+    edit_ref(refname, 'cpd5', **edit)
+    new = referenced(data, refname)
+    count = fitter.refit(new, prev)
+    full = referenced(data, refname)
+    fitter(full)
+
+    assert 0 < count < data.times.size
+    np.testing.assert_allclose(new.fit_coef, full.fit_coef, atol=1e-8)
+    np.testing.assert_allclose(new.fit_resid, full.fit_resid, rtol=1e-6,
+            atol=1e-6)
+    return data, prev, new
+
+def test_refit_rt(tmp_path, write_cdf, write_ref):
+    check_refit(tmp_path, write_cdf, write_ref, rt=0.5)
+
+def test_refit_spectrum(tmp_path, write_cdf, write_ref):
+    check_refit(tmp_path, write_cdf, write_ref, peak=5.)
+
+def test_refit_options(tmp_path, write_cdf, write_ref):
+    data, prev, new = check_refit(tmp_path, write_cdf, write_ref, rt=0.5)
+    # A different retention window refits the whole file
+    fitter = gcfit.Nnls(quiet=True, rt_filter=True, rt_win=0.1)
+    assert fitter.refit(new, prev) == data.times.size
+    full = copy.copy(new)
+    fitter(full)
+    np.testing.assert_allclose(new.fit_coef, full.fit_coef)
+    assert new.fit_options == full.fit_options != prev.fit_options
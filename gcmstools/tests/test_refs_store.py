@@ -0,0 +1,135 @@
+'''Tests of the shared reference data stored once in a GcmsStore.'''
+import pickle
+
+import numpy as np
+import pytest
+
+import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
+import gcmstools.fitting as gcfit
+from gcmstools.datastore import GcmsStore
+
+
+@pytest.fixture
+def files(tmp_path, write_cdf, write_ref):
+    '''Three data files and a reference file.'''
+    cdfnames = []
+    for num in range(3):
+        cdfname = str(tmp_path / 'data{}.CDF'.format(num))
+        write_cdf(cdfname, nscans=60, seed=num)
+        cdfnames.append(cdfname)
+    refname = str(tmp_path / 'ref.txt')
+    write_ref(refname)
+    return cdfnames, refname
+
+def process(cdfnames, refname):
+    datafiles = [gcf.AiaFile(f, quiet=True) for f in cdfnames]
+    gcr.TxtReference(refname, quiet=True, cache=False)(datafiles)
+    gcfit.Nnls(quiet=True)(datafiles)
+    return datafiles
+
+def meta_dict(ref_meta):
+    return dict((name, dict(meta)) for name, meta in ref_meta.items())
+
+def stored_refs(h5):
+    return sorted(g._v_name for g in h5.root.refs._f_iter_nodes('Group'))
+
+def check_stored(h5, data):
+    stored = h5.extract_gcms(data.filename)
+    np.testing.assert_array_equal(stored.ref_array, data.ref_array)
+    assert stored.ref_cpds == data.ref_cpds
+    assert stored.ref_hashes == data.ref_hashes
+    assert meta_dict(stored.ref_meta) == meta_dict(data.ref_meta)
+    np.testing.assert_array_equal(stored.fit_coef, data.fit_coef)
+    return stored
+
+
+def test_refs_round_trip(tmp_path, files):
+    cdfnames, refname = files
+    datafiles = process(cdfnames, refname)
+
+    h5 = GcmsStore(str(tmp_path / 'store.h5'), quiet=True)
+    h5.append_gcms(datafiles)
+    # The reference data is stored once, and the files only keep its key
+    keys = set(h5.data._f_get_child(name)._v_attrs.gcmsinfo['ref_key']
+            for name in ('data0', 'data1', 'data2'))
+    assert len(keys) == 1
+    assert stored_refs(h5) == ['ref_' + keys.pop()]
+    for name in ('data0', 'data1', 'data2'):
+        assert 'ref_array' not in h5.data._f_get_child(name)
+
+    stored = [check_stored(h5, data) for data in datafiles]
+    # The extracted files share the library metadata
+    assert stored[0].ref_meta.shared is stored[1].ref_meta.shared
+    # But the per-file metadata (e.g. the integrals) is not shared
+    name = stored[0].ref_cpds[0]
+    stored[0].ref_meta[name]['note'] = 'changed'
+    assert 'note' not in stored[1].ref_meta[name]
+    h5.close()
+
+    # The data is read back after the file is reopened
+    h5 = GcmsStore(str(tmp_path / 'store.h5'), quiet=True)
+    for data in datafiles:
+        check_stored(h5, data)
+    h5.close()
+
+def test_remove_unused_refs(tmp_path, files, write_ref):
+    cdfnames, refname = files
+    datafiles = process(cdfnames, refname)
+    h5name = str(tmp_path / 'store.h5')
+    h5 = GcmsStore(h5name, quiet=True)
+    h5.append_gcms(datafiles)
+    old = stored_refs(h5)
+
+    # Rewriting two files with a new reference set keeps the old reference
+    # data for the third file
+    write_ref(refname, seed=1)
+    newfiles = process(cdfnames, refname)
+    h5.append_gcms(newfiles[:2])
+    new = [r for r in stored_refs(h5) if r not in old]
+    assert len(new) == 1
+    assert stored_refs(h5) == sorted(old + new)
+    check_stored(h5, newfiles[0])
+    check_stored(h5, datafiles[2])
+
+    # The old reference data is removed once no file uses it
+    h5.append_gcms(newfiles[2])
+    assert stored_refs(h5) == new
+    for data in newfiles:
+        check_stored(h5, data)
+
+    # Unused reference data is also removed when the file is compressed
+    h5._append_ref('0'*32, gcr.split_ref(datafiles[0])[1])
+    assert len(stored_refs(h5)) == 2
+    h5.compress()
+    h5 = GcmsStore(h5name, quiet=True)
+    assert stored_refs(h5) == new
+    for data in newfiles:
+        check_stored(h5, data)
+    h5.close()
+
+def test_pack_refs(tmp_path, files):
+    # Files from an engine of a multiprocess proc_data only carry the shared
+    # reference data once
+    cdfnames, refname = files
+    datafiles = process(cdfnames, refname)
+    expect = process(cdfnames, refname)
+    sent = set()
+    packed = []
+    for data in datafiles:
+        gcr.pack_ref(data, sent)
+        packed.append( pickle.loads(pickle.dumps(data)) )
+    assert len(sent) == 1
+    assert [p._ref_parts[1] is None for p in packed] == [False, True, True]
+
+    shared_refs = {}
+    gcr.unpack_refs(packed, shared_refs)
+    assert list(shared_refs) == list(sent)
+    assert packed[0].ref_meta.shared is packed[2].ref_meta.shared
+
+    h5 = GcmsStore(str(tmp_path / 'store.h5'), quiet=True)
+    h5.append_gcms(packed)
+    assert stored_refs(h5) == ['ref_' + key for key in sent]
+    for data in expect:
+        check_stored(h5, data)
+    h5.close()
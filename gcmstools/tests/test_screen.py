@@ -0,0 +1,84 @@
+'''Tests of the spectral-similarity candidate screening.'''
+import copy
+
+import numpy as np
+import pytest
+import scipy.sparse as sps
+
+import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
+import gcmstools.fitting as gcfit
+
+
+def brute_candidates(inten, ref, k, window, mode):
+    '''Screen each scan separately.'''
+    sim = np.array([[r.dot(s) for r in ref] for s in inten])
+    if mode == 'cosine':
+        norms = np.outer(np.linalg.norm(inten, axis=1),
+                np.linalg.norm(ref, axis=1))
+        sim = np.where(norms > 0, sim/np.where(norms > 0, norms, 1.), 0.)
+    masks = np.zeros(sim.shape, dtype=bool)
+    for num in range(sim.shape[0]):
+        row = sim[max(num - window, 0):num + window + 1].max(axis=0)
+        top = np.argsort(-row, kind='stable')[:k]
+        masks[num, top[row[top] > 0]] = True
+    return masks
+
+
+@pytest.mark.parametrize('mode', ['cosine', 'dot'])
+@pytest.mark.parametrize('window', [0, 2])
+def test_screen_candidates(mode, window):
+    rng = np.random.RandomState(0)
+    # Sparse spectra, so that some compounds have no overlap with some scans
+    ref = rng.uniform(0., 1., (30, 50))*(rng.uniform(size=(30, 50)) < 0.1)
+    inten = rng.uniform(0., 1., (40, 50))*(rng.uniform(size=(40, 50)) < 0.2)
+    inten[5] = 0.
+    expect = brute_candidates(inten, ref, 4, window, mode)
+
+    for array in (ref, sps.csr_matrix(ref)):
+        masks = gcfit.screen_candidates(inten, array, 4, window, mode)
+        np.testing.assert_array_equal(masks, expect)
+    if window == 0:
+        # An empty scan has no candidates
+        assert not masks[5].any()
+    assert (masks.sum(axis=1) <= 4).all()
+
+def test_screen_all(tmp_path, write_cdf, write_ref):
+    # Screening at least as many compounds as the reference set is a full fit
+    cdfname = str(tmp_path / 'data.CDF')
+    refname = str(tmp_path / 'ref.txt')
+    write_cdf(cdfname, nscans=60)
+    write_ref(refname)
+    data = gcf.AiaFile(cdfname, quiet=True)
+    gcr.TxtReference(refname, quiet=True, cache=False)(data)
+    full = copy.copy(data)
+    gcfit.Nnls(quiet=True)(full)
+    gcfit.Nnls(quiet=True, screen=len(data.ref_cpds))(data)
+    np.testing.assert_allclose(data.fit_coef, full.fit_coef, atol=1e-8)
+
+@pytest.mark.parametrize('rounds', [1, 2])
+def test_screen_known(tmp_path, write_known, rounds):
+    # Each scan is a mix of two of many compounds with separate masses, so
+    # the two compounds are the most similar spectra
+    rng = np.random.RandomState(0)
+    ncpds = 30
+    spectra = [dict((40 + 3*num + m, rng.uniform(10., 100.))
+        for m in range(3)) for num in range(ncpds)]
+    coef = np.zeros((20, ncpds))
+    for row in coef:
+        row[rng.choice(ncpds, 2, replace=False)] = rng.uniform(1., 2., 2)
+    cdfname, refname = write_known(tmp_path, spectra, coef)
+    data = gcf.AiaFile(cdfname, quiet=True)
+    gcr.TxtReference(refname, quiet=True, cache=False, bkg=False)(data)
+    gcfit.Nnls(quiet=True, screen=2, screen_win=0,
+            screen_rounds=rounds)(data)
+
+    scale = [max(s.values()) for s in spectra]
+    np.testing.assert_allclose(data.fit_coef, coef*scale, atol=1e-6)
+    assert data.fit_relresid.max() < 1e-6
+
+def test_screen_errors():
+    with pytest.raises(ValueError):
+        gcfit.Nnls(screen=0)
+    with pytest.raises(ValueError):
+        gcfit.Nnls(screen=5, screen_mode='euclidean')
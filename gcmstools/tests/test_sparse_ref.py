@@ -0,0 +1,109 @@
+'''Tests of sparse reference arrays against dense reference arrays.'''
+import copy
+
+import numpy as np
+import pytest
+import scipy.sparse as sps
+
+import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
+import gcmstools.fitting as gcfit
+from gcmstools.datastore import GcmsStore
+
+
+@pytest.fixture
+def referenced(tmp_path, write_cdf, write_ref):
+    '''Reference the same data file with sparse and dense arrays.'''
+    cdfname = str(tmp_path / 'data.CDF')
+    refname = str(tmp_path / 'ref.txt')
+    write_cdf(cdfname, nscans=120)
+    write_ref(refname)
+    data = gcf.AiaFile(cdfname, quiet=True)
+
+    files = []
+    for sparse in (True, False):
+        ref = gcr.TxtReference(refname, quiet=True, cache=False,
+                sparse_ref=sparse)
+        dfile = copy.copy(data)
+        ref(dfile)
+        files.append(dfile)
+    return files
+
+
+def test_sparse_ref_array(referenced):
+    sparse, dense = referenced
+    assert sps.issparse(sparse.ref_array)
+    assert not sps.issparse(dense.ref_array)
+    np.testing.assert_array_equal(sparse.ref_array.toarray(),
+            dense.ref_array)
+    assert sparse.ref_hash == dense.ref_hash
+    assert sparse.ref_hashes == dense.ref_hashes
+
+def test_sparse_ref_fits(referenced):
+    sparse, dense = referenced
+    for kwargs in ({}, {'screen': 5}, {'rt_filter': True, 'rt_win': 5.}):
+        for dfile in (sparse, dense):
+            gcfit.Nnls(quiet=True, solver='batch', **kwargs)(dfile)
+        np.testing.assert_allclose(sparse.fit_coef, dense.fit_coef)
+        np.testing.assert_allclose(sparse.fit_csum, dense.fit_csum)
+    np.testing.assert_allclose(sparse.fit_residuals(), dense.fit_residuals())
+
+def test_sparse_ref_store(tmp_path, referenced):
+    sparse, dense = referenced
+    h5 = GcmsStore(str(tmp_path / 'store.h5'))
+    h5.append_gcms(sparse)
+    stored = h5.extract_gcms('data')
+    h5.close()
+    assert sps.issparse(stored.ref_array)
+    np.testing.assert_array_equal(stored.ref_array.toarray(),
+            dense.ref_array)
+    assert stored.ref_cpds == dense.ref_cpds
+
+def test_shared_ref_meta(tmp_path, referenced):
+    sparse, dense = referenced
+    ref = gcr.TxtReference(str(tmp_path / 'ref.txt'), quiet=True, 
+            cache=False)
+    files = [copy.copy(sparse), copy.copy(dense)]
+    ref(files)
+    one, two = files
+    assert one.ref_meta.shared is two.ref_meta.shared
+    assert list(one.ref_meta) == list(ref.ref_meta)
+
+    # Per-file values don't change the library or the other files
+    one.ref_meta['cpd3']['integral'] = 5.
+    assert one.ref_meta['cpd3']['integral'] == 5.
+    assert 'integral' not in two.ref_meta['cpd3']
+    assert 'integral' not in ref.ref_meta['cpd3']
+    assert one.ref_meta['cpd3']['RT'] == ref.ref_meta['cpd3']['RT']
+    one.ref_meta['Background']['bkg_idx'] = 7
+    assert two.ref_meta['Background']['bkg_idx'] == 0
+
+def test_split_ref_memo(tmp_path, referenced, monkeypatch):
+    sparse, dense = referenced
+    for dfile in (sparse, dense):
+        dfile.ref_meta['cpd3']['integral'] = 2.
+        key, shared, local = gcr.split_ref(dfile)
+        # Copies don't keep the memo
+        other = copy.copy(dfile)
+        assert not hasattr(other, '_ref_shared')
+        other_key, junk, other_local = gcr.split_ref(other)
+        assert other_key == key
+        np.testing.assert_array_equal(local.pop('ref_array'), 
+                other_local.pop('ref_array'))
+        assert local == other_local
+
+    # The shared key is only calculated once for all of the files
+    calls = []
+    shared_key = gcr._shared_key
+    monkeypatch.setattr(gcr, '_shared_key', 
+            lambda shared: calls.append(1) or shared_key(shared))
+    ref = gcr.TxtReference(str(tmp_path / 'ref.txt'), quiet=True, 
+            cache=False)
+    files = [copy.copy(dense) for num in range(3)]
+    ref(files)
+    keys = set(gcr.split_ref(dfile)[0] for dfile in files)
+    assert len(keys) == 1 and len(calls) == 1
+
+    # Values that are not per-file values are not shared
+    files[0].ref_meta['cpd3']['RT'] = '1.0'
+    assert gcr.split_ref(files[0])[0] not in keys
@@ -0,0 +1,94 @@
+'''Tests of fitting the scans of a file with a pool of worker processes.'''
+import copy
+
+import numpy as np
+import pytest
+
+import gcmstools.filetypes as gcf
+import gcmstools.reference as gcr
+import gcmstools.fitting as gcfit
+from gcmstools.datastore import GcmsStore
+
+
+def referenced(tmp_path, write_cdf, write_ref, **kwargs):
+    cdfname = str(tmp_path / 'data.CDF')
+    refname = str(tmp_path / 'ref.txt')
+    write_cdf(cdfname, nscans=120)
+    write_ref(refname)
+    data = gcf.AiaFile(cdfname, quiet=True)
+    gcr.TxtReference(refname, quiet=True, cache=False, **kwargs)(data)
+    return data
+
+def check_workers(data, fittype, **kwargs):
+    '''Compare a fit with worker processes to a serial fit.'''
+    serial = copy.copy(data)
+    gcfit.get_fit(fittype, quiet=True, **kwargs)(serial)
+    fit = gcfit.get_fit(fittype, quiet=True, workers=2, **kwargs)
+    try:
+        # The pool is kept for the next file
+        for num in range(2):
+            parallel = copy.copy(data)
+            fit(parallel)
+            np.testing.assert_allclose(parallel.fit_coef, serial.fit_coef,
+                    atol=1e-8)
+            np.testing.assert_allclose(parallel.fit_csum, serial.fit_csum,
+                    atol=1e-6)
+            for key in ('fit_resid', 'fit_relresid', 'fit_ticfrac'):
+                np.testing.assert_allclose(getattr(parallel, key),
+                        getattr(serial, key), atol=1e-6)
+            for key in ('fit_iters', 'fit_pruned'):
+                assert hasattr(parallel, key) == hasattr(serial, key)
+            if hasattr(serial, 'fit_pruned'):
+                np.testing.assert_array_equal(parallel.fit_pruned,
+                        serial.fit_pruned)
+            if hasattr(serial, 'fit_iters'):
+                # Each range of scans starts without a warm start
+                bounds = np.linspace(0, data.times.size, 5).astype(int)
+                warm = np.ones(data.times.size, dtype=bool)
+                warm[bounds[:-1]] = False
+                np.testing.assert_array_equal(parallel.fit_iters[warm],
+                        serial.fit_iters[warm])
+    finally:
+        fit.close()
+    assert fit._pool is None
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'solver': 'warm'},
+    {'rt_filter': True, 'rt_win': 5., 'prune': 2e4}, {'screen': 5}])
+def test_workers(tmp_path, write_cdf, write_ref, kwargs):
+    data = referenced(tmp_path, write_cdf, write_ref)
+    check_workers(data, 'Nnls', **kwargs)
+
+def test_workers_sparse_ref(tmp_path, write_cdf, write_ref):
+    # Sparse reference arrays are sent to the workers instead of shared
+    data = referenced(tmp_path, write_cdf, write_ref, sparse_ref=True)
+    check_workers(data, 'Nnls', solver='batch')
+
+def test_workers_fnnls(tmp_path, write_cdf, write_ref):
+    data = referenced(tmp_path, write_cdf, write_ref)
+    check_workers(data, 'Fnnls')
+
+def test_proc_data_workers(tmp_path, write_cdf, write_ref):
+    pytest.importorskip('IPython.parallel')
+    import gcmstools.general as gcg
+
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    for num in range(3):
+        write_cdf(str(folder / 'data{}.CDF'.format(num)), nscans=60,
+                seed=num)
+    refname = str(tmp_path / 'ref.txt')
+    write_ref(refname)
+
+    stored = {}
+    for workers in (None, 2):
+        h5name = str(tmp_path / 'store{}.h5'.format(workers))
+        gcg.proc_data(str(folder), h5name, reffile=refname, fittype='Nnls',
+                fit_workers=workers, quiet=True)
+        h5 = GcmsStore(h5name)
+        stored[workers] = [h5.extract_gcms('data{}'.format(num))
+                for num in range(3)]
+        h5.close()
+    for serial, parallel in zip(stored[None], stored[2]):
+        np.testing.assert_allclose(parallel.fit_coef, serial.fit_coef,
+                atol=1e-8)
@@ -19,20 +19,21 @@ setup(
         'Development Status :: 4 - Beta',
         'Intended Audience :: Science/Research',
         'License :: OSI Approved :: BSD License',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
     ],
 
     keywords = "gcms aia nnls",
 
     packages = find_packages(),
+    # The parallel fits use multiprocessing.shared_memory
+    python_requires = '>=3.8',
     install_requires = [
-        'numpy>=1.9.1',
+        'numpy>=1.15',
         'matplotlib>=1.4.2',
         'tables>=3.1.1',
-        'scipy>=0.14.0',
+        'scipy>=1.0',
         'pandas>=0.15.2',
         'IPython>=2.3.1',
     ],